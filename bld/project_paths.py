@@ -0,0 +1,10 @@
+import os
+R = '/root/package'
+project_paths = {
+ 'PROJECT_ROOT': R, 'IN_MODEL_SPECS': R+'/src/model_specs',
+ 'OUT_DATA': R+'/bld/out/data', 'OUT_ANALYSIS': R+'/bld/out/analysis',
+ 'OUT_TABLES': R+'/bld/out/tables', 'OUT_FIGURES': R+'/bld/out/figures',
+ 'OUT_PAPER': R+'/bld/out/paper', 'OUT_FINAL': R+'/bld/out/final',
+}
+def project_paths_join(key, *args):
+    return os.path.join(project_paths[key], *args)
@@ -0,0 +1,209 @@
+"""Storage of the intermediate results of the analysis as array artifacts.
+
+An artifact with the stem *name* (a path without extension) consists of
+
+    * *name*.npy: the data as one array, in numpy's own binary format, such
+      that it can be loaded with *np.load(..., mmap_mode='r')* and only the
+      parts that are actually touched are read from disk,
+    * *name*.json: a small sidecar with the shape and dtype of the array and
+      further metadata (e.g. the random seed and a hash of the model
+      specifications that the array was generated from),
+    * *name*_index.npz (DataFrames only): the levels of the index.
+
+DataFrames with a (caseid, period) MultiIndex are stored as artifact of their
+values; columns and index names are kept in the sidecar.
+
+"""
+
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+
+def artifact_files(stem, frame=False):
+    """Return the paths of the files of the artifact *stem* (e.g. to declare
+    them as targets of a build task).
+
+    """
+
+    files = [stem + '.npy', stem + '.json']
+    if frame:
+        files.append(stem + '_index.npz')
+    return files
+
+
+def spec_hash(*paths):
+    """Return the SHA-256 hash over the contents of the files in *paths*
+    (the model specifications that an artifact depends on).
+
+    """
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as spec_file:
+            digest.update(spec_file.read())
+    return digest.hexdigest()
+
+
+def _write_metadata(stem, metadata):
+    with open(stem + '.json', 'w', encoding = 'utf-8') as out_file:
+        json.dump(metadata, out_file, indent = 4)
+
+
+def load_metadata(stem):
+    """Return the sidecar of the artifact *stem* as dictionary."""
+
+    with open(stem + '.json', encoding = 'utf-8') as in_file:
+        return json.load(in_file)
+
+
+def save_array(stem, array, **metadata):
+    """Store *array* as artifact *stem*.
+
+    Args:
+        + *stem* (string): Path of the artifact without extension.
+        + *array* (np.ndarray): Array to store.
+        + *metadata*: Further entries of the sidecar (JSON serializable),
+          e.g. *seed* and *spec_hash*.
+
+    """
+
+    array = np.asarray(array)
+    np.save(stem + '.npy', array)
+    _write_metadata(
+                    stem,
+                    dict(
+                            metadata, shape = list(array.shape),
+                            dtype = array.dtype.str
+                        )
+                   )
+
+
+def open_array(stem, shape, dtype=np.float64, **metadata):
+    """Create artifact *stem* as writable memory-mapped array, such that it
+    can be filled chunk by chunk without holding it in memory.
+
+    Args:
+        + *stem* (string): Path of the artifact without extension.
+        + *shape* (tuple), *dtype* (np.dtype): Of the array.
+        + *metadata*: Further entries of the sidecar, see *save_array*.
+
+    Returns:
+        + array (np.memmap): Flush it (or delete it) when it is filled.
+
+    """
+
+    array = np.lib.format.open_memmap(
+                                        stem + '.npy', mode = 'w+',
+                                        dtype = dtype, shape = tuple(shape)
+                                     )
+    _write_metadata(
+                    stem,
+                    dict(
+                            metadata, shape = list(array.shape),
+                            dtype = array.dtype.str
+                        )
+                   )
+    return array
+
+
+def load_array(stem, mmap_mode='r'):
+    """Load the array of artifact *stem*, by default memory-mapped and
+    read-only, and check it against the sidecar.
+
+    Args:
+        + *stem* (string): Path of the artifact without extension.
+        + *mmap_mode* (string or None): See *np.load*.
+
+    Returns:
+        + array (np.ndarray or np.memmap)
+
+    """
+
+    metadata = load_metadata(stem)
+    array = np.load(stem + '.npy', mmap_mode = mmap_mode)
+    if (
+            list(array.shape) != metadata['shape'] or
+            array.dtype.str != metadata['dtype']
+        ):
+        raise ArtifactError(stem)
+    return array
+
+
+def save_frame(stem, frame, **metadata):
+    """Store the values of DataFrame *frame* as artifact *stem*, the index
+    levels in *stem*_index.npz. Columns are stored with a common dtype.
+
+    """
+
+    index = frame.index
+    _save_index(stem, index)
+    save_array(
+                stem, frame.values, columns = list(frame.columns),
+                index_names = list(index.names), **metadata
+              )
+
+
+def _save_index(stem, index):
+    np.savez(
+                stem + '_index.npz',
+                **{
+                    'level_{}'.format(i): index.get_level_values(i).values
+                    for i in range(index.nlevels)
+                  }
+            )
+
+
+def open_frame(stem, index, columns, dtype=np.float64, **metadata):
+    """Create artifact *stem* of a DataFrame with *index* and *columns* (see
+    *save_frame*), whose values are a writable memory-mapped array (see
+    *open_array*).
+
+    """
+
+    _save_index(stem, index)
+    return open_array(
+                        stem, (len(index), len(columns)), dtype,
+                        columns = list(columns),
+                        index_names = list(index.names), **metadata
+                     )
+
+
+def load_frame(stem, mmap_mode='r'):
+    """Load the DataFrame stored as artifact *stem* (see *save_frame*). By
+    default, the values are a read-only memory-mapped array (see
+    *load_array*); with *mmap_mode* None, they are read into memory.
+
+    """
+
+    metadata = load_metadata(stem)
+    values = load_array(stem, mmap_mode)
+    with np.load(stem + '_index.npz') as levels:
+        arrays = [
+                    levels['level_{}'.format(i)]
+                    for i in range(len(metadata['index_names']))
+                 ]
+    if 1 == len(arrays):
+        index = pd.Index(arrays[0], name = metadata['index_names'][0])
+    else:
+        index = pd.MultiIndex.from_arrays(
+                                            arrays,
+                                            names = metadata['index_names']
+                                         )
+    return pd.DataFrame(
+                        values, index = index, columns = metadata['columns'],
+                        copy = False
+                       )
+
+
+class ArtifactError(Exception):
+
+    def __init__(self, stem):
+        self.stem = stem
+
+    def __str__(self):
+        return (
+                "Array of artifact '{}' does not match the shape and dtype in "
+                "its sidecar."
+               ).format(self.stem)
@@ -1,4 +1,7 @@
-"""Organize true factors in DataFrame with MultiIndex and save as pickle."""
+"""Organize true factors in DataFrame with MultiIndex and save as array
+artifact.
+
+"""
 
 import numpy as np
 import pandas as pd
@@ -11,38 +14,39 @@ import pandas as pd
 # =============================================================================
 
 from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import save_frame
+from src.analysis.table_cache import load_tables, lookup, gather
 
 def extract_true_factors():
     """Merge tables generated from simulated data, where columns 'fac1',
     'fac2', 'fac3' from **table_2** contain the factor ids in **table_1**.
     
-    The output is one pandas dataframe (saved as pickle) that contains the
-    multiindex (caseid, period) and the three (true) factors.
+    The output is one pandas dataframe (saved as array artifact) that contains
+    the multiindex (caseid, period) and the three (true) factors.
     
     """
 
-    # Read in dataframes from Stata files.
-    factor = pd.read_stata(
-                            ppj("OUT_DATA","tables", "data_table_1.dta"),
-                            index_col = 'factor_id',
-                            columns = ['factor_id', 'true_fac']
-                          )
+    # Read in the columns of the tables from the cache.
+    factor, case = load_tables([1, 2])
     f_nr=['fac1', 'fac2', 'fac3']
-    case = pd.read_stata(
-                            ppj("OUT_DATA", "tables", "data_table_2.dta"),
-                            columns = f_nr + ['caseid', 't']
-                        )
-    case.set_index(['caseid', 't'], inplace = True)
-    
-    # Join data at indices, generate one dataframe and save as pickle.
     
-    for f in f_nr:
-        case = case.join(factor, on = f, rsuffix='_'+f)
-        
-    case.drop(f_nr, axis = 1, inplace = True)
-    case.columns = f_nr
-
-    case.to_pickle(ppj("OUT_ANALYSIS", 'true_facs.pkl'))
+    # Gather the true factors at the factor ids, generate one dataframe and
+    # save as artifact.
+    true_facs = pd.DataFrame(
+                    {
+                        f: gather(
+                                    factor['true_fac'],
+                                    lookup(factor['factor_id'], case[f])
+                                 )
+                        for f in f_nr
+                    },
+                    index = pd.MultiIndex.from_arrays(
+                                                [case['caseid'], case['t']],
+                                                names = ['caseid', 't']
+                                                     )
+                            )
+
+    save_frame(ppj("OUT_ANALYSIS", 'true_facs'), true_facs)
     
 if '__main__' == __name__:
     extract_true_factors()
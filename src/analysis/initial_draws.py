@@ -11,7 +11,16 @@ easily adapted to different analysis.
       distribution which is with mean zero and relevant variances.
     
 Transition errors for transition equations of factor 1 and factor 2 are 
-generated for each observation, period and particle combinations.
+generated for each observation, period and particle combinations. If
+"trans_errors" in smoother.json is "counter", they are not stored, but
+generated by the particle smoother itself when they are needed.
+
+The random prior is drawn from its own counter-based streams (see
+*PriorSampler*), not from the global random state of numpy. The stored
+transition errors are still drawn from the global random state seeded with
+"rnd_seed", but since the prior no longer draws from it first, they differ
+from the errors of earlier versions of this script as well; estimates are
+therefore not comparable draw by draw with results from before the change.
 
 Combined samples of factors from prior distributions are created. We make use
 of the cartesian product of constant and time-varying factors (for each observation)
@@ -21,20 +30,24 @@ factors.
 
 To be able use have the implications for the prior sampling, we follow two process
 for forming prior sample. Function prior_samples is the resulting random sampling 
-from given prior distribution. The second prior sample is simply the true values
+from given prior distribution (see *PriorSampler*, which can also draw blocks of
+observations on demand, such that the random prior need not be stored if
+"prior_draws" in smoother.json is "lazy"). The second prior sample is simply the true values
 of factors generated as the source data. The sampling process is followed by the 
 forming cartesian product as described above.
  
-Resulting arrays are stored as pickle files in "OUT_ANALYSIS" directory.
+Resulting arrays are stored as array artifacts (see *artifacts.save_array*) in
+"OUT_ANALYSIS" directory, together with the random seed and a hash of the
+model specifications they are drawn from.
 
 """
 
 import numpy as np
 import json
-import pickle
-import pandas as pd
 
 from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import save_array, load_frame, spec_hash
+from src.analysis.random_streams import counter_normals
 
 
 def transition_errors(fixed):
@@ -68,37 +81,149 @@ def cov_matrix(prior):
              )
     return cov_12
 
+# Number of observations per block of prior draws. Each block is drawn from
+# its own random stream, in which each observation has a fixed position,
+# such that draws do not depend on which observations are requested, or in
+# which order.
+PRIOR_SHARD_SIZE = 1000
+# Highest word of the counter of the prior streams (distinguishes them from
+# the streams of the transition errors, see *random_streams.period_errors*).
+_PRIOR_STREAM = 1
+
+
+class PriorSampler:
+    """Draw prior particles for all observations at once, or lazily for a
+    range of observations (e.g. the shard of a worker process).
+    
+    Each particle combines one of *draws_varying* joint draws of fac1 and
+    fac2 with one of *draws_constant* draws of fac3 (cartesian product), so
+    there are draws_varying*draws_constant particles per observation. The
+    joint draws use the Cholesky factor of the covariance matrix, which is
+    computed once. The draws of an observation come from fixed rows of the
+    Philox streams of its block (see *random_streams.counter_normals*), so
+    only the observations requested are drawn.
+    
+    Public methods:
+        + draw
+        + blocks
+        + sample
+    
+    """
+    
+    def __init__(self, cov_12, var3, fixed, shard_size=PRIOR_SHARD_SIZE):
+        """Set up the sampler.
+        
+        Args:
+            + *cov_12* (np.ndarray):
+                2x2 covariance matrix of fac1 and fac2, see *cov_matrix*.
+            + *var3* (float): Variance parameter of the prior of fac3.
+            + *fixed* (dictionary):
+                Contents of smoother.json ('obs', 'rnd_seed',
+                'draws_varying', 'draws_constant').
+            + *shard_size* (integer): Observations per random stream.
+        
+        Created class attributes:
+            + *chol* (np.ndarray): Lower Cholesky factor of *cov_12*.
+            + *shape* (tuple): Shape 3xNxM of the full prior.
+        
+        """
+        
+        self.chol = np.linalg.cholesky(cov_12)
+        self.var3 = var3
+        self.seed = fixed["rnd_seed"]
+        self.draws_varying = fixed["draws_varying"]
+        self.draws_constant = fixed["draws_constant"]
+        self.shard_size = shard_size
+        self.shape = (
+                        3, fixed["obs"],
+                        self.draws_varying*self.draws_constant
+                     )
+    
+    def _draw_shard(self, shard, lower, upper):
+        """Draw the 3xKxM prior particles of the K observations at positions
+        *lower* to *upper* of *shard*.
+        
+        """
+        
+        key = [self.seed, shard]
+        nr_obs = upper - lower
+        f12_0 = counter_normals(
+                                key, [0, 0, _PRIOR_STREAM], lower, nr_obs,
+                                2*self.draws_varying
+                               ).reshape(nr_obs, self.draws_varying, 2)
+        f12_0 = f12_0 @ self.chol.T
+        f3_0 = self.var3*counter_normals(
+                                        key, [1, 0, _PRIOR_STREAM], lower,
+                                        nr_obs, self.draws_constant
+                                        )
+        out = np.empty((3, nr_obs, self.shape[2]))
+        out[0:2, ...] = np.repeat(
+                                    np.moveaxis(f12_0, 2, 0),
+                                    self.draws_constant, axis = 2
+                                 )
+        out[2, ...] = np.tile(f3_0, (1, self.draws_varying))
+        return out
+    
+    def draw(self, start, stop):
+        """Draw the 3xKxM prior particles of the observations at positions
+        *start* to *stop*. Only these observations are drawn.
+        
+        """
+        
+        first = start // self.shard_size
+        last = (stop - 1) // self.shard_size
+        blocks = []
+        for shard in range(first, last+1):
+            shard_start = shard*self.shard_size
+            blocks.append(self._draw_shard(
+                    shard, max(start, shard_start) - shard_start,
+                    min(stop, shard_start + self.shard_size) - shard_start
+                                          ))
+        return np.concatenate(blocks, axis = 1)
+    
+    def blocks(self, block_size):
+        """Yield (start, stop, prior particles) for consecutive blocks of
+        *block_size* observations, drawn when they are requested.
+        
+        """
+        
+        for start in range(0, self.shape[1], block_size):
+            stop = min(start + block_size, self.shape[1])
+            yield start, stop, self.draw(start, stop)
+    
+    def sample(self):
+        """Draw the 3xNxM prior particles of all observations."""
+        
+        return self.draw(0, self.shape[1])
+
+
 def prior_samples(cov_12, prior, fixed):
     """Draw fac1 and fac2 from joint prior distribution and return the random 
     sample of fac1 and fac2.
     
     """
-    mean = [0, 0]
-    var3=prior[2]["var_p"]
-    prior_sample=np.empty([3, fixed["obs"], (fixed["n_particles"])])
-    total = np.zeros(((fixed["n_particles"]), 3))
-    for i in range(0, (fixed["obs"]+1)):
-        
-        f12_0 = np.random.multivariate_normal(
-                                             mean,cov_12,fixed["draws_varying"]
-                                             ) 
-        f3_0  = np.random.normal(0, var3, fixed["draws_constant"]) 
-        total[:, 0:2] = np.array(f12_0.repeat(len(f3_0), axis=0))
-        total[:, 2] = np.array(np.tile(f3_0, len(f12_0)))
-        prior_sample[:, i:(i+1), :]= np.expand_dims(total.T, axis=1)
     
-    return prior_sample
+    return PriorSampler(cov_12, prior[2]["var_p"], fixed).sample()
     
-def _true_prior_samples(true_facs):
-    """ Take true factors of period 1 as prior samples.
+def _true_prior(true_facs):
+    """ Take true factors of period 1 as (degenerate) prior, stored once per
+    observation as 3xNx1 array.
     
     """
     true_per_1 = ((true_facs.loc[(slice(None), 1), :]).values).T
-    true_prior = np.repeat(
-                    true_per_1[:, :, np.newaxis], fixed["n_particles"], axis=2
-                        )
     
-    return true_prior
+    return true_per_1[:, :, np.newaxis]
+    
+def _true_prior_samples(true_facs, n_particles):
+    """ Take true factors of period 1 as prior samples: a read-only 3xNxM view
+    of *_true_prior*, in which all particles of an observation share memory.
+    
+    """
+    true_prior = _true_prior(true_facs)
+    
+    return np.broadcast_to(
+                    true_prior, true_prior.shape[:2] + (n_particles,)
+                          )
 
 if __name__ == "__main__":
     prior = json.load(
@@ -116,25 +241,35 @@ if __name__ == "__main__":
     
     
     np.random.seed(fixed["rnd_seed"])
-    true_facs= pd.read_pickle(ppj("OUT_ANALYSIS", "true_facs.pkl"))
+    true_facs= load_frame(ppj("OUT_ANALYSIS", "true_facs"))
+    metadata = {
+                "seed": fixed["rnd_seed"],
+                "spec_hash": spec_hash(
+                                        ppj("IN_MODEL_SPECS", "smoother.json"),
+                                        ppj("IN_MODEL_SPECS", "true_prior.json")
+                                      )
+               }
     # Load true variances and form covarince matrix     
     cov_12 = cov_matrix(prior)
      #Draw random samples of fac1&fac2 and fac3.
      #Merge those to form whole sample.
-    prior_all = prior_samples(cov_12, prior, fixed)
-    # Store the drawn samples.
-    with open(ppj("OUT_ANALYSIS", "true_rnd_prior.pickle"), "wb") as out_file:
-        pickle.dump(prior_all, out_file)
+    if "lazy" != fixed.get("prior_draws", "stored"):
+        prior_all = prior_samples(cov_12, prior, fixed)
+        # Store the drawn samples.
+        save_array(ppj("OUT_ANALYSIS", "true_rnd_prior"), prior_all, **metadata)
     # Load true factors of period 1.
-    true_prior = _true_prior_samples(true_facs)
-    # Store the factors of period 1.
-    with open(ppj("OUT_ANALYSIS", "true_deg_prior.pickle"), "wb") as out_file:
-        pickle.dump(true_prior, out_file)
-   # Construct errors for transition equations of fac1 and fac2.
-    tr_errors = transition_errors(fixed)
-    #Store errors as pickle file.
-    with open(ppj("OUT_ANALYSIS","transition_errors.pickle"),"wb") as out_file:
-        pickle.dump(tr_errors, out_file)
+    true_prior = _true_prior(true_facs)
+    # Store the factors of period 1 (once per observation, the smoother
+    # broadcasts them to all particles).
+    save_array(ppj("OUT_ANALYSIS", "true_deg_prior"), true_prior, **metadata)
+    if "counter" != fixed.get("trans_errors", "stored"):
+        # Construct errors for transition equations of fac1 and fac2.
+        tr_errors = transition_errors(fixed)
+        #Store errors as array artifact.
+        save_array(
+                    ppj("OUT_ANALYSIS","transition_errors"), tr_errors,
+                    **metadata
+                  )
         
         
     
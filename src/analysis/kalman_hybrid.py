@@ -0,0 +1,337 @@
+"""Hybrid of the particle smoother and the Kalman smoother for factor types
+with linear-Gaussian dynamics of their own.
+
+With the shipped :file:`transitions.json`, fac2 follows the Gaussian AR(1)
+process fac2 + log(gamma2) + u (see *Transition.autoregressive_factors*),
+and all its measurements are linear-Gaussian, i.e. one Gaussian
+pseudo-measurement per period (see *Measurement._collapse_equations*). The
+posterior of such a factor type given its own measurements is Gaussian, so
+it is computed exactly by a Kalman smoother, vectorized over all
+observations (see *KalmanBlock*):
+
+    * the estimates of the autoregressive factor types are the Kalman
+      smoothed means,
+    * their particles (which the other factor types need as inputs to
+      their transition equations) are drawn from the exact smoothing
+      distribution instead of the transition equation: the prior particles
+      are weighted with the likelihood of all measurements of these factor
+      types, and each period is drawn given the last one and the
+      measurements of the remaining periods,
+    * particles are therefore weighted with the measurements of the other
+      factor types only, and the backward iteration corrects its weights
+      for the look-ahead of the draws before it draws the next particle
+      (see *particle_smoother.SmootherModel.smooth*).
+
+The Kalman estimates use the measurements of the autoregressive factor types
+only; what the other measurements reveal about them through the (nonlinear)
+transition equations of the other factor types is left out.
+
+Run as a script, the bootstrap smoother and the hybrid are compared for
+increasing numbers of particles (see *rao_blackwell.benchmark*).
+
+"""
+
+import argparse
+import json
+import numpy as np
+
+from bld.project_paths import project_paths_join as ppj
+from src.analysis.particle_smoother import SmootherModel
+from src.analysis.particle_smoother import _observation_prior
+from src.analysis.rao_blackwell import benchmark, equal_rmse_table
+from src.analysis.artifacts import load_frame
+
+
+class KalmanBlock:
+    """Kalman smoother of the A autoregressive factor types of a model, for
+    all N observations and P periods at once. Only means differ between
+    observations; variances and precisions are shared by all of them.
+
+    Besides the smoothed means, the backward information filter of the
+    measurements is kept: for each period t, the likelihood of the
+    measurements of periods t, ..., P as function of the factor in period t
+    is (up to a constant) a Gaussian density with precision
+    *info_precisions* and mean *info_means*. It gives the distribution of
+    the next period given the last one and all measurements (see
+    *draw_next*), and the likelihood of the measurements of the next periods
+    given the factor (see *log_message*).
+
+    Instance variables:
+        + *factors* (np.ndarray): Positions of the A factor types.
+        + *intercepts*, *slopes*, *variances* (np.ndarray):
+            A-arrays with the AR(1) parameters, see
+            *Transition.autoregressive_factors*.
+        + *precisions* (np.ndarray):
+            A-array with the precision of the pseudo-measurements.
+        + *meas_means* (np.ndarray): AxNxP pseudo-measurements.
+        + *info_precisions* (np.ndarray): AxP array.
+        + *info_means* (np.ndarray): AxNxP array.
+
+    Public methods:
+        + log_message
+        + draw_next
+        + smoothed_means
+
+    """
+
+    def __init__(self, transition, meas_objs):
+        """Find the autoregressive factor types of *transition* (Transition)
+        and run the backward information filter over the measurements in
+        *meas_objs* (list of Measurement, one per factor type).
+
+        """
+
+        (
+            self.factors, self.intercepts, self.slopes, self.variances
+        ) = transition.autoregressive_factors()
+        self.precisions = np.array(
+                            [meas_objs[f].precision for f in self.factors]
+                                  )
+        self.meas_means = np.stack(
+                            [meas_objs[f].collapsed_mean for f in self.factors]
+                                  ).reshape((len(self.factors),)
+                                            + meas_objs[0].meas_res.shape[1:])
+        nr_per = self.meas_means.shape[2]
+        self.info_precisions = np.empty((len(self.factors), nr_per))
+        self.info_means = np.empty_like(self.meas_means)
+        self.info_precisions[:, -1] = self.precisions
+        self.info_means[..., -1] = self.meas_means[..., -1]
+        for per in reversed(range(nr_per - 1)):
+            # Pass the information of the later periods through the
+            # transition equation and add the measurements of period per.
+            var = self._message_variances(per + 1)
+            self.info_precisions[:, per] = (
+                                            self.precisions
+                                            + self.slopes**2/var
+                                           )
+            self.info_means[..., per] = (
+                    self.precisions[:, np.newaxis]*self.meas_means[..., per]
+                    + (self.slopes/var)[:, np.newaxis]*(
+                                self.info_means[..., per+1]
+                                - self.intercepts[:, np.newaxis]
+                                                       )
+                                        ) / self.info_precisions[
+                                                            :, per, np.newaxis
+                                                                ]
+
+    def _message_variances(self, per):
+        """Return the A variances of the Gaussian (in the expected next
+        state) that gives the likelihood of the measurements from position
+        *per* on.
+
+        """
+
+        return self.variances + 1/self.info_precisions[:, per]
+
+    def _column(self, array, per, ndim):
+        """Broadcast column *per* of the A or AxN *array* against AxNxM
+        arrays (*ndim* is 1 or 2).
+
+        """
+
+        return array[(slice(None),)*ndim + (per,) + (np.newaxis,)*(3-ndim)]
+
+    def log_message(self, per, factors):
+        """Return the NxM log-likelihood (up to a constant per observation)
+        of the measurements of periods *per* + 1, ..., P, given the AxNxM
+        *factors* in period *per* (0 is the prior).
+
+        """
+
+        intercepts = self.intercepts[:, np.newaxis, np.newaxis]
+        slopes = self.slopes[:, np.newaxis, np.newaxis]
+        var = self._message_variances(per)[:, np.newaxis, np.newaxis]
+        deviations = (
+                        intercepts + slopes*factors
+                        - self._column(self.info_means, per, 2)
+                     )
+        return np.sum(-.5*deviations*deviations/var, axis = 0)
+
+    def draw_next(self, factors, errors, per):
+        """Draw the factors of period *per* + 1 given the AxNxM *factors* of
+        period *per* (0 is the prior) and all measurements, from the
+        normalized AxNxM *errors*.
+
+        """
+
+        intercepts = self.intercepts[:, np.newaxis, np.newaxis]
+        slopes = self.slopes[:, np.newaxis, np.newaxis]
+        trans_precisions = 1/self.variances[:, np.newaxis, np.newaxis]
+        info_precisions = self._column(self.info_precisions, per, 1)
+        precisions = trans_precisions + info_precisions
+        means = (
+                    trans_precisions*(intercepts + slopes*factors)
+                    + info_precisions*self._column(self.info_means, per, 2)
+                ) / precisions
+        return means + errors/np.sqrt(precisions)
+
+    def smoothed_means(self, prior):
+        """Return the AxNxP smoothed means of the factors, starting from the
+        mean and variance of the AxNxM particles *prior* of each
+        observation. Combines the forward Kalman filter (predicted
+        distribution of each period) with the backward information filter.
+
+        """
+
+        means = np.mean(prior, axis = 2)
+        variances = np.var(prior, axis = 2)
+        out = np.empty_like(self.meas_means)
+        for per in range(out.shape[2]):
+            means = (
+                        self.intercepts[:, np.newaxis]
+                        + self.slopes[:, np.newaxis]*means
+                    )
+            pred_precisions = 1/(
+                                    self.slopes[:, np.newaxis]**2*variances
+                                    + self.variances[:, np.newaxis]
+                                )
+            info_precisions = self.info_precisions[:, per, np.newaxis]
+            out[..., per] = (
+                                pred_precisions*means
+                                + info_precisions*self.info_means[..., per]
+                            ) / (pred_precisions + info_precisions)
+            filt_precisions = (
+                                pred_precisions
+                                + self.precisions[:, np.newaxis]
+                              )
+            means = (
+                        pred_precisions*means
+                        + self.precisions[:, np.newaxis]
+                        * self.meas_means[..., per]
+                    ) / filt_precisions
+            variances = 1/filt_precisions
+        return out
+
+
+class KalmanHybridModel(SmootherModel):
+    """Smoother model (see *particle_smoother.SmootherModel*) that handles
+    the autoregressive factor types with a *KalmanBlock* and particles for
+    the others.
+
+    Instance variables:
+        + *kalman* (KalmanBlock)
+
+    Public methods:
+        + smooth
+
+    """
+
+    def __init__(self, params, meas_params, trans_params, meas_data=None):
+        """See *particle_smoother.SmootherModel*."""
+
+        super().__init__(params, meas_params, trans_params, meas_data)
+        self.kalman = KalmanBlock(self.trans_obj, self.meas_objs)
+        # Rows of the transition errors of the autoregressive factor types.
+        self._error_rows = np.searchsorted(
+                                            self.trans_obj.nonconst,
+                                            self.kalman.factors
+                                          )
+
+    def _next_state(self, state, errors, per, unique=None):
+        next_state = super()._next_state(state, errors, per, unique)
+        current = state[self.kalman.factors, ...]
+        if unique is not None:
+            current = unique.expand(unique.compress(current))
+        next_state[self.kalman.factors, ...] = self.kalman.draw_next(
+                                            current, errors[self._error_rows],
+                                            per
+                                                                    )
+        return next_state
+
+    def _measured(self, per):
+        return np.setdiff1d(super()._measured(per), self.kalman.factors)
+
+    def _log_weights(self, next_state, state, per, constants, unique=None):
+        weights = super()._log_weights(
+                                        next_state, state, per, constants,
+                                        unique
+                                      )
+        if 0 == per:
+            # The autoregressive factor types are drawn given all of their
+            # measurements, whose likelihood weights the prior particles.
+            weights += self.kalman.log_message(
+                                            0, state[self.kalman.factors, ...]
+                                              )
+        return weights
+
+    def _backward_log_weights(self, next_estimates, particles, per,
+                              constants=None, unique=None):
+        # Particles were drawn towards the measurements of the later
+        # periods, which the transition densities account for already.
+        # Dividing by their likelihood leaves the filter weights of the
+        # model with the autoregressive factor types marginalised out; the
+        # backward index is drawn from them (their argmax would pick the
+        # particles that fit the later measurements worst).
+        return super()._backward_log_weights(
+                                        next_estimates, particles, per,
+                                        constants, unique
+                                            ) - self.kalman.log_message(
+                                    per, particles[self.kalman.factors, ...]
+                                                                      )
+
+    def smooth(self, prior, trans_errors, rng=np.random):
+        """Estimate the factors of all observations from *prior* (see
+        *particle_smoother.SmootherModel.smooth*); the estimates of the
+        autoregressive factor types are the Kalman smoothed means.
+
+        """
+
+        if not isinstance(prior, np.ndarray):
+            prior = _observation_prior(prior, 0, len(self.caseids))
+        result = super().smooth(prior, trans_errors, rng)
+        result.estimates[:, self.kalman.factors, :] = np.moveaxis(
+                    self.kalman.smoothed_means(prior[self.kalman.factors]),
+                    2, 0
+                                                                  )
+        return result
+
+
+def kalman_hybrid_smoother(
+                        params, meas_params, trans_params, prior, trans_errors,
+                        meas_data=None, rng=np.random
+                          ):
+    """Estimate the factors like *particle_smoother* (same arguments and
+    output), with the autoregressive factor types handled by a Kalman
+    smoother (see *KalmanHybridModel*).
+
+    """
+
+    model = KalmanHybridModel(params, meas_params, trans_params, meas_data)
+    return model.smooth(prior, trans_errors, rng).to_frame()
+
+
+SMOOTHERS = {'bootstrap': SmootherModel, 'kalman_hybrid': KalmanHybridModel}
+
+
+if __name__ == "__main__":
+    from src.analysis.prepare_data import MeasurementManifest, MANIFEST
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+                        "--draws-varying", type = int, nargs = "+",
+                        default = [1, 2, 3, 5, 10],
+                        help = "numbers of draws of fac1 and fac2 per "
+                               "observation in the prior"
+                       )
+    args = parser.parse_args()
+    params, meas_params, trans_params, prior = [
+                json.load(open(
+                                ppj("IN_MODEL_SPECS", name+".json"),
+                                encoding = "utf-8"
+                              ))
+                for name in ['smoother', 'measurements', 'transitions',
+                             'true_prior']
+                                               ]
+    # Measurement data that is stored in shards is loaded from the manifest.
+    if params.get("meas_shard_size", 0) > 0:
+        meas_data = MeasurementManifest(ppj("OUT_ANALYSIS", MANIFEST))
+    else:
+        meas_data = None
+    table = benchmark(
+                        params, meas_params, trans_params, prior,
+                        load_frame(ppj("OUT_ANALYSIS", "true_facs")),
+                        args.draws_varying, meas_data, SMOOTHERS
+                     )
+    table.to_csv(ppj("OUT_TABLES", "kalman_hybrid_benchmark.csv"))
+    equal_rmse_table(
+                    table, params["draws_constant"]*max(args.draws_varying)
+                    ).to_csv(ppj("OUT_TABLES", "kalman_hybrid_equal_rmse.csv"))
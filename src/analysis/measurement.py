@@ -4,7 +4,6 @@ MeasurementDimensionError class: exception if dimensions do not fit.
 
 import numpy as np
 import pandas as pd
-from scipy.stats import norm
 
 class Measurement:
     """Organize measurement-data and parameters pertaining to the measurement
@@ -19,16 +18,27 @@ class Measurement:
             Has measurements for all measurement equations and additional
             controls, over all observations. Has MultiIndex (caseid, period)
             and columns 'control', 'control_2', 'meas1', 'meas2', 'meas3'.
+            Is only read at construction: the residuals are stored in a dense
+            (equation, observation, period) array, such that the lookup of
+            one period is a view.
         
     Public methods:
         + marginal_probability
+        + log_marginal_probability
     
     """
     
-    def __init__(self, parameters, data):
+    def __init__(self, parameters, data, collapse=True):
         """Store parameters and measurement data for use in linear measurement
         equation.
         
+        Since all measurement equations are linear in the factor and have
+        Gaussian errors, the product of their densities is (up to a constant
+        per observation and period) a single Gaussian density in the factor.
+        Its precision, mean and log-constant are precomputed here, such that
+        the marginal probability of a factor costs one quadratic evaluation,
+        whatever the number of measurement equations.
+        
         Args:
             + *parameters* (list of dictionaries):
                 Each dictionary contains names 'beta1', 'beta2' (coefficients
@@ -37,20 +47,47 @@ class Measurement:
             + *data* (pd.DataFrame):
                 Has MultiIndex (caseid, period) and columns 'control', 
                 'control_2', 'meas1', 'meas2', 'meas3'.
+            + *collapse* (boolean):
+                Evaluate the collapsed Gaussian (default) instead of the
+                product over the measurement equations.
         
         Created class attributes:
-            + *meas_res* (list of pd.DataFrame):
-                DataFrame with MultiIndex (caseid, period) and column that 
-                stores the residuals of measurements given controls (and 
-                coefficients), for each measurement equation.
+            + *caseids* (np.ndarray):
+                Sorted caseids of the N observations.
+            + *periods* (np.ndarray):
+                Sorted periods (P of them) with measurements.
+            + *meas_res* (np.ndarray):
+                Contiguous array of shape ExNxP (E measurement equations)
+                that stores the residuals of measurements given controls (and
+                coefficients), ordered by caseid and period.
             + *fac_coeff* (list of scalars):
                 Stores coefficient of factor for each measurement equation.
             + *variances* (list of scalars):
                 Stores error variances for each measurement equation.
+            + *precision* (scalar):
+                Precision of the collapsed Gaussian, sum of z^2/var.
+            + *collapsed_mean*, *collapsed_log_const* (np.ndarray):
+                Arrays of shape NxP with mean and log-constant of the
+                collapsed Gaussian.
+        
+        Raises:
+            + MeasurementDimensionError:
+                If *data* does not have exactly one row per combination of
+                caseid and period.
                 
         """
         
-        self.meas_res = []
+        # Validate that data form a complete (caseid, period)-grid, such that
+        # residuals can be stored in one dense array.
+        data = data.sort_index()
+        self.caseids = data.index.unique(level = 0).values
+        self.periods = data.index.unique(level = 1).values
+        nr_obs, nr_per = len(self.caseids), len(self.periods)
+        expected = pd.MultiIndex.from_product([self.caseids, self.periods])
+        if (0 == len(data)) or (not data.index.equals(expected)):
+            raise MeasurementDimensionError
+        
+        self.meas_res = np.empty((len(parameters), nr_obs, nr_per))
         self.fac_coeff = []
         self.variances = []
         controls = np.array(data.loc[:,['control', 'control_2']])
@@ -60,30 +97,66 @@ class Measurement:
             meas = np.array(data['meas'+eq_nr])
             #Generate residuals of measurements given controls.
             resid = meas - np.matmul(controls, betas)
-            self.meas_res.append(
-                                    pd.DataFrame(
-                                                    data = resid,
-                                                    index = data.index,
-                                                    columns = ['res'+eq_nr]
-                                                )
-                                 )
+            self.meas_res[i, ...] = resid.reshape((nr_obs, nr_per))
         
             #Store coefficients and variances in lists.
             self.fac_coeff.append(param_dic['z'])
             self.variances.append(param_dic['var'])
+        
+        self.collapse = collapse
+        self._collapse_equations()
+    
+    def _collapse_equations(self):
+        """Precompute the collapsed Gaussian of all measurement equations:
+        
+            sum_k log N(res_k - z_k*f; var_k)
+                = log_const - precision/2*(f - mean)^2,
+        
+        with precision = sum_k z_k^2/var_k,
+        mean = sum_k z_k*res_k/var_k / precision and
+        log_const = sum_k log N(res_k; var_k) + precision/2*mean^2.
+        
+        """
+        
+        self.precision = 0
+        weighted_res = np.zeros(self.meas_res.shape[1:])
+        log_const = np.zeros(self.meas_res.shape[1:])
+        for res, z, var in zip(self.meas_res, self.fac_coeff, self.variances):
+            self.precision += z*z/var
+            weighted_res += z*res/var
+            log_const += self._log_density(res, var)
+        self.collapsed_mean = weighted_res / self.precision
+        log_const += .5*self.precision*np.square(self.collapsed_mean)
+        self.collapsed_log_const = log_const
+    
+    def _period_index(self, factors, period):
+        """Return the position of *period* along the last axis of the
+        residual arrays, after checking that *factors* has one row per
+        observation.
+        
+        """
+        
+        pos = np.searchsorted(self.periods, period)
+        if (
+                factors.shape[0] != len(self.caseids) or
+                len(self.periods) == pos or
+                self.periods[pos] != period
+            ):
+            raise MeasurementDimensionError
+        return pos
     
-    def _density(self, x, var):
-        """Return value of density evaluated at x.
+    def _log_density(self, x, var):
+        """Return value of log-density evaluated at x.
         
         Args:
             + *x* (np.ndarray): matrix of values
             + *var* (scalar): variance of normal density
         
         Returns:
-            + np.ndarray of normal densities at x
+            + np.ndarray of normal log-densities at x
         """
         
-        return norm.pdf(x, scale = np.sqrt(var))
+        return -.5*(np.log(2*np.pi*var) + x*x/var)
     
     def marginal_probability(self, factors, period):
         """Returns marginal (since density-values are returned) probability of
@@ -103,20 +176,60 @@ class Measurement:
                 
         """
         
-        nr_obs, nr_facs = factors.shape
-        marginals = np.ones((nr_obs, nr_facs))
-        # Calculate densities for each measurement equation.
+        return np.exp(self.log_marginal_probability(factors, period))
+    
+    def log_marginal_probability(self, factors, period):
+        """Returns the logarithm of the marginal probability of factors, given
+        measurements, for one period. The log-densities of all measurement
+        equations are added up, so that no product of small densities is
+        formed.
+        
+        Args:
+            + *factors* (np.ndarray):
+                Array with shape NxM, where N is number of observations and M 
+                is number of factors per period and observation.
+            + *period* (integer): 
+                number of period, starting at 1
+            
+        Returns:
+            + log marginal probabilities (np.ndarray):
+                Array with shape NxM, filled with log-density-values of the
+                factors at the according indices.
+                
+        """
+        
+        if self.collapse:
+            return self._log_marginal_collapsed(factors, period)
+        return self._log_marginal_per_equation(factors, period)
+    
+    def _log_marginal_collapsed(self, factors, period):
+        """Evaluate the collapsed Gaussian (see *_collapse_equations*) at
+        *factors*; arguments as in *log_marginal_probability*.
+        
+        """
+        
+        pos = self._period_index(factors, period)
+        log_marginals = factors - self.collapsed_mean[:, pos, np.newaxis]
+        np.square(log_marginals, out = log_marginals)
+        log_marginals *= -.5*self.precision
+        log_marginals += self.collapsed_log_const[:, pos, np.newaxis]
+        return log_marginals
+    
+    def _log_marginal_per_equation(self, factors, period):
+        """Add up the log-densities of the measurement equations one by one;
+        arguments as in *log_marginal_probability*.
+        
+        """
+        
+        pos = self._period_index(factors, period)
+        log_marginals = np.zeros(factors.shape)
+        # Add log-densities of each measurement equation.
         for i, var in enumerate(self.variances):
-            meas = self.meas_res[i].xs(period, level = 1)
-            if (meas.empty) or (nr_obs != meas.shape[0]):
-                raise MeasurementDimensionError
-            x = (
-                    np.repeat(meas.values, nr_facs, axis = 1)
-                        - self.fac_coeff[i]*factors
-                )
-            marginals *= self._density(x, var)
-        
-        return marginals
+            meas = self.meas_res[i, :, pos, np.newaxis]
+            x = meas - self.fac_coeff[i]*factors
+            log_marginals += self._log_density(x, var)
+        
+        return log_marginals
             
             
         
@@ -0,0 +1,371 @@
+"""Monte Carlo study of the particle smoother: simulate the data, smooth it
+for each prior specification and summarize the bias and RMSE of the
+estimates, in R independent replications.
+
+Each replication runs in a worker process and keeps all intermediate data in
+memory: the data are simulated with *simulate_data.simulate_frames*, the
+random prior is drawn with *initial_draws.PriorSampler*, the transition
+errors are generated on the fly (see *random_streams.CounterTransitionErrors*)
+and the estimates are summarized with *summary_stats*. Only the per-period
+bias and RMSE tables are sent back, where they are folded into running means
+and variances (see *RunningMoments*), in the order of the replications.
+For small numbers of observations, batches of replications can be smoothed
+in one vectorized pass (see *replicate_batch*).
+
+Replication r uses the random seed spawned from 'rnd_seed' in
+:file:`smoother.json` with spawn key (3, r) for all of its randomness, so
+every replication can be reproduced on its own, and the study does not depend
+on the number of worker processes.
+
+"""
+
+import argparse
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+from bld.project_paths import project_paths_join as ppj
+from src.analysis.particle_smoother import chunked_particle_smoother
+from src.analysis.particle_smoother import replicated_particle_smoother
+from src.analysis.initial_draws import PriorSampler, cov_matrix, _true_prior
+from src.analysis.random_streams import CounterTransitionErrors
+from src.analysis.random_streams import StackedGenerator, shard_generator
+from src.analysis.random_streams import shard_bounds, shard_seeds
+from src.data_management.simulate_data import simulate_frames
+from src.final.summary_stats import summary_stats
+
+F_NR = ['fac1', 'fac2', 'fac3']
+SPECS = ['rnd_prior', 'deg_prior']
+STATISTICS = ['bias', 'rmse']
+# First entry of the spawn key of the replication seeds.
+_REPLICATION_STREAM = 3
+
+
+def replication_seed(seed, replication):
+    """Return the random seed (integer) of replication number
+    *replication* (**starts at 0**), spawned from *seed*.
+
+    """
+
+    seed_seq = np.random.SeedSequence(
+                                seed,
+                                spawn_key = (_REPLICATION_STREAM, replication)
+                                     )
+    return int(seed_seq.generate_state(1)[0])
+
+
+class RunningMoments:
+    """Mean and variance of a stream of equally shaped arrays, updated one
+    array at a time with Welford's algorithm, such that the arrays need not
+    be kept.
+
+    Instance variables:
+        + *count* (integer): Number of arrays so far.
+        + *mean* (np.ndarray): Elementwise mean.
+
+    Public methods:
+        + update
+        + variance
+        + standard_error
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._sum_squares = None
+
+    def update(self, values):
+        """Add the array *values* to the stream."""
+
+        values = np.asarray(values, dtype = float)
+        if self.mean is None:
+            self.mean = np.zeros_like(values)
+            self._sum_squares = np.zeros_like(values)
+        self.count += 1
+        delta = values - self.mean
+        self.mean += delta/self.count
+        self._sum_squares += delta*(values - self.mean)
+
+    def variance(self):
+        """Return the elementwise sample variance (ddof 1, NaN for less than
+        two arrays).
+
+        """
+
+        if self.count < 2:
+            return np.full_like(self.mean, np.nan)
+        return self._sum_squares/(self.count - 1)
+
+    def standard_error(self):
+        """Return the elementwise Monte Carlo standard error of the mean."""
+
+        return np.sqrt(self.variance()/self.count)
+
+
+def _replication_inputs(replication, fixed, meas_params, trans_params, prior):
+    """Simulate the data of replication number *replication* and set up its
+    priors and transition errors.
+
+    Returns:
+        + params (dictionary): *fixed* with the seed of the replication.
+        + measurement data (list of pd.DataFrame), true factors
+          (pd.DataFrame): See *simulate_data.simulate_frames*.
+        + priors (dictionary): Prior (sampler) by specification.
+        + transition errors (CounterTransitionErrors)
+
+    """
+
+    params = dict(
+                    fixed,
+                    rnd_seed = replication_seed(fixed["rnd_seed"], replication)
+                 )
+    meas_data, true_facs = simulate_frames(
+                                            params, meas_params, trans_params,
+                                            prior
+                                          )
+    trans_errors = CounterTransitionErrors(
+                                params["rnd_seed"],
+                                (2, params["obs"], params["period"],
+                                 params["n_particles"])
+                                          )
+    priors = {
+                'rnd_prior': PriorSampler(
+                                            cov_matrix(prior),
+                                            prior[2]["var_p"], params
+                                         ),
+                'deg_prior': _true_prior(true_facs)
+             }
+    return params, meas_data, true_facs, priors, trans_errors
+
+
+def replicate(replication, fixed, meas_params, trans_params, prior,
+              specs=SPECS):
+    """Run one replication of the study.
+
+    Args:
+        + *replication* (integer): Number of the replication.
+        + *fixed* (dictionary):
+            Contents of smoother.json. 'rnd_seed' is the seed of the study;
+            'chunk_size' (if positive) bounds the observations smoothed at
+            once.
+        + *meas_params*, *trans_params*, *prior* (list of dictionaries):
+            Contents of measurements.json, transitions.json and
+            true_prior.json.
+        + *specs* (list of strings): Prior specifications to estimate.
+
+    Returns:
+        + tables (dictionary):
+            PxF arrays of the bias and the RMSE per period and factor type
+            (see *summary_stats*), keyed by (spec, statistic).
+
+    """
+
+    params, meas_data, true_facs, priors, trans_errors = _replication_inputs(
+                                    replication, fixed, meas_params,
+                                    trans_params, prior
+                                                                            )
+    tables = {}
+    for spec in specs:
+        estimates = chunked_particle_smoother(
+                                    params, meas_params, trans_params,
+                                    priors[spec], trans_errors,
+                                    params.get("chunk_size", 0)
+                                    or params["obs"],
+                                    meas_data, seed = params["rnd_seed"]
+                                             )
+        for stat, table in zip(
+                                STATISTICS,
+                                summary_stats(estimates, true_facs)
+                              ):
+            tables[(spec, stat)] = table.values
+    return tables
+
+
+def _batch_generator(batch_params):
+    """Return the random generator for the resampling of a batch of
+    replications (see *replicate_batch*), with the parameters
+    *batch_params* (list of dictionaries, see *_replication_inputs*). The
+    observations of each replication are drawn from the streams that
+    *chunked_particle_smoother* spawns from the seed of the replication,
+    one per block of 'chunk_size' observations.
+
+    """
+
+    generators, sizes = [], []
+    for params in batch_params:
+        bounds = shard_bounds(
+                                params["obs"],
+                                params.get("chunk_size", 0) or params["obs"]
+                             )
+        for (start, stop), seq in zip(
+                                    bounds,
+                                    shard_seeds(params["rnd_seed"], len(bounds))
+                                     ):
+            generators.append(shard_generator(seq))
+            sizes.append(stop - start)
+    return StackedGenerator(generators, sizes)
+
+
+def replicate_batch(replications, fixed, meas_params, trans_params, prior,
+                    specs=SPECS):
+    """Run the replications in *replications* (range of numbers) as one
+    batch, which is smoothed by *replicated_particle_smoother* in one
+    vectorized pass per specification. The data, priors and transition
+    errors are those of *replicate*, and each replication resamples from its
+    own streams (see *_batch_generator*), so the results equal those of
+    *replicate* and do not depend on the batch size.
+
+    Returns:
+        + tables (list of dictionaries): See *replicate*, per replication.
+
+    """
+
+    inputs = [
+                _replication_inputs(
+                                    r, fixed, meas_params, trans_params, prior
+                                   )
+                for r in replications
+             ]
+    meas_data = [rep_inputs[1] for rep_inputs in inputs]
+    trans_errors = np.stack([
+                    np.stack(
+                                [
+                                    rep_inputs[4].period(per)
+                                    for per in range(fixed["period"])
+                                ],
+                                axis = 2
+                            )
+                    for rep_inputs in inputs
+                            ])
+    tables = [{} for r in replications]
+    for spec in specs:
+        priors = np.stack([
+                    rep_inputs[3][spec]
+                    if isinstance(rep_inputs[3][spec], np.ndarray)
+                    else rep_inputs[3][spec].sample()
+                    for rep_inputs in inputs
+                          ])
+        estimates = replicated_particle_smoother(
+                    inputs[0][0], meas_params, trans_params, priors,
+                    trans_errors, meas_data,
+                    _batch_generator([rep_inputs[0] for rep_inputs in inputs])
+                                                )
+        for r, rep_inputs in enumerate(inputs):
+            for stat, table in zip(
+                                    STATISTICS,
+                                    summary_stats(
+                                                    estimates.loc[r],
+                                                    rep_inputs[2]
+                                                 )
+                                  ):
+                tables[r][(spec, stat)] = table.values
+    return tables
+
+
+def _replicate_each(replications, *args):
+    """Run the replications in *replications* one by one (see
+    *replicate*).
+
+    """
+
+    return [replicate(r, *args) for r in replications]
+
+
+def monte_carlo(fixed, meas_params, trans_params, prior, replications,
+                workers=1, specs=SPECS, batch=1):
+    """Run *replications* replications of the study in *workers* processes
+    (in the calling process if *workers* is 0). Each task is a batch of
+    *batch* replications; batches of more than one replication are smoothed
+    in one vectorized pass (see *replicate_batch*), which pays off for
+    small numbers of observations.
+
+    Returns:
+        + moments (dictionary):
+            *RunningMoments* over the replications, keyed by (spec,
+            statistic) as the tables of *replicate*.
+
+    """
+
+    moments = {
+                (spec, stat): RunningMoments()
+                for spec in specs for stat in STATISTICS
+              }
+    batches = [
+                range(start, min(start+batch, replications))
+                for start in range(0, replications, batch)
+              ]
+    task = replicate_batch if batch > 1 else _replicate_each
+    args = (fixed, meas_params, trans_params, prior, specs)
+    if workers > 0:
+        executor = ProcessPoolExecutor(max_workers = workers)
+        results = executor.map(
+                                task, batches,
+                                *[repeat(arg) for arg in args]
+                              )
+    else:
+        executor = None
+        results = (task(replications, *args) for replications in batches)
+    try:
+        for batch_tables in results:
+            for tables in batch_tables:
+                for key, table in tables.items():
+                    moments[key].update(table)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return moments
+
+
+def moments_table(moments, nr_per):
+    """Arrange the mean and Monte Carlo standard error of one entry of
+    *monte_carlo* as DataFrame with the periods as index and columns
+    (factor, 'mean' or 'se').
+
+    """
+
+    values = np.stack([moments.mean, moments.standard_error()], axis = 2)
+    return pd.DataFrame(
+                        values.reshape(nr_per, -1),
+                        index = pd.RangeIndex(1, nr_per+1, name = 't'),
+                        columns = pd.MultiIndex.from_product(
+                                                [F_NR, ['mean', 'se']]
+                                                            )
+                       )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+                        "--replications", type = int, default = 100,
+                        help = "number of replications"
+                       )
+    parser.add_argument(
+                        "--batch", type = int, default = 1,
+                        help = "number of replications smoothed at once"
+                       )
+    parser.add_argument(
+                        "--workers", type = int, default = 1,
+                        help = "number of worker processes (0 runs the "
+                               "replications in this process)"
+                       )
+    args = parser.parse_args()
+    fixed, meas_params, trans_params, prior = [
+                json.load(open(
+                                ppj("IN_MODEL_SPECS", name+".json"),
+                                encoding = "utf-8"
+                              ))
+                for name in ['smoother', 'measurements', 'transitions',
+                             'true_prior']
+                                              ]
+    moments = monte_carlo(
+                            fixed, meas_params, trans_params, prior,
+                            args.replications, args.workers,
+                            batch = args.batch
+                         )
+    for (spec, stat), entry in moments.items():
+        moments_table(entry, fixed["period"]).to_csv(
+                        ppj('OUT_TABLES', '{}_mc_{}.csv'.format(spec, stat))
+                                                    )
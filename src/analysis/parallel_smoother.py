@@ -0,0 +1,276 @@
+"""Run the particle smoother in parallel worker processes, one shard of
+observations at a time.
+
+The observations are split into shards of a fixed size (the 'chunk_size' in
+:file:`smoother.json`). The measurement data, the prior and the transition
+errors are copied once into shared memory, from which every worker reads only
+the rows of the shard it processes, so that nothing big is pickled to the
+workers. Memory-mapped inputs (see *artifacts.load_array*) are not copied
+either, each worker maps the file itself. Inputs that are generated on the
+fly (transition errors, see *random_streams.CounterTransitionErrors*, and
+random priors, see *initial_draws.PriorSampler*) are not shared, each worker
+generates the part of its shard itself, and measurement data that is stored
+in shards (see *prepare_data.MeasurementManifest*) is loaded by the workers.
+Each shard resamples with its own random stream, spawned from the random seed
+with *np.random.SeedSequence.spawn*, which makes the estimates bit-identical
+for any number of workers (and identical to the serial
+*chunked_particle_smoother* with the same seed).
+
+"""
+
+import mmap
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from src.analysis.particle_smoother import particle_smoother
+from src.analysis.particle_smoother import _load_measurement_data
+from src.analysis.particle_smoother import _observation_errors
+from src.analysis.particle_smoother import _observation_prior
+from src.analysis.random_streams import shard_bounds, shard_seeds
+from src.analysis.random_streams import shard_generator
+
+# Shard size if 'chunk_size' in smoother.json is not set. The shards must
+# not depend on the number of workers, so that results do not either.
+DEFAULT_SHARD_SIZE = 500
+
+F_NR = ['fac1', 'fac2', 'fac3']
+MEAS_COLUMNS = ['control', 'control_2', 'meas1', 'meas2', 'meas3']
+
+
+class SharedArrays:
+    """Copy named arrays into blocks of shared memory that worker processes
+    attach to by name (see *attach_shared_arrays*).
+
+    Instance variables:
+        + *specs* (dictionary):
+            For each array name, the name of its shared memory block, its
+            shape and its dtype. Is small and cheap to send to workers.
+
+    Public methods:
+        + close
+
+    """
+
+    def __init__(self, arrays):
+        """Allocate one shared memory block per array and copy the array.
+
+        Args:
+            + *arrays* (dictionary): np.ndarrays by name.
+
+        """
+
+        self._blocks = []
+        self.specs = {}
+        for key, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            block = shared_memory.SharedMemory(
+                                                create = True,
+                                                size = max(arr.nbytes, 1)
+                                              )
+            shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=block.buf)
+            shared[...] = arr
+            self._blocks.append(block)
+            self.specs[key] = (block.name, arr.shape, arr.dtype.str)
+
+    def close(self):
+        """Release and remove all shared memory blocks."""
+
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+def attach_shared_arrays(specs):
+    """Attach to the shared memory blocks described by *specs* (see
+    *SharedArrays*).
+
+    Returns:
+        + arrays (dictionary): np.ndarrays (backed by shared memory) by name.
+        + blocks (list): The attached blocks; they have to be kept alive as
+          long as the arrays are used and closed afterwards.
+
+    """
+
+    arrays = {}
+    blocks = []
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name = name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return arrays, blocks
+
+
+def _is_mapped_file(value):
+    """Whether *value* is the complete array of a memory-mapped .npy file
+    (and not a view of it).
+
+    """
+
+    return isinstance(value, np.memmap) and isinstance(value.base, mmap.mmap)
+
+
+def _passed_to_workers(value):
+    """Whether an input is sent to the workers directly (as small generator,
+    or as file name of a memory-mapped array) instead of shared memory.
+
+    """
+
+    return _is_mapped_file(value) or not isinstance(value, np.ndarray)
+
+
+def _worker_input(value):
+    """Return the representation of an input sent to the workers."""
+
+    if _is_mapped_file(value):
+        return value.filename
+    return value
+
+
+def _shared_inputs(meas_data, prior, trans_errors):
+    """Collect the inputs of the smoother as plain arrays. The measurement
+    data of each factor type is sorted by (caseid, period) and split into the
+    index levels and the values (unless it is stored in shards). Prior and
+    transition errors are only included if they are arrays in memory (and
+    neither generated on the fly nor memory-mapped).
+
+    """
+
+    arrays = {
+                key: value
+                for key, value in [('prior', prior),
+                                   ('trans_errors', trans_errors)]
+                if not _passed_to_workers(value)
+             }
+    if not isinstance(meas_data, list):
+        return arrays
+    for i, data in enumerate(meas_data):
+        data = data.sort_index()
+        arrays['caseid_{}'.format(i)] = data.index.get_level_values(0).values
+        arrays['period_{}'.format(i)] = data.index.get_level_values(1).values
+        arrays['meas_{}'.format(i)] = data.loc[:, MEAS_COLUMNS].values
+    return arrays
+
+
+def _shard_measurements(arrays, caseids):
+    """Rebuild the measurement data of the observations with *caseids* (a
+    consecutive range of sorted caseids) from the shared arrays.
+
+    """
+
+    meas_data = []
+    for i in range(len(F_NR)):
+        ids = arrays['caseid_{}'.format(i)]
+        rows = slice(*np.searchsorted(ids, [caseids[0], caseids[-1]+1]))
+        meas_data.append(pd.DataFrame(
+                        data = arrays['meas_{}'.format(i)][rows].copy(),
+                        index = pd.MultiIndex.from_arrays([
+                                            ids[rows],
+                                            arrays['period_{}'.format(i)][rows]
+                                                          ]),
+                        columns = MEAS_COLUMNS
+                                     ))
+    return meas_data
+
+
+def _smooth_shard(specs, caseids, start, stop, seed_seq, params, meas_params,
+                  trans_params, generated):
+    """Smooth the observations at positions *start* to *stop* (with caseids
+    *caseids*) in a worker process, reading all data from shared memory,
+    except for the inputs in *generated* (dictionary), which are generated
+    on the fly, memory-mapped from the given file, or loaded from the shards
+    of the measurement data.
+
+    """
+
+    arrays, blocks = attach_shared_arrays(specs)
+    inputs = dict(arrays)
+    for key, value in generated.items():
+        if isinstance(value, str):
+            value = np.load(value, mmap_mode = 'r')
+        inputs[key] = value
+    if 'meas_data' in inputs:
+        meas_data = inputs['meas_data'].load(start, stop)
+    else:
+        meas_data = _shard_measurements(arrays, caseids)
+    try:
+        estimates = particle_smoother(
+                            params, meas_params, trans_params,
+                            _observation_prior(inputs['prior'], start, stop),
+                            _observation_errors(
+                                                inputs['trans_errors'],
+                                                start, stop
+                                               ),
+                            meas_data, shard_generator(seed_seq)
+                                     )
+    finally:
+        # Views into the blocks must be gone before the blocks are closed.
+        del arrays, inputs
+        for block in blocks:
+            block.close()
+    return estimates
+
+
+def parallel_particle_smoother(
+                                params, meas_params, trans_params, prior,
+                                trans_errors, workers, meas_data=None
+                              ):
+    """Estimate the factors with *particle_smoother*, distributing shards of
+    observations over *workers* processes.
+
+    Args:
+        + *params* (dictionary):
+            See *particle_smoother*. The shard size is taken from the entry
+            'chunk_size' (*DEFAULT_SHARD_SIZE* if missing or 0), the random
+            streams of the shards are spawned from 'rnd_seed'.
+        + *meas_params*, *trans_params*, *prior*, *trans_errors*:
+            See *chunked_particle_smoother*.
+        + *workers* (integer): Number of worker processes.
+        + *meas_data* (list of pd.DataFrame or MeasurementManifest):
+            See *chunked_particle_smoother*.
+
+    Returns:
+        + estimates of factors (pd.DataFrame): See *particle_smoother*.
+
+    """
+
+    if meas_data is None:
+        meas_data = _load_measurement_data(F_NR)
+    if isinstance(meas_data, list):
+        caseids = np.sort(meas_data[0].index.unique(level = 0).values)
+        nr_obs = len(caseids)
+    else:
+        caseids = None
+        nr_obs = meas_data.nr_obs
+    shard_size = params.get("chunk_size", 0) or DEFAULT_SHARD_SIZE
+    bounds = shard_bounds(nr_obs, shard_size)
+    seeds = shard_seeds(params["rnd_seed"], len(bounds))
+    shared = SharedArrays(_shared_inputs(meas_data, prior, trans_errors))
+    # Generators of inputs and names of mapped files are sent to the workers.
+    generated = {
+                    key: _worker_input(value)
+                    for key, value in [('prior', prior),
+                                       ('trans_errors', trans_errors)]
+                    if _passed_to_workers(value)
+                }
+    if not isinstance(meas_data, list):
+        generated['meas_data'] = meas_data
+    try:
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            futures = [
+                        executor.submit(
+                                        _smooth_shard, shared.specs,
+                                        None if caseids is None
+                                        else caseids[start:stop],
+                                        start, stop, seq,
+                                        params, meas_params, trans_params,
+                                        generated
+                                       )
+                        for (start, stop), seq in zip(bounds, seeds)
+                      ]
+            estimates = [future.result() for future in futures]
+    finally:
+        shared.close()
+    return pd.concat(estimates)
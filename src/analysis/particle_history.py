@@ -0,0 +1,238 @@
+"""ParticleHistory class: genealogy of the particles of the forward pass.
+ConstantFactors class: distinct values of the constant factor types.
+"""
+
+import numpy as np
+from src.analysis.resampling import UniqueAncestors
+
+
+def _row_codes(keys):
+    """Number the distinct values in each row of the NxM array *keys*.
+
+    Returns:
+        + codes (np.ndarray):
+            NxM array with the rank of each value among the distinct values
+            of its row.
+        + first (np.ndarray):
+            NxK array (K the largest number of distinct values in a row) with
+            the position of one entry of each distinct value (0 for ranks
+            that a row does not have).
+
+    """
+
+    order = np.argsort(keys, axis = 1, kind = 'stable')
+    ordered = np.take_along_axis(keys, order, 1)
+    new = np.ones(keys.shape, dtype = bool)
+    new[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ranks = np.cumsum(new, axis = 1) - 1
+    codes = np.empty_like(ranks)
+    np.put_along_axis(codes, order, ranks, 1)
+    first = np.zeros((keys.shape[0], ranks[:, -1].max() + 1), dtype = int)
+    np.put_along_axis(first, ranks, order, 1)
+    return codes, first
+
+
+class ConstantFactors:
+    """The constant factor types of the particles, stored as the K distinct
+    value combinations per observation and an index map from the particles
+    to them. A prior that combines *draws_varying* draws of the non-constant
+    factor types with *draws_constant* draws of the constant ones (see
+    *initial_draws.PriorSampler*) has at most *draws_constant* distinct
+    values per observation, so work on the constant factor types can be done
+    once per distinct value and broadcast to the particles.
+
+    Instance variables:
+        + *values* (np.ndarray):
+            CxNxK array of the distinct values of the C constant factor
+            types per observation.
+        + *codes* (np.ndarray):
+            NxM array, particle m of observation n has the constant factors
+            values[:, n, codes[n, m]].
+
+    Public methods:
+        + from_particles
+        + broadcast
+        + select
+
+    """
+
+    def __init__(self, values, codes):
+        self.values = values
+        self.codes = codes
+
+    @classmethod
+    def from_particles(cls, particles, const, nr_parts=None):
+        """Find the distinct values of the constant factor types *const* in
+        the 3xNxM array *particles*. A degenerate 3xNx1 array can be
+        broadcast to *nr_parts* particles.
+
+        """
+
+        keys = particles[const, ...]
+        codes = np.zeros(keys.shape[1:], dtype = int)
+        for key in keys:
+            key_codes, first = _row_codes(key)
+            codes = codes*first.shape[1] + key_codes
+        codes, first = _row_codes(codes)
+        rows = np.arange(keys.shape[1])[:, np.newaxis]
+        if nr_parts is not None:
+            codes = np.broadcast_to(codes, (keys.shape[1], nr_parts))
+        return cls(keys[:, rows, first], codes)
+
+    def broadcast(self, unique):
+        """Return the NxM array of the particles from the NxK array *unique*
+        (e.g. a probability per distinct value).
+
+        """
+
+        return np.take_along_axis(unique, self.codes, 1)
+
+    def select(self, lineage):
+        """Return the constant factors of the particles whose (NxM) indices
+        among the particles of this object are *lineage*.
+
+        """
+
+        return ConstantFactors(
+                                self.values,
+                                np.take_along_axis(self.codes, lineage, 1)
+                              )
+
+
+class ParticleHistory:
+    """Store the particles of the forward iteration of the particle smoother
+    as genealogy instead of full copies of the resampled particles: for each
+    period, the ancestor indices drawn by the resampling step, the states of
+    the non-constant factor types of the particles that were drawn at least
+    once (the distinct ancestors, see *resampling.UniqueAncestors*), and the
+    codes of the constant factor types of the resampled particles (see
+    *ConstantFactors*; indices and codes as the smallest unsigned integer
+    type that holds them). Constant factor types are never copied, and the
+    codes are carried forward through the ancestor indices when a period is
+    appended, so reconstructing the resampled particles of any period (in
+    the backward iteration) takes one pass per array, whatever the number of
+    periods.
+
+    With H non-constant factor types, up to 256 particles and a share u of
+    distinct ancestors, a particle and period take 8Hu + 2 bytes instead of
+    24 for a full copy (for multinomial resampling, u is about 0.63 with
+    equal weights and smaller the more the weights differ). With the
+    simulated data (H = 2, 100 particles, 'rnd_prior'), u is 0.40 and the
+    history takes 8.4 bytes per particle and period, 65% less than the
+    copies. The distinct states are floats that the backward iteration
+    evaluates in full precision, so they are not compressed further.
+
+    Instance variables:
+        + *prior* (np.ndarray):
+            3xNxM array of particles that the forward iteration starts from
+            (may be a read-only broadcast view, e.g. of a degenerate prior).
+        + *factor_setting* (list of binaries):
+            See *Transition*, '0' marks a constant factor type.
+
+    Public methods:
+        + append
+        + particles
+
+    """
+
+    def __init__(self, prior, factor_setting, constants=None):
+        """Start the history with the prior.
+
+        Args:
+            + *prior* (np.ndarray):
+                3xNxM array of particles (period 0 of the history).
+            + *factor_setting* (list of binaries (0 or 1)):
+                Setting of constant ('0') and non-constant ('1') factor types.
+            + *constants* (ConstantFactors):
+                Constant factor types of *prior*, found in *prior* if not
+                given.
+
+        Created class attributes:
+            + *states* (list of np.ndarray):
+                HxU arrays of the states of the H non-constant factor types
+                of the U distinct ancestors, per period.
+            + *ancestors* (list of np.ndarray):
+                NxM arrays of ancestor indices, per period.
+            + *codes* (list of np.ndarray):
+                NxM arrays of the codes of the constant factor types of the
+                resampled particles, per period (the first is the prior).
+
+        """
+
+        self.prior = prior
+        self.factor_setting = factor_setting
+        self._nonconst = np.nonzero(factor_setting)[0]
+        self._const = np.nonzero(0 == np.array(factor_setting))[0]
+        if constants is None:
+            constants = ConstantFactors.from_particles(prior, self._const)
+        self.constants = constants
+        self.states = []
+        self.ancestors = []
+        self.codes = [constants.codes]
+        self._index_type = np.min_scalar_type(prior.shape[2] - 1)
+        self._code_type = np.min_scalar_type(constants.values.shape[2] - 1)
+
+    def __len__(self):
+        """Number of periods in the history, including the prior."""
+
+        return len(self.ancestors) + 1
+
+    def append(self, state, ancestors, unique=None):
+        """Add one period to the history.
+
+        Args:
+            + *state* (np.ndarray):
+                3xNxM array of particles before resampling.
+            + *ancestors* (np.ndarray):
+                NxM array of ancestor indices drawn from *state*.
+            + *unique* (UniqueAncestors):
+                The distinct *ancestors*, found if not given.
+
+        """
+
+        if unique is None:
+            unique = UniqueAncestors(ancestors)
+        self.states.append(unique.compress(state[self._nonconst, ...]))
+        self.ancestors.append(ancestors.astype(self._index_type))
+        self.codes.append(np.take_along_axis(
+                                            self.codes[-1], ancestors, 1
+                                            ).astype(self._code_type))
+
+    def particles(self, per, with_constants=False):
+        """Reconstruct the resampled particles of period *per*.
+
+        Args:
+            + *per* (integer):
+                Period of the history, where 0 is the prior.
+            + *with_constants* (boolean):
+                Also return the constant factor types of the particles as
+                *ConstantFactors*.
+
+        Returns:
+            + particles (np.ndarray): 3xNxM array.
+            + constants (ConstantFactors): If *with_constants*.
+
+        """
+
+        if 0 == per:
+            particles, constants = self.prior, self.constants
+        else:
+            ancestors = self.ancestors[per-1]
+            particles = np.empty(
+                            (len(self.factor_setting),) + ancestors.shape
+                                )
+            # The distinct ancestors are found in the same order as when
+            # their states were stored.
+            unique = UniqueAncestors(ancestors)
+            particles[self._nonconst, ...] = unique.expand(self.states[per-1])
+            constants = ConstantFactors(self.constants.values, self.codes[per])
+            if len(self._const) > 0:
+                # Index the distinct values in one step, such that the
+                # constant factor types of the prior are never copied.
+                rows = np.arange(ancestors.shape[0])[:, np.newaxis]
+                particles[self._const, ...] = constants.values[
+                                                    :, rows, constants.codes
+                                                              ]
+        if with_constants:
+            return particles, constants
+        return particles
@@ -1,14 +1,22 @@
 """Implementation of bootstrap backward-simulation particle smoother for
 three-factor (nonlinear) state-space system. The smoother calculates its
 estimate of the underlying states (factors) for all provided observations at
-once.
+once, or (since observations are independent) in chunks of observations,
+such that peak memory depends on the chunk size instead of the number of
+observations (see *chunked_particle_smoother*).
+
+The measurement and transition equations can be set up once and shared by
+several prior specifications (see *SmootherModel* and *smooth_specs*); run
+as a script, the smoother accepts several specifications and smoothes them
+in one process.
 
 """
 
 import numpy as np
 import pandas as pd
+import argparse
 import json
-import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # =============================================================================
 # import os
@@ -20,11 +28,19 @@ import sys
 from bld.project_paths import project_paths_join as ppj
 from src.analysis.measurement import Measurement
 from src.analysis.transition import Transition
-from numpy.random import multinomial
+from src.analysis.particle_history import ParticleHistory, ConstantFactors
+from src.analysis.resampling import resample_log, log_normalize, draw_log
+from src.analysis.resampling import gather_particles, UniqueAncestors
+from src.analysis.random_streams import shard_bounds, shard_seeds
+from src.analysis.random_streams import shard_generator
+from src.analysis.random_streams import CounterTransitionErrors
+from src.analysis.artifacts import load_frame, load_array, save_frame
+from src.analysis.artifacts import spec_hash
 
 def _construct_new_particles(samples, old_particles):
     """Construct new array of particles given the drawing results over the old
-    particles.
+    particles. Reference implementation of the (vectorized) gather in
+    *resampling.gather_particles*, kept for equivalence tests.
     
     Args:
         + *samples* (np.ndarray):
@@ -62,52 +78,118 @@ def _construct_new_particles(samples, old_particles):
     return ret_arr
 
 
-def _find_most_probable_part(weights, parts):
-    """ Find the most probable particle using their weights.
+def _draw_part(weights, parts, rng=np.random):
+    """ Draw the particle that continues the trajectory of each observation,
+    with probabilities proportional to the exponentials of their weights.
     
     Args:
         + *weights* (np.ndarray):
-            NxM array containing normalized probability of observing a particle
+            NxM array containing (log-)probability of observing a particle
             for each particle.
         + *parts* (np.ndarray):
             3xNxM array of particles with observations and factors.
+        + *rng* (np.random.Generator or module np.random):
+            Source of randomness.
     
     Returns: 
-        + most_prob_parts (np.ndarray):
-            3xN array containing most probable particle for each observation.
+        + drawn_parts (np.ndarray):
+            3xN array containing the drawn particle for each observation.
         
     """
     
-    index_part = np.argmax(weights, axis=1)
-    most_prob_part = np.empty(parts.shape[0:2])
-    for i, index in enumerate(index_part):
-        most_prob_part[:, i] = parts[:, i, index]
-        
-    return most_prob_part    
+    index_part = draw_log(weights, rng)
+    return np.take_along_axis(
+                                parts, index_part[np.newaxis, :, np.newaxis],
+                                axis = 2
+                             )[..., 0]
+    
+    
+def _period_errors(trans_errors, per):
+    """Return the HxNxM transition errors of period *per* (**starts at 0**),
+    from the stored array or generated by a *CounterTransitionErrors*.
+    
+    """
+    
+    if isinstance(trans_errors, np.ndarray):
+        return trans_errors[:, :, per, :]
+    return trans_errors.period(per)
+
+
+def _observation_errors(trans_errors, start, stop):
+    """Restrict the transition errors to the observations at positions
+    *start* to *stop*.
+    
+    """
+    
+    if isinstance(trans_errors, np.ndarray):
+        return trans_errors[:, start:stop, ...]
+    return trans_errors.observations(start, stop)
+
+
+def _observation_prior(prior, start, stop):
+    """Return the 3xKxM prior particles of the observations at positions
+    *start* to *stop*, from the stored array or drawn by a
+    *initial_draws.PriorSampler*.
+    
+    """
+    
+    if isinstance(prior, np.ndarray):
+        return prior[:, start:stop, ...]
+    return prior.draw(start, stop)
+
+
+def _load_measurement_data(f_nr):
+    """Load the measurement data (DataFrame with MultiIndex (caseid, period))
+    of each factor type in *f_nr*.
     
+    """
     
-def particle_smoother(params, meas_params, trans_params, prior, trans_errors):
+    return [load_frame(ppj("OUT_ANALYSIS", 'meas_'+fac)) for fac in f_nr]
+
+
+def particle_smoother(
+                        params, meas_params, trans_params, prior, trans_errors,
+                        meas_data=None, rng=np.random
+                     ):
     """Estimate unobserved states of (nonlinear) state-space system for many
     observations, using the (bootstrap) backward-simulation particle smoother.
     
     Args:
         + *params* (dictionary):
-            Contains basic properties of the estimation.
+            Contains basic properties of the estimation. The optional entry
+            'resampling' names the resampling scheme (see *resampling.py*,
+            default is 'multinomial'); with 'particles' set to 'unique',
+            resampled particles are stored as their distinct ancestors
+            (default is 'full').
         + *meas_params* (list of dictionaries):
             A list containing a dictionary with parameters for each measurement
             equation in the model.
         + *trans_params* (list of dictionaries):
             A list that contains a dictionary with parameters for each
             transition equation in the model.
-        + *prior* (np.ndarray):
+        + *prior* (np.ndarray or PriorSampler):
             3xNxM-array, where N is the number of observations and M the number
             of particles, that contains the particles (each consisting of three
-            factors) used in the first step of the particle smoother.
-        + *trans_errors* (np.ndarray):
+            factors) used in the first step of the particle smoother. May
+            also be a sampler that draws them (see
+            *initial_draws.PriorSampler*). A degenerate prior, where all
+            particles of an observation are identical, can be given as 3xNx1
+            array; it is never replicated M times.
+        + *trans_errors* (np.ndarray or CounterTransitionErrors):
             HxNxPxM-array, where H<=3 is the number of non-constant factor
             types and P is the number of periods per observation, that contains
             the additive errors to the transition equations, drawn for each
-            observation, period and particle.
+            observation, period and particle. Alternatively, an object that
+            generates the errors of each period when they are needed (see
+            *random_streams.CounterTransitionErrors*).
+        + *meas_data* (list of pd.DataFrame or MeasurementManifest):
+            Measurement data of the N observations for each factor type (as
+            stored by *prepare_data*), or the manifest of the shards that
+            contain it (see *prepare_data.MeasurementManifest*). Is loaded
+            from 'OUT_ANALYSIS' if not provided.
+        + *rng* (np.random.Generator or module np.random):
+            Source of randomness for the resampling step and the backward
+            draws.
     
     Returns:
         + estimates of factors (pd.DataFrame):
@@ -117,76 +199,512 @@ def particle_smoother(params, meas_params, trans_params, prior, trans_errors):
             
     """
     
-    # Set up the factors and their type (non-constant or constant).
+    model = SmootherModel(params, meas_params, trans_params, meas_data)
+    return model.smooth(prior, trans_errors, rng).to_frame()
+    
+
+def chunked_particle_smoother(
+                                params, meas_params, trans_params, prior,
+                                trans_errors, chunk_size, meas_data=None,
+                                seed=None
+                             ):
+    """Run *particle_smoother* on consecutive blocks of *chunk_size*
+    observations and concatenate the estimates. Observations are independent
+    in the model, so only the working arrays of one block (particle history,
+    weights) are held in memory at any time. If *seed* is given, every block
+    resamples with its own random stream (see *random_streams*), such that
+    the result does not depend on how blocks are distributed over processes
+    (see *parallel_smoother*).
+    
+    Args:
+        + *params*, *meas_params*, *trans_params*, *prior*, *trans_errors*:
+            See *particle_smoother*. The observations along the second axis
+            of *prior* and *trans_errors* are expected in the order of the
+            sorted caseids of the measurement data. Only views of these
+            arrays are passed on to the blocks. If *prior* is a sampler, the
+            prior of each block is drawn when the block is smoothed.
+        + *chunk_size* (integer):
+            Number of observations per block.
+        + *meas_data* (list of pd.DataFrame or MeasurementManifest):
+            See *particle_smoother*. From a manifest, only the shards that
+            contain a block are loaded when the block is smoothed.
+        + *seed* (integer):
+            Seed from which the random streams of the blocks are spawned. The
+            global random state of numpy is used if not provided.
+    
+    Returns:
+        + estimates of factors (pd.DataFrame): See *particle_smoother*.
+        
+    """
+    
+    if meas_data is None:
+        meas_data = _load_measurement_data(['fac1', 'fac2', 'fac3'])
+    if isinstance(meas_data, list):
+        caseids = meas_data[0].index.unique(level = 0).sort_values()
+        nr_obs = len(caseids)
+    else:
+        nr_obs = meas_data.nr_obs
+    bounds = shard_bounds(nr_obs, chunk_size)
+    if seed is None:
+        rngs = [np.random]*len(bounds)
+    else:
+        rngs = [shard_generator(seq) for seq in shard_seeds(seed, len(bounds))]
+    estimates = []
+    for (start, stop), rng in zip(bounds, rngs):
+        if isinstance(meas_data, list):
+            block_data = [
+                            data.loc[caseids[start:stop]].sort_index()
+                            for data in meas_data
+                         ]
+        else:
+            block_data = meas_data.load(start, stop)
+        estimates.append(particle_smoother(
+                                            params, meas_params, trans_params,
+                                            _observation_prior(
+                                                            prior, start, stop
+                                                              ),
+                                            _observation_errors(
+                                                            trans_errors,
+                                                            start, stop
+                                                               ),
+                                            block_data, rng
+                                          ))
+    return pd.concat(estimates)
+
+
+class SmootherResult:
+    """Estimates of the smoother as dense array, from which the DataFrame
+    with MultiIndex (observation, period) is only built on request.
+    
+    Instance variables:
+        + *estimates* (np.ndarray):
+            Px3xN array of the estimated factors per period, factor type and
+            observation.
+        + *caseids* (np.ndarray): Sorted caseids of the N observations.
+        + *periods* (np.ndarray): The P periods (1, ..., P).
+        + *f_nr* (list of strings): Names of the factor types.
+    
+    Public methods:
+        + to_frame
+        + from_frame
+        + observations
+    
+    """
+    
+    def __init__(self, estimates, caseids, f_nr=('fac1', 'fac2', 'fac3')):
+        self.estimates = estimates
+        self.caseids = np.asarray(caseids)
+        self.periods = np.arange(1, estimates.shape[0]+1)
+        self.f_nr = list(f_nr)
+    
+    def to_frame(self):
+        """Return the estimates as DataFrame with MultiIndex (observation,
+        period) and columns 'facX' (see *particle_smoother*).
+        
+        """
+        
+        nr_per, nr_fac, nr_obs = self.estimates.shape
+        return pd.DataFrame(
+                    self.estimates.transpose(2, 0, 1).reshape(-1, nr_fac),
+                    columns = self.f_nr,
+                    index = pd.MultiIndex.from_product([
+                                                        self.caseids,
+                                                        range(1, nr_per+1)
+                                                       ])
+                           )
+    
+    @classmethod
+    def from_frame(cls, frame):
+        """Build the result from a DataFrame with MultiIndex (caseid, period)
+        that has one row per caseid and period (e.g. estimates stored by
+        *particle_smoother* or the true factors).
+        
+        """
+        
+        frame = frame.sort_index()
+        caseids = frame.index.unique(level = 0).values
+        values = np.asarray(frame.values, dtype = float)
+        return cls(
+                    values.reshape(len(caseids), -1, frame.shape[1])
+                    .transpose(1, 2, 0),
+                    caseids, frame.columns
+                  )
+    
+    def observations(self, caseids):
+        """Return the Px3xK estimates of the observations *caseids*.
+        
+        Raises:
+            + KeyError: If some of the *caseids* have no estimates.
+        
+        """
+        
+        caseids = np.asarray(caseids)
+        positions = np.minimum(
+                                np.searchsorted(self.caseids, caseids),
+                                len(self.caseids) - 1
+                              )
+        missing = self.caseids[positions] != caseids
+        if np.any(missing):
+            raise KeyError(caseids[missing].tolist())
+        return self.estimates[:, :, positions]
+
+
+class SmootherModel:
+    """Measurement and transition equations of the smoother, set up once
+    from the measurement data, such that several priors (e.g. the prior
+    specifications 'rnd_prior' and 'deg_prior') can be smoothed from the
+    same preprocessed state, also concurrently (*smooth* does not modify
+    the model). Subclasses change how particles are propagated and weighted
+    through *_next_state*, *_log_weights* and *_backward_log_weights* (see
+    *kalman_hybrid.KalmanHybridModel*).
+    
+    Instance variables:
+        + *params* (dictionary): See *particle_smoother*.
+        + *meas_objs* (list of Measurement): One per factor type.
+        + *trans_obj* (Transition)
+        + *caseids* (np.ndarray): Sorted caseids of the N observations.
+    
+    Public methods:
+        + smooth
+    
+    """
+    
     f_nr = ['fac1', 'fac2', 'fac3']
     f_setting = [1, 1, 0]
-    # Load in the measurement data.
-    meas_objs = []
-    for fac in f_nr:
-        data = pd.read_pickle(ppj("OUT_ANALYSIS", 'meas_'+fac+'.pkl'))
-        params_list = []
-        for param_dic in meas_params:
-            if fac == param_dic['factor']:
-                params_list.append(param_dic)
-        meas_objs.append(Measurement(params_list, data))
-        
-    # Set up transition equations.
-    trans_obj = Transition(trans_params, f_setting)
-    # History of resampled particles over periods.
-    history = []
-    # Auxiliary function for sampling.
-    sampling = lambda distr : multinomial(params["n_particles"], distr)
-    
-    # Forward iteration of particle smoother.
-    # ========================================
-    history.append(prior)
-    for per in range(params["period"]):
-        next_state = trans_obj.next_state(
-                                            history[per],
-                                            trans_errors[:,:,per,:]
+    
+    def __init__(self, params, meas_params, trans_params, meas_data=None):
+        """Set up the measurement objects (residuals of the measurement data)
+        and the transition equations. See *particle_smoother* for the
+        arguments.
+        
+        """
+        
+        self.params = params
+        # Load in the measurement data.
+        if meas_data is None:
+            meas_data = _load_measurement_data(self.f_nr)
+        elif not isinstance(meas_data, list):
+            meas_data = meas_data.load(0, meas_data.nr_obs)
+        self.meas_objs = []
+        for fac, data in zip(self.f_nr, meas_data):
+            params_list = []
+            for param_dic in meas_params:
+                if fac == param_dic['factor']:
+                    params_list.append(param_dic)
+            self.meas_objs.append(Measurement(params_list, data))
+        # Set up transition equations.
+        self.trans_obj = Transition(trans_params, self.f_setting)
+        self.caseids = self.meas_objs[0].caseids
+    
+    def _next_state(self, state, errors, per, unique=None):
+        """Propagate the particles *state* to period *per* + 1 (see
+        *Transition.next_state*).
+        
+        """
+        
+        return self.trans_obj.next_state(state, errors, unique)
+    
+    def _measured(self, per):
+        """Return the factor types whose measurements of period *per* + 1
+        weight the particles (constant factor types only in period 1).
+        
+        """
+        
+        return np.nonzero((np.array(self.f_setting)-.1)*per >= 0)[0]
+    
+    def _log_weights(self, next_state, state, per, constants, unique=None):
+        """Return the NxM log-weights of the particles *next_state* of
+        period *per* + 1, propagated from *state*, given the measurements.
+        
+        """
+        
+        const = np.nonzero(0 == np.array(self.f_setting))[0]
+        weights = np.zeros(next_state.shape[1:])
+        for i in self._measured(per):
+            # Work with logs of probabilities throughout, such that
+            # products of small densities cannot underflow.
+            if i in const:
+                weights += constants.broadcast(
+                        self.meas_objs[i].log_marginal_probability(
+                            constants.values[np.searchsorted(const, i)],
+                            per+1
+                                                                  )
+                                              )
+            else:
+                weights += self.meas_objs[i].log_marginal_probability(
+                                                    next_state[i, ...],
+                                                    per+1
+                                                                     )
+        return weights
+    
+    def _backward_log_weights(self, next_estimates, particles, per,
+                              constants=None, unique=None):
+        """Return the NxM log-weights of the resampled *particles* of period
+        *per* (**starts at 1**), given the estimates *next_estimates* of the
+        next period (see *Transition.log_marginal_probability*).
+        
+        """
+        
+        return self.trans_obj.log_marginal_probability(
+                                                        next_estimates,
+                                                        particles, constants,
+                                                        unique
+                                                      )
+    
+    def smooth(self, prior, trans_errors, rng=np.random):
+        """Estimate the factors of all observations from *prior*.
+        
+        Args:
+            + *prior*, *trans_errors*, *rng*: See *particle_smoother*.
+        
+        Returns:
+            + estimates of factors (SmootherResult)
+        
+        """
+        
+        params = self.params
+        nr_obs = len(self.caseids)
+        if not isinstance(prior, np.ndarray):
+            prior = _observation_prior(prior, 0, nr_obs)
+        # Distinct values of the constant factor types of the prior, whose
+        # measurement densities and transition matching are evaluated once
+        # per distinct value.
+        const = np.nonzero(0 == np.array(self.f_setting))[0]
+        constants = ConstantFactors.from_particles(
+                                    prior, const, params["n_particles"]
+                                                  )
+        # Genealogy of resampled particles over periods. A 3xNx1 prior enters
+        # as read-only broadcast view.
+        history = ParticleHistory(
+                                np.broadcast_to(
+                                        prior,
+                                        (3, nr_obs, params["n_particles"])
+                                               ),
+                                self.f_setting, constants
+                                 )
+        scheme = params.get("resampling", "multinomial")
+        # With 'particles' set to 'unique', resampled particles are kept as
+        # their distinct ancestors (see *resampling.UniqueAncestors*).
+        compressed = "unique" == params.get("particles", "full")
+        
+        # Forward iteration of particle smoother.
+        # ========================================
+        state = prior
+        unique = None
+        for per in range(params["period"]):
+            next_state = self._next_state(
+                                            state,
+                                            _period_errors(trans_errors, per),
+                                            per, unique
                                          )
-        probs = np.zeros((params["obs"], params["n_particles"]))
-        fac_to_consider = np.nonzero((np.array(f_setting)-.1)*per >= 0)[0]
-        for i in fac_to_consider:
-            # Take logs of probabilities to calculate product more easily.
-            probs += np.log(meas_objs[i].marginal_probability(
-                                                            next_state[i, ...],
-                                                            per+1)
-                                                             )
-        particle_probs = np.exp(probs)
-        weights = (
-                    particle_probs / 
-                    np.tile(
-                             np.sum(particle_probs, axis = 1),
-                             (params["n_particles"], 1)
-                            ).T
-                  )
-        samples = np.apply_along_axis(sampling, 1, weights)
-        # Construct drawn particles and save them in history.
-        history.append(_construct_new_particles(samples, next_state))
-    
-    # Backward iteration of particle smoother.
-    # =========================================
-    estimates = pd.DataFrame(
-                     data = np.zeros((params["obs"]*params["period"], 3)),
-                     columns = f_nr,
-                     index = pd.MultiIndex.from_product([
-                                                    range(1,params["obs"]+1),
-                                                    range(1,params["period"]+1)
-                                                       ]) 
-                            )
-    arr_est = _find_most_probable_part(weights, next_state)
-    estimates.loc[(slice(None),params["period"]),:] = arr_est.T
-    for per in reversed(range(1, params["period"])):
-        # Weight resampled particles with probability of having produced next
-        # period's most probable particle.
-        weights = trans_obj.marginal_probability(arr_est, history[per])
-        arr_est = _find_most_probable_part(weights, history[per])
-        estimates.loc[(slice(None), per), :] = arr_est.T
-    return estimates
+            weights = self._log_weights(
+                                        next_state, state, per, constants,
+                                        unique
+                                       )
+            log_normalize(weights)
+            ancestors = resample_log(weights, scheme, rng)
+            # Save the drawing in the history and construct drawn particles.
+            drawn = UniqueAncestors(ancestors)
+            history.append(next_state, ancestors, drawn)
+            if compressed:
+                state, unique = next_state, drawn
+            else:
+                state = gather_particles(next_state, ancestors)
+        
+        # Backward iteration of particle smoother.
+        # =========================================
+        # Draw one trajectory per observation, backwards from the filter of
+        # the last period.
+        estimates = np.empty((params["period"], 3, nr_obs))
+        estimates[-1] = _draw_part(weights, next_state, rng)
+        for per in reversed(range(1, params["period"])):
+            # Weight resampled particles (equal filter weights) with the
+            # probability of having produced next period's drawn particle.
+            particles, constants = history.particles(
+                                                    per, with_constants = True
+                                                    )
+            if compressed:
+                unique = UniqueAncestors(history.ancestors[per-1])
+            weights = self._backward_log_weights(
+                                        estimates[per], particles, per,
+                                        constants, unique
+                                                )
+            estimates[per-1] = _draw_part(weights, particles, rng)
+        return SmootherResult(estimates, self.caseids, self.f_nr)
+
+
+
+def smooth_specs(model, priors, trans_errors, seed, threads=0):
+    """Smooth several priors from the same *SmootherModel*.
+    
+    Args:
+        + *model* (SmootherModel): Set up once for all priors.
+        + *priors* (dictionary):
+            Prior (array or sampler, see *particle_smoother*) by name of the
+            prior specification.
+        + *trans_errors*: See *particle_smoother*.
+        + *seed* (integer):
+            Random seed of the resampling. Each specification resamples from
+            its own np.random.RandomState(seed), which gives the same
+            estimates as smoothing it alone after np.random.seed(seed).
+        + *threads* (integer):
+            Number of threads that smooth the specifications concurrently
+            (0 smoothes one after the other).
+    
+    Returns:
+        + estimates (dictionary): SmootherResult by specification.
+    
+    """
+    
+    def smooth(spec):
+        return model.smooth(
+                            priors[spec], trans_errors,
+                            np.random.RandomState(seed)
+                           )
+    
+    if threads > 0:
+        with ThreadPoolExecutor(max_workers = threads) as executor:
+            return dict(zip(priors, executor.map(smooth, priors)))
+    return {spec: smooth(spec) for spec in priors}
+
+def fold_replications(array):
+    """Merge the leading replication axis of an Rx3xNx... (or RxHxNx...)
+    array into its observation axis, which gives a 3x(R*N)x... array whose
+    observations are ordered by replication first.
+    
+    """
+    
+    return np.moveaxis(array, 0, 1).reshape(
+                                    (array.shape[1], -1) + array.shape[3:]
+                                           )
+
+
+def _fold_measurement_data(meas_data):
+    """Stack the measurement data of R replications (list over replications
+    of lists of DataFrames, one per factor type) into one list of DataFrames,
+    in which the caseids of replication r are renumbered to r*N + 1, ...,
+    (r+1)*N (in the order of the original caseids).
+    
+    Returns:
+        + measurement data (list of pd.DataFrame)
+        + caseids (list of np.ndarray): Original caseids per replication.
+    
+    """
+    
+    caseids = [
+                np.sort(rep_data[0].index.unique(level = 0).values)
+                for rep_data in meas_data
+              ]
+    nr_obs = len(caseids[0])
+    if any(len(ids) != nr_obs for ids in caseids):
+        raise ReplicationDimensionError
+    folded = []
+    for f in range(len(meas_data[0])):
+        frames = []
+        for r, (rep_data, ids) in enumerate(zip(meas_data, caseids)):
+            frame = rep_data[f]
+            new_ids = r*nr_obs + 1 + np.searchsorted(
+                                        ids, frame.index.get_level_values(0)
+                                                    )
+            frames.append(frame.set_axis(
+                                pd.MultiIndex.from_arrays([
+                                        new_ids,
+                                        frame.index.get_level_values(1)
+                                                         ])
+                                        ))
+        folded.append(pd.concat(frames))
+    return folded, caseids
+
+
+def replicated_particle_smoother(
+                                params, meas_params, trans_params, priors,
+                                trans_errors, meas_data, rng=np.random
+                                ):
+    """Smooth R replications (e.g. of a Monte Carlo study) with one call of
+    *particle_smoother*. Observations are independent in all steps of the
+    smoother, so the replication axis of the priors and the transition
+    errors is folded into the observation axis (see *fold_replications*),
+    and every kernel call evaluates all replications at once.
+    
+    Args:
+        + *params*, *meas_params*, *trans_params*:
+            See *particle_smoother*; shared by all replications.
+        + *priors* (np.ndarray):
+            Rx3xNxM (or Rx3xNx1 for degenerate priors) array of the prior
+            particles of each replication.
+        + *trans_errors* (np.ndarray or CounterTransitionErrors):
+            RxHxNxPxM array of transition errors, or a generator of the
+            errors of all R*N folded observations.
+        + *meas_data* (list of lists of pd.DataFrame):
+            For each replication, the measurement data of its N observations
+            (see *particle_smoother*).
+        + *rng* (np.random.Generator or module np.random):
+            Source of randomness for the resampling step and the backward
+            draws, shared by all replications.
+    
+    Returns:
+        + estimates of factors (pd.DataFrame):
+            As *particle_smoother*, with MultiIndex (replication,
+            observation, period).
+    
+    Raises:
+        + ReplicationDimensionError:
+            If the replications do not have the same number of observations.
+    
+    """
+    
+    folded_data, caseids = _fold_measurement_data(meas_data)
+    if isinstance(trans_errors, np.ndarray):
+        trans_errors = fold_replications(trans_errors)
+    estimates = particle_smoother(
+                                    params, meas_params, trans_params,
+                                    fold_replications(priors), trans_errors,
+                                    folded_data, rng
+                                 )
+    nr_obs = len(caseids[0])
+    positions = estimates.index.get_level_values(0).values - 1
+    return estimates.set_axis(pd.MultiIndex.from_arrays(
+                [
+                    positions // nr_obs,
+                    np.concatenate(caseids)[positions],
+                    estimates.index.get_level_values(1)
+                ],
+                names = ['replication', 'caseid', 't']
+                                                       ))
+
+
+class ReplicationDimensionError(Exception):
+    
+    def __str__(self):
+        return "All replications must have the same number of observations."
     
 if __name__ == "__main__":
-    spec = sys.argv[1]
+    from src.analysis.parallel_smoother import parallel_particle_smoother
+    from src.analysis.initial_draws import PriorSampler, cov_matrix
+    from src.analysis.prepare_data import MeasurementManifest, MANIFEST
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+                        "specs", nargs = "+",
+                        help = "prior specifications, e.g. rnd_prior"
+                       )
+    parser.add_argument(
+                        "--chunk-size", type = int, default = None,
+                        help = "number of observations smoothed at once "
+                               "(overrides 'chunk_size' in smoother.json, "
+                               "0 smoothes all observations at once)"
+                       )
+    parser.add_argument(
+                        "--workers", type = int, default = 0,
+                        help = "number of worker processes that smooth "
+                               "shards of observations in parallel"
+                       )
+    parser.add_argument(
+                        "--threads", type = int, default = 0,
+                        help = "number of threads that smooth the prior "
+                               "specifications concurrently (if neither "
+                               "chunked nor run in worker processes)"
+                       )
+    args = parser.parse_args()
     # Read in parameter files.
     params = json.load(
                         open(
@@ -194,6 +712,8 @@ if __name__ == "__main__":
                                 encoding = "utf-8"
                              )
                     )
+    if args.chunk_size is not None:
+        params["chunk_size"] = args.chunk_size
     np.random.seed(params["rnd_seed"])
     meas_params = json.load(
                              open(
@@ -207,12 +727,82 @@ if __name__ == "__main__":
                                      encoding = "utf-8"
                                  )
                             )
-    # Load prior and transition errors.
-    prior = np.load(ppj("OUT_ANALYSIS", "true_{}.pickle".format(spec)))
-    trans_errors = np.load(ppj("OUT_ANALYSIS", "transition_errors.pickle"))
-    # Run particle smoother.
-    factors = particle_smoother(
+    # Load priors and transition errors, memory-mapped, such that chunks and
+    # workers only read the observations they smooth. In 'counter' mode, the
+    # errors are generated per period from the random seed instead of being
+    # loaded; they are the same for every prior specification either way.
+    priors = {}
+    for spec in args.specs:
+        if (
+                "rnd_prior" == spec and
+                "lazy" == params.get("prior_draws", "stored")
+           ):
+            true_prior = json.load(
+                                open(
+                                    ppj("IN_MODEL_SPECS", "true_prior.json"),
+                                    encoding = "utf-8"
+                                    )
+                                  )
+            priors[spec] = PriorSampler(
+                                        cov_matrix(true_prior),
+                                        true_prior[2]["var_p"], params
+                                       )
+        else:
+            priors[spec] = load_array(
+                                ppj("OUT_ANALYSIS", "true_{}".format(spec))
+                                     )
+    if "counter" == params.get("trans_errors", "stored"):
+        trans_errors = CounterTransitionErrors(
+                                params["rnd_seed"],
+                                (2,) + priors[args.specs[0]].shape[1:2]
+                                + (params["period"], params["n_particles"])
+                                              )
+    else:
+        trans_errors = load_array(ppj("OUT_ANALYSIS", "transition_errors"))
+    # Measurement data that is stored in shards is loaded block by block.
+    if params.get("meas_shard_size", 0) > 0:
+        meas_data = MeasurementManifest(ppj("OUT_ANALYSIS", MANIFEST))
+    else:
+        meas_data = None
+    # Run particle smoother. Without chunks or workers, the measurement and
+    # transition equations are set up once for all specifications.
+    if args.workers > 0:
+        factors = {
+                    spec: parallel_particle_smoother(
+                                    params, meas_params, trans_params, prior,
+                                    trans_errors, args.workers, meas_data
+                                                    )
+                    for spec, prior in priors.items()
+                  }
+    elif params.get("chunk_size", 0) > 0:
+        factors = {
+                    spec: chunked_particle_smoother(
                                     params, meas_params, trans_params, prior,
-                                    trans_errors
-                                )
-    factors.to_pickle(ppj("OUT_ANALYSIS", spec+"_factor_estimates.pkl"))
\ No newline at end of file
+                                    trans_errors, params["chunk_size"],
+                                    meas_data, seed = params["rnd_seed"]
+                                                   )
+                    for spec, prior in priors.items()
+                  }
+    else:
+        results = smooth_specs(
+                                SmootherModel(
+                                                params, meas_params,
+                                                trans_params, meas_data
+                                             ),
+                                priors, trans_errors, params["rnd_seed"],
+                                args.threads
+                              )
+        factors = {spec: result.to_frame() for spec, result in results.items()}
+    hashed = spec_hash(*[
+                            ppj("IN_MODEL_SPECS", name)
+                            for name in [
+                                            "smoother.json",
+                                            "measurements.json",
+                                            "transitions.json"
+                                        ]
+                        ])
+    for spec, estimates in factors.items():
+        save_frame(
+                    ppj("OUT_ANALYSIS", spec+"_factor_estimates"), estimates,
+                    seed = params["rnd_seed"], spec_hash = hashed
+                  )
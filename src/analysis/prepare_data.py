@@ -1,5 +1,14 @@
-"""Structure measurements per factor and save as pickle."""
+"""Structure measurements per factor and save as array artifacts.
 
+For large datasets, *prepare_data_streaming* reads the tables in chunks of
+caseids and writes the measurements shard by shard, together with a manifest
+that records which caseids each shard contains (see *MeasurementManifest*).
+It is used if 'meas_shard_size' in smoother.json is positive.
+
+"""
+
+import json
+import os
 import numpy as np
 import pandas as pd
 """
@@ -9,53 +18,330 @@ sys.path.insert(0,'./../../bld/')
 from project_paths import project_paths_join as ppj
 """
 from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import save_frame, load_frame
+from src.analysis.table_cache import load_tables, load_table, lookup, gather
+from src.analysis.table_cache import cache_directory
+
+F_NR = ['fac1', 'fac2', 'fac3']
+MANIFEST = 'meas_manifest.json'
+
+
+def _drop_duplicates(frame):
+    """Drop rows whose values repeat an earlier row of the same caseid (the
+    constant factor type repeats its measurements in every period); missing
+    values are equal to each other, as in *pd.DataFrame.drop_duplicates*.
+    A caseid never spans two shards of *prepare_data_streaming*, so shards
+    are deduplicated on their own.
+
+    """
+
+    keys = frame.droplevel(1).reset_index()
+    return frame[~keys.duplicated().values]
+
+
+def _measurement_frames(factor, case, control):
+    """Build the measurement DataFrame of each factor type from the columns
+    (dictionaries of arrays) of **table_1**, **table_2** and **table_3**, for
+    the rows of *case*.
+
+    """
+
+    index = pd.MultiIndex.from_arrays(
+                                        [case['caseid'], case['t']],
+                                        names = ['caseid', 't']
+                                     )
+    # Gather controls and measurements at the ids in table_2.
+    controls = {}
+    for c, name in [('x1', 'control'), ('x2', 'control_2')]:
+        rows = lookup(control['cont_id'], case[c])
+        controls[name] = gather(control['control'], rows)
+    dataframes = []
+    for f in F_NR:
+        rows = lookup(factor['factor_id'], case[f])
+        columns = dict(controls)
+        for meas in ['meas1', 'meas2', 'meas3']:
+            columns[meas] = gather(factor[meas], rows)
+        dataframes.append(_drop_duplicates(
+                                        pd.DataFrame(columns, index = index)
+                                          ))
+    return dataframes
+
 
 def prepare_data():
     """Merge tables generated from simulated data, where columns 'fac1',
     'fac2', 'fac3' from **table_2** contain the factor ids in **table_1**
     and columns 'x1', 'x2' from **table_2** contain control ids in **table_3**.
-    
-    The output are one pandas dataframe (saved as pickle) per factor, named
-    'meas_facX' (X as 1, 2, 3), that contains the multiindex (caseid, period),
-    the two controls, and three measurements.
-    
+
+    The output are one pandas dataframe (saved as array artifact, see
+    *artifacts.save_frame*) per factor, named 'meas_facX' (X as 1, 2, 3), that
+    contains the multiindex (caseid, period), the two controls, and three
+    measurements.
+
     """
 
-    # Read in dataframes from Stata files.
-    factor = pd.read_stata(
-                            ppj("OUT_DATA","tables", "data_table_1.dta"),
-                            index_col = 'factor_id',
-                            columns = ['factor_id', 'meas1', 'meas2', 'meas3']
-                          )
-    case = pd.read_stata(
-                            ppj("OUT_DATA", "tables", "data_table_2.dta")
-                        )
-    case.set_index(['caseid', 't'], inplace = True)
-    control = pd.read_stata(
-                                ppj("OUT_DATA", "tables", "data_table_3.dta"),
-                                index_col = 'cont_id'
-                            )
-    
-    # Join data at indices, generate one dataframe per factor
-    # and save as pickle.
-    c_nr = ['x1', 'x2']
-    for nr, c in enumerate(c_nr):
-        case = case.join(control, on = c, rsuffix = '_'+str(nr+1))
-    case.drop(c_nr, axis = 1, inplace = True)
-    
-    f_nr=['fac1', 'fac2', 'fac3']
-    dataframes = []
-    
-    for nr, f in enumerate(f_nr):
-        dataframes.append(case.join(factor, on = f))
-        dataframes[nr].drop(f_nr, axis = 1, inplace = True)
-        dataframes[nr].drop_duplicates(inplace = True)
-        dataframes[nr].to_pickle(ppj("OUT_ANALYSIS", 'meas_'+f+'.pkl'))
-    
-if '__main__' == __name__:
-    prepare_data()
+    # Read in the columns of the tables from the cache, generate one
+    # dataframe per factor and save as array artifact.
+    factor, case, control = load_tables([1, 2, 3])
+    for f, dataframe in zip(F_NR, _measurement_frames(factor, case, control)):
+        save_frame(ppj("OUT_ANALYSIS", 'meas_'+f), dataframe)
+
+
+def _table_chunks(nr, chunksize):
+    """Yield the rows of 'data_table_*nr*.dta' in chunks of *chunksize* rows
+    (as dictionaries of arrays), from the columnar cache if it exists and
+    with *pd.read_stata* otherwise.
+
+    """
+
+    path = ppj("OUT_DATA", "tables", "data_table_{}.dta".format(nr))
+    cache_root = ppj("OUT_ANALYSIS", "table_cache")
+    if os.path.isdir(cache_directory(path, cache_root)):
+        columns = load_table(path, cache_root)
+        nr_rows = len(next(iter(columns.values())))
+        for start in range(0, nr_rows, chunksize):
+            yield {
+                    key: column[start:start+chunksize]
+                    for key, column in columns.items()
+                  }
+    else:
+        with pd.read_stata(path, chunksize = chunksize) as reader:
+            for chunk in reader:
+                yield {key: chunk[key].values for key in chunk.columns}
+
+
+class OrderedTable:
+    """Rows of a table that is read chunk by chunk, and whose rows are
+    ordered by an id column (non-decreasing). Rows are handed out in order,
+    up to a given id.
+
+    Public methods:
+        + next_bound
+        + take_before
+
+    """
+
+    def __init__(self, chunks, id_column):
+        """Set up the table.
+
+        Args:
+            + *chunks* (iterator): Yields dictionaries of column arrays.
+            + *id_column* (string): Name of the ordering column.
+
+        """
 
+        self._chunks = chunks
+        self.id_column = id_column
+        self._buffer = None
+        self._last_id = None
 
+    def _read(self):
+        """Append the next chunk to the buffer. Returns False at the end of
+        the table.
 
+        """
 
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        ids = chunk[self.id_column]
+        if len(ids) == 0:
+            return True
+        if (
+                np.any(np.diff(ids) < 0) or
+                (self._last_id is not None and ids[0] < self._last_id)
+            ):
+            raise TableOrderError(self.id_column)
+        self._last_id = ids[-1]
+        if self._buffer is None:
+            self._buffer = chunk
+        else:
+            self._buffer = {
+                            key: np.concatenate([self._buffer[key], column])
+                            for key, column in chunk.items()
+                           }
+        return True
 
+    def _buffered_ids(self):
+        if self._buffer is None:
+            return np.array([])
+        return self._buffer[self.id_column]
+
+    def next_bound(self, nr_ids):
+        """Return the (*nr_ids*+1)-th distinct id of the remaining rows, or
+        None if there are at most *nr_ids* distinct ids left.
+
+        """
+
+        while len(np.unique(self._buffered_ids())) <= nr_ids and self._read():
+            pass
+        unique_ids = np.unique(self._buffered_ids())
+        if len(unique_ids) > nr_ids:
+            return unique_ids[nr_ids]
+        return None
+
+    def take_before(self, bound):
+        """Remove and return the remaining rows (dictionary of arrays) with
+        id smaller than *bound* (all remaining rows if *bound* is None).
+
+        """
+
+        while (
+                (bound is None or
+                 0 == len(self._buffered_ids()) or
+                 self._buffered_ids()[-1] < bound)
+                and self._read()
+              ):
+            pass
+        if self._buffer is None:
+            return None
+        ids = self._buffered_ids()
+        stop = len(ids) if bound is None else np.searchsorted(ids, bound)
+        rows = {key: column[:stop] for key, column in self._buffer.items()}
+        self._buffer = {
+                        key: column[stop:]
+                        for key, column in self._buffer.items()
+                       }
+        return rows
+
+
+def prepare_data_streaming(shard_size, chunksize=None):
+    """Prepare the measurement data as *prepare_data*, but read the tables
+    in chunks and write the measurements of *shard_size* caseids at a time
+    (as 'meas_facX_shard_K'), such that only one shard is held in memory.
+    **table_1** and **table_3** must be ordered by their ids, which increase
+    with the caseid (as generated in :ref:`data_management`).
+
+    A manifest ('meas_manifest.json') records, for each shard, the first and
+    last caseid, the number of caseids and the stems of the files.
+
+    Repeated rows are dropped within each caseid, as in *prepare_data*, so
+    no state is kept across shards.
+
+    Args:
+        + *shard_size* (integer): Number of caseids per shard.
+        + *chunksize* (integer):
+            Rows per chunk read from a table (default: 8 times *shard_size*).
+
+    """
+
+    chunksize = chunksize or 8*shard_size
+    case = OrderedTable(_table_chunks(2, chunksize), 'caseid')
+    factor = OrderedTable(_table_chunks(1, chunksize), 'factor_id')
+    control = OrderedTable(_table_chunks(3, chunksize), 'cont_id')
+    shards = []
+    while True:
+        case_rows = case.take_before(case.next_bound(shard_size))
+        if case_rows is None or 0 == len(case_rows['caseid']):
+            break
+        # Ids increase with the caseid, so the rows of the shard are those up
+        # to the largest id that the shard refers to.
+        factor_rows = factor.take_before(
+                        max(np.max(case_rows[f]) for f in F_NR) + 1
+                                        )
+        control_rows = control.take_before(
+                        max(np.max(case_rows[c]) for c in ['x1', 'x2']) + 1
+                                          )
+        files = {}
+        for f, dataframe in zip(
+                                F_NR,
+                                _measurement_frames(
+                                            factor_rows, case_rows,
+                                            control_rows
+                                                   )
+                               ):
+            files[f] = 'meas_{}_shard_{}'.format(f, len(shards))
+            save_frame(ppj("OUT_ANALYSIS", files[f]), dataframe)
+        shards.append({
+                        'first_caseid': int(case_rows['caseid'][0]),
+                        'last_caseid': int(case_rows['caseid'][-1]),
+                        'nr_obs': len(np.unique(case_rows['caseid'])),
+                        'files': files
+                      })
+    with open(
+                ppj("OUT_ANALYSIS", MANIFEST), 'w', encoding = 'utf-8'
+             ) as out_file:
+        json.dump(
+                    {'shard_size': shard_size, 'shards': shards}, out_file,
+                    indent = 4
+                 )
+
+
+class MeasurementManifest:
+    """Measurement data that is stored in shards of caseids (see
+    *prepare_data_streaming*). Only the shards that contain the requested
+    observations are loaded.
+
+    Instance variables:
+        + *shards* (list of dictionaries): The entries of the manifest.
+        + *nr_obs* (integer): Number of observations (caseids).
+
+    Public methods:
+        + load
+
+    """
+
+    def __init__(self, path):
+        """Read the manifest at *path*; the shards are expected in the same
+        directory.
+
+        """
+
+        with open(path, encoding = 'utf-8') as in_file:
+            manifest = json.load(in_file)
+        self.directory = os.path.dirname(path)
+        self.shards = manifest['shards']
+        self._offsets = np.cumsum(
+                                    [0] + [
+                                            shard['nr_obs']
+                                            for shard in self.shards
+                                          ]
+                                 )
+        self.nr_obs = int(self._offsets[-1])
+
+    def load(self, start, stop):
+        """Return the measurement data (list of DataFrames, one per factor
+        type) of the observations at positions *start* to *stop* (in the
+        order of the caseids).
+
+        """
+
+        parts = [[] for f in F_NR]
+        for nr, shard in enumerate(self.shards):
+            first = max(start, self._offsets[nr]) - self._offsets[nr]
+            last = min(stop, self._offsets[nr+1]) - self._offsets[nr]
+            if first >= last:
+                continue
+            frames = [
+                        load_frame(os.path.join(self.directory,
+                                                shard['files'][f]))
+                        for f in F_NR
+                     ]
+            caseids = frames[0].index.unique(level = 0)[first:last]
+            for part, frame in zip(parts, frames):
+                part.append(frame.loc[caseids])
+        return [pd.concat(part) for part in parts]
+
+
+class TableOrderError(Exception):
+
+    def __init__(self, column):
+        self.column = column
+
+    def __str__(self):
+        return (
+                "Rows are not ordered by '{}', the table cannot be read in "
+                "chunks."
+               ).format(self.column)
+
+
+if '__main__' == __name__:
+    fixed = json.load(
+                      open(
+                              ppj("IN_MODEL_SPECS", "smoother.json"),
+                              encoding="utf-8"
+                              )
+                      )
+    if fixed.get("meas_shard_size", 0) > 0:
+        prepare_data_streaming(fixed["meas_shard_size"])
+    else:
+        prepare_data()
@@ -0,0 +1,255 @@
+"""Independent random number streams for shards of observations.
+
+The observations are split into shards of a fixed size, and every shard gets
+its own stream, derived from the random seed in :file:`smoother.json` with
+*np.random.SeedSequence.spawn*. Results then depend on the shard, but not on
+the order in which shards are processed or on the number of worker processes
+that process them.
+
+Transition errors can also be generated on the fly instead of being stored
+(see *CounterTransitionErrors*): the counter-based generator Philox is keyed
+by the seed and the shard, and its counter starts at a position determined
+by the period, the factor type and the observation (see *counter_normals*),
+so that the errors of any observations and period can be generated
+directly, in any order.
+
+"""
+
+import numpy as np
+
+
+def shard_bounds(nr_obs, shard_size):
+    """Return the (start, stop) positions of the shards of *shard_size*
+    consecutive observations.
+
+    Args:
+        + *nr_obs* (integer): Number of observations.
+        + *shard_size* (integer): Number of observations per shard.
+
+    Returns:
+        + bounds (list of tuples): (start, stop) for each shard.
+
+    """
+
+    return [
+            (start, min(start+shard_size, nr_obs))
+            for start in range(0, nr_obs, shard_size)
+           ]
+
+
+def shard_seeds(seed, nr_shards):
+    """Spawn one seed sequence per shard from *seed*.
+
+    Args:
+        + *seed* (integer): Random seed of the estimation.
+        + *nr_shards* (integer): Number of shards.
+
+    Returns:
+        + seed sequences (list of np.random.SeedSequence)
+
+    """
+
+    return np.random.SeedSequence(seed).spawn(nr_shards)
+
+
+def shard_generator(seed_seq):
+    """Return a random generator for the stream of one shard.
+
+    Args:
+        + *seed_seq* (np.random.SeedSequence): As returned by *shard_seeds*.
+
+    Returns:
+        + generator (np.random.Generator)
+
+    """
+
+    return np.random.Generator(np.random.PCG64(seed_seq))
+
+
+class StackedGenerator:
+    """Random generator whose draws are split along the first axis into
+    consecutive blocks of rows, each drawn from a generator of its own. Used
+    where the observations of several shards (e.g. of several replications)
+    are smoothed in one vectorized pass: every block gets the numbers that
+    its generator gives it when the block is smoothed alone.
+
+    Instance variables:
+        + *generators* (list of np.random.Generator): One per block.
+        + *sizes* (list of integers): Number of rows of each block.
+
+    Public methods:
+        + random
+        + standard_exponential
+
+    """
+
+    def __init__(self, generators, sizes):
+        self.generators = list(generators)
+        self.sizes = list(sizes)
+
+    def _stack(self, method, size):
+        """Draw the blocks of an array of shape *size* with *method* (name
+        of a method of np.random.Generator) and concatenate them.
+
+        """
+
+        size = tuple(np.atleast_1d(size))
+        if size[0] != sum(self.sizes):
+            raise ValueError(
+                    "{} rows requested from blocks of {} rows".format(
+                                                    size[0], sum(self.sizes)
+                                                                     )
+                            )
+        return np.concatenate([
+                    getattr(generator, method)((rows,) + size[1:])
+                    for generator, rows in zip(self.generators, self.sizes)
+                              ])
+
+    def random(self, size):
+        """See *np.random.Generator.random*."""
+
+        return self._stack('random', size)
+
+    def standard_exponential(self, size):
+        """See *np.random.Generator.standard_exponential*."""
+
+        return self._stack('standard_exponential', size)
+
+
+def counter_normals(key, stream, first, nr_rows, row_length):
+    """Draw rows *first* to *first* + *nr_rows* of a stream of rows of
+    *row_length* standard normal draws each.
+
+    The stream is the Philox generator with *key*, whose counter holds the
+    row in its lowest word and *stream* in the others. Every row is drawn
+    from a fixed range of the counter (Box-Muller transform of
+    2*ceil(*row_length*/2) uniform draws), so any range of rows is drawn
+    directly, and equals the same rows of a longer range.
+
+    Args:
+        + *key* (sequence of two integers): Key of the generator.
+        + *stream* (sequence of three integers):
+            Upper words of the counter, which distinguish streams with the
+            same key.
+        + *first* (integer): First row (**starts at 0**).
+        + *nr_rows*, *row_length* (integer): Shape of the draws.
+
+    Returns:
+        + draws (np.ndarray): nr_rows x row_length array.
+
+    """
+
+    pairs = -(-row_length // 2)
+    # Philox yields four 64-bit words (uniform draws) per counter step.
+    steps = -(-pairs // 2)
+    bit_generator = np.random.Philox(
+                    key = np.array(key, dtype = np.uint64),
+                    counter = np.array([first*steps] + list(stream),
+                                       dtype = np.uint64)
+                                    )
+    uniforms = np.random.Generator(bit_generator).random((nr_rows, 4*steps))
+    uniforms = uniforms[:, :2*pairs].reshape(nr_rows, pairs, 2)
+    radius = np.sqrt(-2*np.log1p(-uniforms[..., 0]))
+    angle = 2*np.pi*uniforms[..., 1]
+    return np.stack(
+                    [radius*np.cos(angle), radius*np.sin(angle)], axis = 2
+                   ).reshape(nr_rows, 2*pairs)[:, :row_length]
+
+
+# Number of observations per block of on-the-fly transition errors (one
+# Philox key per block). It is fixed, such that errors do not depend on how
+# the smoother is chunked; only the observations requested are drawn.
+ERROR_SHARD_SIZE = 1000
+
+
+def period_errors(seed, shard, period, shape, first=0):
+    """Draw the standard normal transition errors of one period for
+    consecutive observations of one shard, from the Philox generator with
+    key (seed, shard) (see *counter_normals*; the stream of factor type h
+    is (h, period, 0)).
+
+    Args:
+        + *seed* (integer): Random seed of the estimation.
+        + *shard* (integer): Number of the shard (**starts at 0**).
+        + *period* (integer): Number of the period (**starts at 0**).
+        + *shape* (tuple): Shape HxKxM of the errors (K observations).
+        + *first* (integer):
+            Position of the first of the K observations in the shard.
+
+    Returns:
+        + errors (np.ndarray)
+
+    """
+
+    nr_nonconst, nr_obs, nr_parts = shape
+    return np.stack([
+                        counter_normals(
+                                        [seed, shard], [h, period, 0], first,
+                                        nr_obs, nr_parts
+                                       )
+                        for h in range(nr_nonconst)
+                    ])
+
+
+class CounterTransitionErrors:
+    """Stand-in for the HxNxPxM array of transition errors (H non-constant
+    factor types, N observations, P periods, M particles) that generates the
+    errors of one period for a range of observations when they are needed,
+    see *period_errors*. Errors of observation n are taken from block
+    n // *shard_size*, so they are the same however the observations are
+    chunked or sharded, and for every prior specification.
+
+    Instance variables:
+        + *seed* (integer)
+        + *shape* (tuple): The shape (H, N, P, M) of the full array.
+        + *shard_size* (integer): Observations per block of errors.
+        + *start*, *stop* (integer):
+            Range of observations covered by this object.
+
+    Public methods:
+        + period
+        + observations
+
+    """
+
+    def __init__(self, seed, shape, shard_size=ERROR_SHARD_SIZE, start=0,
+                 stop=None):
+        self.seed = seed
+        self.shape = tuple(shape)
+        self.shard_size = shard_size
+        self.start = start
+        self.stop = self.shape[1] if stop is None else stop
+
+    def observations(self, start, stop):
+        """Return the errors of the observations at positions *start* to
+        *stop* (relative to this object), like slicing the second axis.
+
+        """
+
+        return CounterTransitionErrors(
+                                        self.seed, self.shape,
+                                        self.shard_size, self.start+start,
+                                        min(self.start+stop, self.stop)
+                                      )
+
+    def period(self, per):
+        """Generate the HxKxM errors of period *per* (**starts at 0**) for
+        the K observations covered by this object.
+
+        """
+
+        nr_nonconst, _, _, nr_parts = self.shape
+        first = self.start // self.shard_size
+        last = (self.stop - 1) // self.shard_size
+        blocks = []
+        for shard in range(first, last+1):
+            # Only the observations of the shard that are covered.
+            shard_start = shard*self.shard_size
+            lower = max(self.start, shard_start) - shard_start
+            upper = min(self.stop, shard_start + self.shard_size) - shard_start
+            blocks.append(period_errors(
+                                        self.seed, shard, per,
+                                        (nr_nonconst, upper-lower, nr_parts),
+                                        lower
+                                       ))
+        return np.concatenate(blocks, axis = 1)
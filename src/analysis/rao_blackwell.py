@@ -0,0 +1,426 @@
+"""Rao-Blackwellized variant of the particle smoother, which integrates the
+constant factor types out instead of sampling them.
+
+fac3 is constant over time: it enters the model through its measurements
+(period 1) and as input to the CES transition of fac1. The prior draws only
+*draws_constant* distinct values of it per observation (see
+*initial_draws.PriorSampler*), so the bootstrap smoother spends most of its
+particles on copies of the non-constant factors, one per value of fac3.
+Here, each particle consists of the non-constant factor types only and
+carries the conditional distribution of the constant ones over the distinct
+prior values (the support, see *particle_history.ConstantFactors*), given
+its trajectory and the measurements so far:
+
+    * forward, the next state is drawn from the mixture of the transition
+      equations over the support (a support value is drawn from the
+      distribution of the particle, then the errors are added), and the
+      distribution is updated with the transition densities of the drawn
+      state for every support value,
+    * the measurements of the constant factor types enter the particle
+      weights integrated over the distribution,
+    * backward, a support value and a particle of the last period are
+      drawn from their joint filter distribution, and the support value
+      fixes the constant factor types in all periods. In the earlier
+      periods, the weights of a particle are its probability of having
+      produced the next estimate, times its filter probability of the
+      support value; this is the backward step of the bootstrap smoother
+      (see *particle_smoother.SmootherModel.smooth*), whose resampled
+      particles carry their constant factor types instead.
+
+The estimates have the format of *particle_smoother*. Run as a script, the
+bootstrap and the Rao-Blackwellized smoother are compared for increasing
+numbers of particles (see *benchmark*).
+
+"""
+
+import argparse
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from bld.project_paths import project_paths_join as ppj
+from src.analysis.particle_smoother import SmootherModel, SmootherResult
+from src.analysis.particle_smoother import _draw_part
+from src.analysis.particle_smoother import _load_measurement_data
+from src.analysis.particle_smoother import _observation_prior
+from src.analysis.particle_smoother import _period_errors
+from src.analysis.particle_history import ConstantFactors
+from src.analysis.resampling import resample_log, log_normalize, draw_log
+from src.analysis.resampling import gather_particles
+from src.analysis.initial_draws import PriorSampler, cov_matrix
+from src.analysis.random_streams import CounterTransitionErrors
+from src.analysis.artifacts import load_frame
+from src.final.summary_stats import differences
+
+F_NR = ['fac1', 'fac2', 'fac3']
+
+
+def _support_distribution(constants, nr_parts):
+    """Return the NxK log-frequencies of the K distinct values of
+    *constants* (ConstantFactors) among the *nr_parts* particles of each
+    observation (-inf for ranks that an observation does not have).
+
+    """
+
+    nr_obs, nr_vals = constants.values.shape[1:]
+    codes = np.broadcast_to(constants.codes, (nr_obs, nr_parts))
+    counts = np.bincount(
+                    (codes + nr_vals*np.arange(nr_obs)[:, np.newaxis]).ravel(),
+                    minlength = nr_obs*nr_vals
+                        ).reshape(nr_obs, nr_vals)
+    with np.errstate(divide = 'ignore'):
+        return np.log(counts/nr_parts)
+
+
+def _log_sums(log_probs):
+    """Return the logarithms of the sums of exp(*log_probs*) over the last
+    dimension (log-sum-exp trick).
+
+    """
+
+    top = np.max(log_probs, axis = -1, keepdims = True)
+    return (
+            np.log(np.sum(np.exp(log_probs - top), axis = -1))
+            + top[..., 0]
+           )
+
+
+def _draw_support(log_post, rng):
+    """Draw one support value per particle from the NxMxK log-probabilities
+    *log_post* (inverse transform sampling).
+
+    """
+
+    cumulative = np.cumsum(np.exp(log_post), axis = 2)
+    points = rng.random(log_post.shape[:2] + (1,))*cumulative[..., -1:]
+    return np.minimum(
+                        np.sum(cumulative < points, axis = 2),
+                        log_post.shape[2] - 1
+                     )
+
+
+class RaoBlackwellizedModel(SmootherModel):
+    """Smoother model (see *particle_smoother.SmootherModel*) whose *smooth*
+    integrates the constant factor types out over the distinct values of
+    the prior.
+
+    A prior that combines *draws_varying* draws of the non-constant factor
+    types with *draws_constant* draws of the constant ones starts with
+    *draws_constant* copies of each draw. The copies are kept: they get
+    different transition errors and part after the first period, and
+    dropping them would leave *draws_varying* particles. Each particle
+    evaluates the transition equations and densities once per support
+    value, so a particle costs several times as much as in the bootstrap
+    smoother (see the run times in the table of *benchmark*). With the same
+    backward step, the RMSE of fac1 and fac2 is about that of the bootstrap
+    smoother with the same number of particles, and the RMSE of fac3 is
+    somewhat lower.
+
+    Public methods:
+        + smooth
+
+    """
+
+    def _with_support(self, state, support):
+        """Combine the HxNxM non-constant factor types *state* with each of
+        the CxNxK distinct values *support* of the constant ones into a
+        3xNxMxK array.
+
+        """
+
+        const = np.nonzero(0 == np.array(self.f_setting))[0]
+        factors = np.empty(
+                            (3,) + state.shape[1:] + support.shape[2:]
+                          )
+        factors[self.trans_obj.nonconst, ...] = state[..., np.newaxis]
+        factors[const, ...] = support[:, :, np.newaxis, :]
+        return factors
+
+    def smooth(self, prior, trans_errors, rng=np.random):
+        """Estimate the factors of all observations from *prior*.
+
+        Args:
+            + *prior*, *trans_errors*, *rng*: See *particle_smoother*.
+              *rng* also draws the support values of the transitions.
+
+        Returns:
+            + estimates of factors (SmootherResult)
+
+        """
+
+        params = self.params
+        nr_obs = len(self.caseids)
+        nr_parts = params["n_particles"]
+        if not isinstance(prior, np.ndarray):
+            prior = _observation_prior(prior, 0, nr_obs)
+        const = np.nonzero(0 == np.array(self.f_setting))[0]
+        nonconst = self.trans_obj.nonconst
+        constants = ConstantFactors.from_particles(prior, const)
+        support = constants.values
+        nr_vals = support.shape[2]
+        # The constant factor types of the prior are independent of the
+        # others (see *initial_draws.PriorSampler*), so every particle starts
+        # from their distribution among all particles of its observation.
+        post = np.broadcast_to(
+                    _support_distribution(constants, nr_parts)[:, np.newaxis],
+                    (nr_obs, nr_parts, nr_vals)
+                              )
+        state = np.broadcast_to(prior, (3, nr_obs, nr_parts))[nonconst, ...]
+        scheme = params.get("resampling", "multinomial")
+        rows = np.arange(nr_obs)[:, np.newaxis]
+        # Resampled particles and their distributions, per period.
+        states = []
+        posts = []
+
+        # Forward iteration of particle smoother.
+        # ========================================
+        for per in range(params["period"]):
+            expected = self.trans_obj.expected_next_state(
+                                        self._with_support(state, support)
+                                                         )
+            if nr_vals > 1:
+                drawn = _draw_support(post, rng)
+                expected_drawn = np.take_along_axis(
+                                    expected,
+                                    drawn[np.newaxis, ..., np.newaxis], 3
+                                                   )[..., 0]
+            else:
+                expected_drawn = expected[..., 0]
+            next_state = expected_drawn + (
+                                self.trans_obj.sds[:, np.newaxis, np.newaxis]
+                                * _period_errors(trans_errors, per)
+                                          )
+            # Update the distributions with the transition densities; their
+            # sum over the support is the density that the state was drawn
+            # from, so it does not enter the weights.
+            log_post = post + np.sum(
+                            self.trans_obj.log_densities(
+                                    next_state[..., np.newaxis] - expected
+                                                        ),
+                            axis = 0
+                                    )
+            log_post -= _log_sums(log_post)[..., np.newaxis]
+            weights = np.zeros((nr_obs, nr_parts))
+            for i in self._measured(per):
+                # Measurements of constant factor types enter the weights
+                # integrated over the distribution of each particle.
+                if i in const:
+                    log_post += self.meas_objs[i].log_marginal_probability(
+                                    support[np.searchsorted(const, i)], per+1
+                                                                          )[
+                                                    :, np.newaxis, :
+                                                                           ]
+                    sums = _log_sums(log_post)
+                    weights += sums
+                    log_post -= sums[..., np.newaxis]
+                else:
+                    weights += self.meas_objs[i].log_marginal_probability(
+                                    next_state[np.searchsorted(nonconst, i)],
+                                    per+1
+                                                                         )
+            log_normalize(weights)
+            ancestors = resample_log(weights, scheme, rng)
+            state = gather_particles(next_state, ancestors)
+            post = log_post[rows, ancestors]
+            states.append(state)
+            posts.append(post)
+
+        # Backward iteration of particle smoother.
+        # =========================================
+        # Draw the support value and the particle of the last period from
+        # their joint filter distribution; the support value fixes the
+        # constant factor types in all periods.
+        joint = weights[..., np.newaxis] + log_post
+        part, val = np.divmod(
+                        draw_log(joint.reshape(nr_obs, nr_parts*nr_vals), rng),
+                        nr_vals
+                             )
+        cols = np.arange(nr_obs)
+        estimates = np.empty((params["period"], 3, nr_obs))
+        estimates[:, const, :] = support[:, cols, val]
+        estimates[-1, nonconst, :] = next_state[:, cols, part]
+        particles = np.empty((3, nr_obs, nr_parts))
+        particles[const, ...] = support[:, cols, val, np.newaxis]
+        for per in reversed(range(1, params["period"])):
+            # Weight resampled particles with their filter probability of the
+            # drawn support value, times the probability of having produced
+            # next period's drawn particle (as in the bootstrap smoother).
+            particles[nonconst, ...] = states[per-1]
+            weights = self._backward_log_weights(
+                                                estimates[per], particles, per
+                                                )
+            weights += np.take_along_axis(
+                                            posts[per-1],
+                                            val[:, np.newaxis, np.newaxis], 2
+                                         )[..., 0]
+            estimates[per-1, nonconst, :] = _draw_part(
+                                                    weights, particles, rng
+                                                      )[nonconst]
+        return SmootherResult(estimates, self.caseids, self.f_nr)
+
+
+def rao_blackwellized_smoother(
+                        params, meas_params, trans_params, prior, trans_errors,
+                        meas_data=None, rng=np.random
+                              ):
+    """Estimate the factors like *particle_smoother* (same arguments and
+    output), but with the constant factor types integrated out (see
+    *RaoBlackwellizedModel*).
+
+    """
+
+    model = RaoBlackwellizedModel(
+                                    params, meas_params, trans_params,
+                                    meas_data
+                                 )
+    return model.smooth(prior, trans_errors, rng).to_frame()
+
+
+SMOOTHERS = {'bootstrap': SmootherModel, 'rao_blackwell': RaoBlackwellizedModel}
+
+
+def benchmark(params, meas_params, trans_params, prior, true_facs,
+              draws_varying, meas_data=None, smoothers=None):
+    """Smooth the data with several smoothers (*SMOOTHERS* by default) for
+    several numbers of particles and compare the RMSE of the estimates.
+
+    Args:
+        + *params* (dictionary):
+            Contents of smoother.json; 'draws_constant' stays fixed.
+        + *meas_params*, *trans_params*, *prior* (list of dictionaries):
+            Contents of measurements.json, transitions.json and
+            true_prior.json.
+        + *true_facs* (pd.DataFrame or SmootherResult): The true factors.
+        + *draws_varying* (list of integers):
+            Numbers of draws of the non-constant factor types of the prior;
+            each run has draws_varying*draws_constant particles.
+        + *meas_data*: See *particle_smoother*.
+        + *smoothers* (dictionary):
+            Smoother model classes (see *particle_smoother.SmootherModel*)
+            by name; 'bootstrap' is the reference of
+            *particles_for_equal_rmse*.
+
+    Returns:
+        + table (pd.DataFrame):
+            RMSE per factor type over all periods and observations, and the
+            run time in seconds, with MultiIndex (smoother, n_particles).
+            Priors and transition errors are drawn from 'rnd_seed' (see
+            *initial_draws.PriorSampler* and
+            *random_streams.CounterTransitionErrors*), so both smoothers get
+            the same inputs.
+
+    """
+
+    if meas_data is None:
+        meas_data = _load_measurement_data(F_NR)
+    if smoothers is None:
+        smoothers = SMOOTHERS
+    records = []
+    for draws in draws_varying:
+        fixed = dict(
+                        params, draws_varying = draws,
+                        n_particles = draws*params["draws_constant"]
+                    )
+        sampler = PriorSampler(cov_matrix(prior), prior[2]["var_p"], fixed)
+        trans_errors = CounterTransitionErrors(
+                                fixed["rnd_seed"],
+                                (2, fixed["obs"], fixed["period"],
+                                 fixed["n_particles"])
+                                              )
+        for name, model_class in smoothers.items():
+            model = model_class(fixed, meas_params, trans_params, meas_data)
+            start = time.perf_counter()
+            result = model.smooth(
+                                    sampler, trans_errors,
+                                    np.random.RandomState(fixed["rnd_seed"])
+                                 )
+            seconds = time.perf_counter() - start
+            diff = differences(result, true_facs)
+            records.append(
+                            [name, fixed["n_particles"]]
+                            + list(np.sqrt(np.mean(diff**2, axis = (0, 2))))
+                            + [seconds]
+                          )
+    return pd.DataFrame(
+                        records,
+                        columns = ['smoother', 'n_particles'] + F_NR
+                                  + ['seconds']
+                       ).set_index(['smoother', 'n_particles'])
+
+
+def particles_for_equal_rmse(table, reference):
+    """Return the smallest number of particles of each smoother in *table*
+    (see *benchmark*) whose RMSE of a factor type is at most that of the
+    bootstrap smoother with *reference* particles (None if there is none),
+    per factor type. The factor types are compared separately, such that a
+    gain in one of them cannot hide a loss in another.
+
+    """
+
+    target = table.loc[('bootstrap', reference), F_NR]
+    out = {}
+    for name in table.index.unique(level = 0):
+        rmse = table.loc[name, F_NR]
+        out[name] = {}
+        for fac in F_NR:
+            enough = rmse.index[rmse[fac] <= target[fac]]
+            out[name][fac] = int(enough.min()) if len(enough) > 0 else None
+    return out
+
+
+def equal_rmse_table(table, reference):
+    """Return *particles_for_equal_rmse* as pd.DataFrame with index
+    'smoother', one column per factor type (empty if there is no such
+    number) and the column 'reference' (the particles of the bootstrap
+    smoother).
+
+    """
+
+    equal = particles_for_equal_rmse(table, reference)
+    frame = pd.DataFrame(
+                            {
+                                fac: pd.array(
+                                        [equal[name][fac] for name in equal],
+                                        dtype = 'Int64'
+                                             )
+                                for fac in F_NR
+                            },
+                            index = pd.Index(list(equal), name = 'smoother')
+                        )
+    frame['reference'] = reference
+    return frame
+
+
+if __name__ == "__main__":
+    from src.analysis.prepare_data import MeasurementManifest, MANIFEST
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+                        "--draws-varying", type = int, nargs = "+",
+                        default = [1, 2, 3, 5, 10],
+                        help = "numbers of draws of fac1 and fac2 per "
+                               "observation in the prior"
+                       )
+    args = parser.parse_args()
+    params, meas_params, trans_params, prior = [
+                json.load(open(
+                                ppj("IN_MODEL_SPECS", name+".json"),
+                                encoding = "utf-8"
+                              ))
+                for name in ['smoother', 'measurements', 'transitions',
+                             'true_prior']
+                                               ]
+    # Measurement data that is stored in shards is loaded from the manifest.
+    if params.get("meas_shard_size", 0) > 0:
+        meas_data = MeasurementManifest(ppj("OUT_ANALYSIS", MANIFEST))
+    else:
+        meas_data = None
+    table = benchmark(
+                        params, meas_params, trans_params, prior,
+                        load_frame(ppj("OUT_ANALYSIS", "true_facs")),
+                        args.draws_varying, meas_data
+                     )
+    table.to_csv(ppj("OUT_TABLES", "rao_blackwell_benchmark.csv"))
+    equal_rmse_table(
+                    table, params["draws_constant"]*max(args.draws_varying)
+                    ).to_csv(ppj("OUT_TABLES", "rao_blackwell_equal_rmse.csv"))
@@ -0,0 +1,357 @@
+"""Vectorized resampling schemes for the particle smoother.
+
+Each scheme takes an NxM array of (not necessarily normalized) particle
+weights, where N is the number of observations and M the number of particles,
+and returns an NxM array of ancestor indices: entry (n, m) is the index of the
+old particle of observation n that is copied to position m. The indices are
+computed for all observations at once from the 2-D cumulative weights, and
+are sorted along each row.
+
+The new particles are then assembled with a single fancy-index gather, see
+*gather_particles*. Weights that are given as logarithms (as in the forward
+pass of the smoother) are resampled with *resample_log*, which never leaves
+the log-domain before the largest log-weight of each row has been subtracted.
+
+"""
+
+import numpy as np
+
+
+def _cumulative_weights(weights):
+    """Return row-wise cumulative weights, normalized to end exactly at 1.
+
+    Args:
+        + *weights* (np.ndarray): NxM array of non-negative weights.
+
+    Returns:
+        + cumulative weights (np.ndarray): NxM array.
+
+    """
+
+    cum_weights = np.cumsum(weights, axis=1)
+    cum_weights /= cum_weights[:, -1:]
+    # Guard against round-off, such that every point in [0, 1) is covered.
+    cum_weights[:, -1] = 1
+    return cum_weights
+
+
+def _search_rows(cum_weights, points):
+    """Find for each point the first particle whose cumulative weight exceeds
+    the point, for all rows in one call of *np.searchsorted*.
+
+    Rows are separated by adding the row number to both the cumulative weights
+    and the points, which makes the flattened cumulative weights increasing.
+
+    Args:
+        + *cum_weights* (np.ndarray):
+            NxM array of row-wise cumulative weights, ending at 1.
+        + *points* (np.ndarray):
+            NxK array of points in [0, 1).
+
+    Returns:
+        + indices (np.ndarray): NxK array of particle indices in 0..M-1.
+
+    """
+
+    nr_obs, nr_parts = cum_weights.shape
+    offsets = np.arange(nr_obs)[:, np.newaxis]
+    flat_indices = np.searchsorted(
+                                    (cum_weights + offsets).ravel(),
+                                    (points + offsets).ravel(),
+                                    side = 'right'
+                                  )
+    indices = flat_indices.reshape(points.shape) - offsets*nr_parts
+    # Points that are rounded onto the upper end of a row stay in that row.
+    return np.minimum(indices, nr_parts-1)
+
+
+def _sorted_uniforms(shape, rng):
+    """Draw sorted uniform points along the last axis, using normalized
+    cumulative sums of exponential spacings (avoids sorting).
+
+    """
+
+    spacings = np.cumsum(
+                          rng.standard_exponential((shape[0], shape[1]+1)),
+                          axis = 1
+                        )
+    return spacings[:, :-1] / spacings[:, -1:]
+
+
+def _indices_from_counts(counts):
+    """Convert NxM copy-counts (each row summing up to M) into NxM sorted
+    ancestor indices.
+
+    """
+
+    nr_obs, nr_parts = counts.shape
+    ancestors = np.tile(np.arange(nr_parts), nr_obs)
+    return np.repeat(ancestors, counts.ravel()).reshape(nr_obs, nr_parts)
+
+
+def multinomial(weights, rng=np.random):
+    """Multinomial resampling: M independent draws per observation.
+
+    Args:
+        + *weights* (np.ndarray):
+            NxM array of non-negative particle weights.
+        + *rng* (np.random.Generator or module np.random):
+            Source of randomness.
+
+    Returns:
+        + ancestor indices (np.ndarray): NxM integer array.
+
+    """
+
+    points = _sorted_uniforms(weights.shape, rng)
+    return _search_rows(_cumulative_weights(weights), points)
+
+
+def stratified(weights, rng=np.random):
+    """Stratified resampling: one uniform draw in each of the M strata
+    [m/M, (m+1)/M) per observation.
+
+    Args and return value as in *multinomial*.
+
+    """
+
+    nr_parts = weights.shape[1]
+    points = (np.arange(nr_parts) + rng.random(weights.shape)) / nr_parts
+    return _search_rows(_cumulative_weights(weights), points)
+
+
+def systematic(weights, rng=np.random):
+    """Systematic resampling: one uniform draw per observation, shifted
+    through the M strata.
+
+    Args and return value as in *multinomial*.
+
+    """
+
+    nr_obs, nr_parts = weights.shape
+    points = (
+                (np.arange(nr_parts) + rng.random((nr_obs, 1)))
+                / nr_parts
+             )
+    return _search_rows(_cumulative_weights(weights), points)
+
+
+def residual(weights, rng=np.random):
+    """Residual resampling: particle m of observation n is copied
+    floor(M*w_nm) times deterministically, the remaining R_n copies are drawn
+    multinomially from the residual weights.
+
+    Args and return value as in *multinomial*.
+
+    """
+
+    nr_obs, nr_parts = weights.shape
+    scaled = nr_parts * weights / np.sum(weights, axis=1, keepdims=True)
+    counts = np.floor(scaled).astype(np.int64)
+    remaining = nr_parts - np.sum(counts, axis=1)
+    # Sorted uniform points for R_n draws per row: only the first R_n of the
+    # M slots are used, normalized with the (R_n+1)-th exponential spacing.
+    spacings = np.cumsum(
+                          rng.standard_exponential((nr_obs, nr_parts+1)),
+                          axis = 1
+                        )
+    points = (
+                spacings[:, :-1]
+                / np.take_along_axis(spacings, remaining[:, np.newaxis], 1)
+             )
+    used = np.arange(nr_parts) < remaining[:, np.newaxis]
+    resid = scaled - counts
+    resid[0 == remaining, :] = 1
+    drawn = _search_rows(_cumulative_weights(resid), np.where(used, points, 0))
+    rows = np.broadcast_to(np.arange(nr_obs)[:, np.newaxis], drawn.shape)
+    counts += np.bincount(
+                            (rows*nr_parts + drawn)[used],
+                            minlength = nr_obs*nr_parts
+                         ).reshape(nr_obs, nr_parts)
+    return _indices_from_counts(counts)
+
+
+SCHEMES = {
+            'multinomial': multinomial,
+            'stratified': stratified,
+            'systematic': systematic,
+            'residual': residual
+          }
+
+
+def resample(weights, scheme='multinomial', rng=np.random):
+    """Draw ancestor indices with the resampling scheme named *scheme*.
+
+    Args:
+        + *weights* (np.ndarray):
+            NxM array of non-negative particle weights.
+        + *scheme* (string):
+            One of 'multinomial', 'stratified', 'systematic', 'residual'.
+        + *rng* (np.random.Generator or module np.random):
+            Source of randomness.
+
+    Returns:
+        + ancestor indices (np.ndarray): NxM integer array.
+
+    """
+
+    if scheme not in SCHEMES:
+        raise ResamplingSchemeError(scheme)
+    return SCHEMES[scheme](weights, rng)
+
+
+def log_normalize(log_weights):
+    """Normalize log-weights row-wise (in place), such that the weights of
+    each row sum up to one. Uses the log-sum-exp trick with broadcasting.
+
+    Args:
+        + *log_weights* (np.ndarray): NxM array of log-weights.
+
+    Returns:
+        + normalized log-weights (np.ndarray): the same NxM array.
+
+    """
+
+    row_max = np.max(log_weights, axis=1, keepdims=True)
+    log_sums = np.log(np.sum(np.exp(log_weights - row_max), axis=1,
+                             keepdims=True)) + row_max
+    log_weights -= log_sums
+    return log_weights
+
+
+def resample_log(log_weights, scheme='multinomial', rng=np.random):
+    """Draw ancestor indices from (not necessarily normalized) log-weights.
+    The weights are formed relative to the largest weight of each row, so
+    they cannot underflow to zero altogether.
+
+    Args:
+        + *log_weights* (np.ndarray): NxM array of log-weights.
+        + *scheme* (string): See *resample*.
+        + *rng* (np.random.Generator or module np.random): See *resample*.
+
+    Returns:
+        + ancestor indices (np.ndarray): NxM integer array.
+
+    """
+
+    weights = log_weights - np.max(log_weights, axis=1, keepdims=True)
+    np.exp(weights, out=weights)
+    return resample(weights, scheme, rng)
+
+
+def draw_log(log_weights, rng=np.random):
+    """Draw a single index per row from (not necessarily normalized)
+    log-weights, e.g. the particle that continues a trajectory in the
+    backward pass of the smoother.
+
+    Args:
+        + *log_weights* (np.ndarray): NxM array of log-weights.
+        + *rng* (np.random.Generator or module np.random): See *resample*.
+
+    Returns:
+        + indices (np.ndarray): N-array of particle indices in 0..M-1.
+
+    """
+
+    weights = log_weights - np.max(log_weights, axis=1, keepdims=True)
+    np.exp(weights, out=weights)
+    points = rng.random((weights.shape[0], 1))
+    return _search_rows(_cumulative_weights(weights), points)[:, 0]
+
+
+def gather_particles(particles, indices):
+    """Assemble new particles from ancestor indices with one fancy-index
+    gather.
+
+    Args:
+        + *particles* (np.ndarray):
+            Array of shape KxNxM with old particles (K factor types).
+        + *indices* (np.ndarray):
+            NxM array of ancestor indices.
+
+    Returns:
+        + new particles (np.ndarray): Array of shape KxNxM.
+
+    """
+
+    rows = np.arange(indices.shape[0])[:, np.newaxis]
+    return particles[:, rows, indices]
+
+
+class UniqueAncestors:
+    """Compressed form of resampled particles: the distinct ancestors of each
+    observation with a map from the resampled particles to them. After
+    resampling from degenerate weights, most particles of an observation are
+    copies of a few ancestors, so deterministic functions of the particles
+    (e.g. the expected next state, see *Transition.next_state*) need only be
+    evaluated once per distinct ancestor and expanded afterwards.
+
+    Instance variables:
+        + *rows* (np.ndarray):
+            Observation of each of the U distinct (observation, ancestor)
+            pairs, in the order of the observations.
+        + *ancestors* (np.ndarray):
+            Index of each distinct ancestor among the old particles.
+        + *first* (np.ndarray):
+            Position of one copy of each distinct ancestor among the
+            resampled particles.
+        + *inverse* (np.ndarray):
+            NxM array with the position of each resampled particle among the
+            U distinct ancestors.
+
+    Public methods:
+        + compress
+        + expand
+
+    """
+
+    def __init__(self, indices):
+        """Find the distinct ancestors in the NxM array of ancestor indices
+        *indices* (see *resample*).
+
+        """
+
+        # Ancestor indices are below the number of particles, so marking
+        # the drawn ones finds them in order without sorting.
+        drawn = np.zeros(indices.shape, dtype = bool)
+        np.put_along_axis(drawn, indices, True, 1)
+        self.rows, self.ancestors = np.nonzero(drawn)
+        positions = np.cumsum(drawn).reshape(drawn.shape) - 1
+        self.inverse = np.take_along_axis(positions, indices, 1)
+        self.first = np.empty(len(self.rows), dtype = np.intp)
+        self.first[self.inverse] = np.arange(indices.shape[1])
+
+    def __len__(self):
+        """Number U of distinct (observation, ancestor) pairs."""
+
+        return len(self.rows)
+
+    def compress(self, particles):
+        """Return the KxU distinct ancestors from the KxNxM array of old
+        *particles*.
+
+        """
+
+        return particles[:, self.rows, self.ancestors]
+
+    def expand(self, values):
+        """Return the ...xNxM array of the resampled particles from the
+        ...xU array *values* of the distinct ancestors.
+
+        """
+
+        return values[..., self.inverse]
+
+
+class ResamplingSchemeError(Exception):
+
+    def __init__(self, scheme):
+        self.scheme = scheme
+
+    def __str__(self):
+        return (
+                "Unknown resampling scheme '{}', choose one of: ".format(
+                                                                  self.scheme
+                                                                        )
+                + ", ".join(sorted(SCHEMES))
+               )
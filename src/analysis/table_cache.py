@@ -0,0 +1,141 @@
+"""Columnar cache of the Stata tables generated in :ref:`data_management`.
+
+Each table is converted once into one array artifact per column (see
+*artifacts*), in a directory whose name contains the SHA-256 hash of the
+.dta file. As long as the file does not change, later runs map the columns
+from the cache instead of parsing the .dta file again.
+
+The tables are in second normal form: **table_2** refers to rows of
+**table_1** (factors) and **table_3** (controls) by id. *lookup* and *gather*
+replace the joins at these ids by integer-indexed gathers.
+
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import save_array, load_array, load_metadata
+
+
+def file_hash(path, block_size=2**20):
+    """Return the SHA-256 hash of the file at *path*."""
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_directory(path, cache_root):
+    """Return the cache directory of the .dta file at *path* below
+    *cache_root*.
+
+    """
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_root, '{}_{}'.format(name, file_hash(path)[:16]))
+
+
+def _convert(path, directory):
+    """Parse the .dta file at *path* and store its columns in *directory*.
+    The columns are written to a temporary directory that is renamed at the
+    end, such that concurrent conversions of the same file cannot leave a
+    partial cache behind.
+
+    """
+
+    table = pd.read_stata(path)
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok = True)
+    temporary = tempfile.mkdtemp(dir = parent)
+    for nr, column in enumerate(table.columns):
+        save_array(
+                    os.path.join(temporary, str(nr)), table[column].values,
+                    column = column
+                  )
+    try:
+        os.rename(temporary, directory)
+    except OSError:
+        # Another process has completed the same conversion.
+        shutil.rmtree(temporary)
+
+
+def load_table(path, cache_root):
+    """Return the columns of the Stata table at *path*, converting the table
+    into the cache first if necessary.
+
+    Args:
+        + *path* (string): Path of the .dta file.
+        + *cache_root* (string): Directory that contains the caches.
+
+    Returns:
+        + columns (dictionary): Memory-mapped np.ndarray by column name.
+
+    """
+
+    directory = cache_directory(path, cache_root)
+    if not os.path.isdir(directory):
+        _convert(path, directory)
+    columns = {}
+    nr_columns = sum(name.endswith('.json') for name in os.listdir(directory))
+    for nr in range(nr_columns):
+        stem = os.path.join(directory, str(nr))
+        columns[load_metadata(stem)['column']] = load_array(stem)
+    return columns
+
+
+def load_tables(tables):
+    """Load the columns of the tables *tables* (numbers X of
+    'data_table_X.dta' in 'OUT_DATA') with *load_table*, from the cache in
+    'OUT_ANALYSIS'.
+
+    """
+
+    return [
+            load_table(
+                        ppj("OUT_DATA", "tables",
+                            "data_table_{}.dta".format(nr)),
+                        ppj("OUT_ANALYSIS", "table_cache")
+                      )
+            for nr in tables
+           ]
+
+
+def lookup(ids, keys):
+    """Find the rows of a table with id column *ids* that *keys* refer to.
+
+    Args:
+        + *ids* (np.ndarray): Unique ids of the rows of a table.
+        + *keys* (np.ndarray): Ids to look up.
+
+    Returns:
+        + rows (np.ndarray):
+            Array of the shape of *keys* with the row of each key, -1 where
+            the key does not exist in *ids*.
+
+    """
+
+    order = np.argsort(ids, kind = 'stable')
+    positions = np.searchsorted(ids[order], keys)
+    positions = np.minimum(positions, len(ids)-1)
+    rows = order[positions]
+    return np.where(ids[rows] == keys, rows, -1)
+
+
+def gather(column, rows):
+    """Gather the entries of *column* at *rows* (see *lookup*), with NaN for
+    rows -1 (as a left join).
+
+    """
+
+    values = column[rows]
+    if np.any(rows < 0):
+        values = values.astype(np.result_type(values.dtype, np.float32))
+        values[rows < 0] = np.nan
+    return values
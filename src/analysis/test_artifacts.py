@@ -0,0 +1,73 @@
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from artifacts import save_array, load_array, save_frame, load_frame
+from artifacts import load_metadata, spec_hash, ArtifactError, open_frame
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_artifacts(tmp_path):
+    out = {}
+    out['stem'] = str(tmp_path / 'array')
+    out['array'] = np.random.RandomState(2).normal(size = (3, 5, 4))
+    index = pd.MultiIndex.from_product(
+                                        [[3, 5, 9], [1, 2]],
+                                        names = ['caseid', 't']
+                                      )
+    out['frame'] = pd.DataFrame(
+                                np.arange(12.).reshape(6, 2), index = index,
+                                columns = ['fac1', 'fac2']
+                               )
+    out['spec'] = tmp_path / 'spec.json'
+    out['spec'].write_text('{"rnd_seed": 1}')
+    return out
+
+def test_array_roundtrip_memory_mapped(setup_artifacts):
+    stem, array = setup_artifacts['stem'], setup_artifacts['array']
+    save_array(stem, array, seed = 1)
+    loaded = load_array(stem)
+    assert isinstance(loaded, np.memmap)
+    assert np.array_equal(loaded[:, 1:3, :], array[:, 1:3, :])
+    metadata = load_metadata(stem)
+    assert metadata['shape'] == [3, 5, 4]
+    assert metadata['seed'] == 1
+
+def test_frame_roundtrip(setup_artifacts):
+    stem, frame = setup_artifacts['stem'], setup_artifacts['frame']
+    save_frame(stem, frame)
+    loaded = load_frame(stem)
+    pd.testing.assert_frame_equal(loaded, frame)
+    # By default, the values are a view of the memory-mapped file.
+    base = loaded.values
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    assert base is not None
+    assert np.array_equal(load_frame(stem, None).values, frame.values)
+
+def test_frame_filled_in_chunks(setup_artifacts):
+    stem, frame = setup_artifacts['stem'], setup_artifacts['frame']
+    out = open_frame(stem, frame.index, frame.columns, seed = 4)
+    for start in range(0, 6, 4):
+        out[start:start+4] = frame.values[start:start+4]
+    out.flush()
+    del out
+    pd.testing.assert_frame_equal(load_frame(stem), frame)
+    assert 4 == load_metadata(stem)['seed']
+
+def test_sidecar_mismatch(setup_artifacts):
+    stem = setup_artifacts['stem']
+    save_array(stem, setup_artifacts['array'])
+    np.save(stem + '.npy', np.zeros((3, 5)))
+    with pytest.raises(ArtifactError):
+        load_array(stem)
+
+def test_spec_hash(setup_artifacts):
+    spec = setup_artifacts['spec']
+    first = spec_hash(spec)
+    assert first == spec_hash(spec)
+    spec.write_text('{"rnd_seed": 2}')
+    assert first != spec_hash(spec)
@@ -0,0 +1,50 @@
+import sys
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from initial_draws import PriorSampler, cov_matrix
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_sampler():
+    out = {}
+    out['prior'] = [{'var_p': 0.2}, {'var_p': 0.5}, {'var_p': 0.3}]
+    out['fixed'] = {
+                    'obs': 7, 'rnd_seed': 3, 'draws_varying': 4,
+                    'draws_constant': 3
+                   }
+    out['sampler'] = PriorSampler(
+                                    cov_matrix(out['prior']), 0.3,
+                                    out['fixed'], shard_size = 3
+                                 )
+    return out
+
+def test_prior_shape(setup_sampler):
+    assert setup_sampler['sampler'].sample().shape == (3, 7, 12)
+
+def test_prior_cartesian_product(setup_sampler):
+    draws = setup_sampler['sampler'].sample()
+    # fac1 and fac2 are repeated for each draw of fac3, fac3 is tiled.
+    varying = draws[0:2, :, :].reshape(2, 7, 4, 3)
+    assert np.all(varying == varying[..., :1])
+    constant = draws[2, :, :].reshape(7, 4, 3)
+    assert np.all(constant == constant[:, :1, :])
+
+def test_prior_blocks_equal_sample(setup_sampler):
+    sampler = setup_sampler['sampler']
+    full = sampler.sample()
+    for start, stop in [(0, 2), (2, 6), (5, 7)]:
+        assert np.array_equal(sampler.draw(start, stop), full[:, start:stop])
+    blocks = [block for _, _, block in sampler.blocks(2)]
+    assert np.array_equal(np.concatenate(blocks, axis = 1), full)
+
+def test_prior_moments(setup_sampler):
+    fixed = dict(setup_sampler['fixed'], obs = 20000)
+    cov_12 = np.array([[0.2, 0.1], [0.1, 0.5]])
+    draws = PriorSampler(cov_12, 0.3, fixed).sample()
+    f12 = draws[0:2, :, ::3].reshape(2, -1)
+    assert_allclose(np.cov(f12), cov_12, atol = 0.01)
+    assert_allclose(np.std(draws[2, :, :3]), 0.3, atol = 0.01)
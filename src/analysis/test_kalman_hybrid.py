@@ -0,0 +1,239 @@
+import sys
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+import pytest
+from kalman_hybrid import KalmanBlock, kalman_hybrid_smoother
+from particle_smoother import particle_smoother
+from measurement import Measurement
+from transition import Transition
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_6obs3periods():
+    out = {}
+    rng = np.random.RandomState(4)
+    nr_obs, nr_per, nr_parts = 6, 3, 8
+    out['params'] = {
+                        'n_particles': nr_parts, 'period': nr_per,
+                        'obs': nr_obs, 'rnd_seed': 1
+                    }
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 1,
+                                'z': z, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                            for z in [1.0, 1.2]
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                          ]
+    index = pd.MultiIndex.from_product(
+                                        [range(1, nr_obs+1),
+                                         range(1, nr_per+1)]
+                                      )
+    out['meas_data'] = [
+                        pd.DataFrame(
+                                        rng.normal(size = (len(index), 5)),
+                                        index = index,
+                                        columns = [
+                                                    'control', 'control_2',
+                                                    'meas1', 'meas2', 'meas3'
+                                                  ]
+                                    )
+                        for fac in range(3)
+                       ]
+    out['prior'] = rng.normal(size = (3, nr_obs, nr_parts))
+    out['trans_errors'] = rng.normal(size = (2, nr_obs, nr_per, nr_parts))
+    out['trans_obj'] = Transition(out['trans_params'], [1, 1, 0])
+    out['meas_objs'] = [
+                        Measurement(
+                                    [
+                                        p for p in out['meas_params']
+                                        if fac == p['factor']
+                                    ],
+                                    data
+                                   )
+                        for fac, data in zip(
+                                            ['fac1', 'fac2', 'fac3'],
+                                            out['meas_data']
+                                            )
+                       ]
+    return out
+
+def _dense_posterior(block, obs, prior_mean, prior_var):
+    """Mean and covariance of (f_0, ..., f_P) of the first autoregressive
+    factor type of observation *obs*, from the joint Gaussian.
+
+    """
+
+    a, b, q = block.intercepts[0], block.slopes[0], block.variances[0]
+    nr_per = block.meas_means.shape[2]
+    precision = np.zeros((nr_per + 1, nr_per + 1))
+    info = np.zeros(nr_per + 1)
+    precision[0, 0] = 1/prior_var
+    info[0] = prior_mean/prior_var
+    for per in range(1, nr_per + 1):
+        # (f_per - a - b*f_(per-1))^2/q
+        coeffs = np.zeros(nr_per + 1)
+        coeffs[per], coeffs[per-1] = 1, -b
+        precision += np.outer(coeffs, coeffs)/q
+        info += coeffs*a/q
+        precision[per, per] += block.precisions[0]
+        info[per] += block.precisions[0]*block.meas_means[0, obs, per-1]
+    cov = np.linalg.inv(precision)
+    return cov @ info, cov
+
+def test_autoregressive_factors(setup_6obs3periods):
+    factors, intercepts, slopes, variances = (
+                    setup_6obs3periods['trans_obj'].autoregressive_factors()
+                                             )
+    assert list(factors) == [1]
+    assert_allclose(intercepts, np.log(.6))
+    assert_allclose(slopes, 1)
+    assert_allclose(variances, .1)
+    # A linear map of another factor type is no AR(1) process.
+    params = [
+                setup_6obs3periods['trans_params'][0],
+                dict(setup_6obs3periods['trans_params'][1], gamma1 = .6,
+                     gamma2 = 0)
+             ]
+    assert 0 == len(Transition(params, [1, 1, 0]).autoregressive_factors()[0])
+
+def test_smoothed_means_equal_dense_posterior(setup_6obs3periods):
+    block = KalmanBlock(
+                        setup_6obs3periods['trans_obj'],
+                        setup_6obs3periods['meas_objs']
+                       )
+    prior = setup_6obs3periods['prior'][block.factors]
+    smoothed = block.smoothed_means(prior)
+    for obs in range(6):
+        mean, _ = _dense_posterior(
+                                    block, obs, prior[0, obs].mean(),
+                                    prior[0, obs].var()
+                                  )
+        assert_allclose(smoothed[0, obs], mean[1:])
+
+def test_draw_next_equals_dense_conditional(setup_6obs3periods):
+    block = KalmanBlock(
+                        setup_6obs3periods['trans_obj'],
+                        setup_6obs3periods['meas_objs']
+                       )
+    factors = np.random.RandomState(5).normal(size = (1, 6, 2))
+    for per in range(3):
+        draws = block.draw_next(factors, np.zeros((1, 6, 2)), per)
+        for obs in range(6):
+            # Given f_per, f_(per+1) does not depend on earlier periods.
+            mean, cov = _dense_posterior(block, obs, 0, 1e12)
+            for part in range(2):
+                expected = mean[per+1] + cov[per+1, per]/cov[per, per]*(
+                                                factors[0, obs, part]
+                                                - mean[per]
+                                                                        )
+                assert_allclose(draws[0, obs, part], expected, rtol = 1e-6)
+
+def test_hybrid_output(setup_6obs3periods):
+    setup = setup_6obs3periods
+    args = [
+            setup['params'], setup['meas_params'], setup['trans_params'],
+            setup['prior'], setup['trans_errors'], setup['meas_data'],
+            np.random.RandomState(3)
+           ]
+    estimates = kalman_hybrid_smoother(*args)
+    bootstrap = particle_smoother(*args)
+    assert estimates.index.equals(bootstrap.index)
+    assert list(estimates.columns) == list(bootstrap.columns)
+    assert np.all(np.isfinite(estimates.values))
+    block = KalmanBlock(setup['trans_obj'], setup['meas_objs'])
+    assert_allclose(
+                    estimates['fac2'].values.reshape(6, 3),
+                    block.smoothed_means(setup['prior'][[1]])[0]
+                   )
+
+@pytest.fixture
+def setup_simulated():
+    out = {}
+    rng = np.random.RandomState(0)
+    nr_obs, nr_per = 300, 8
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 1,
+                                'z': z, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                            for z in [1.0, 1.2]
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                          ]
+    trans = Transition(out['trans_params'], [1, 1, 0])
+    state = rng.normal(size = (3, nr_obs))
+    true_facs = []
+    for per in range(nr_per):
+        state = trans.next_state(state, rng.normal(size = (2, nr_obs)))
+        true_facs.append(state)
+    out['true_facs'] = np.array(true_facs)
+    index = pd.MultiIndex.from_product(
+                                        [range(1, nr_obs+1),
+                                         range(1, nr_per+1)]
+                                      )
+    out['meas_data'] = []
+    for fac in range(3):
+        factors = out['true_facs'][:, fac, :].T.ravel()
+        data = pd.DataFrame(
+                            0., index = index,
+                            columns = [
+                                        'control', 'control_2', 'meas1',
+                                        'meas2', 'meas3'
+                                      ]
+                           )
+        for eq, z in enumerate([1.0, 1.2]):
+            data['meas'+str(eq+1)] = z*factors + np.sqrt(.5)*rng.normal(
+                                                            size = len(index)
+                                                                        )
+        out['meas_data'].append(data)
+    out['rng'] = rng
+    return out
+
+def test_fac1_rmse_does_not_grow_with_particles(setup_simulated):
+    setup = setup_simulated
+    nr_per, _, nr_obs = setup['true_facs'].shape
+    rmse = []
+    for nr_parts in [10, 40, 160]:
+        params = {
+                    'n_particles': nr_parts, 'period': nr_per,
+                    'obs': nr_obs, 'rnd_seed': 1
+                 }
+        estimates = kalman_hybrid_smoother(
+                        params, setup['meas_params'], setup['trans_params'],
+                        setup['rng'].normal(size = (3, nr_obs, nr_parts)),
+                        setup['rng'].normal(size = (2, nr_obs, nr_per,
+                                                    nr_parts)),
+                        setup['meas_data'], np.random.RandomState(3)
+                                          )
+        diff = estimates['fac1'].values.reshape(nr_obs, nr_per) - (
+                                                setup['true_facs'][:, 0, :].T
+                                                                  )
+        rmse.append(np.sqrt(np.mean(diff**2)))
+    # The backward weights of the particles for fac1 include the look-ahead
+    # correction of the fac2 draws; more particles must not pick particles
+    # that fit the later measurements of fac2 worst.
+    assert np.all(np.diff(rmse) <= 0)
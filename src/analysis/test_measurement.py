@@ -3,7 +3,7 @@ import numpy as np
 import pandas as pd
 from numpy.testing import assert_allclose
 import pytest
-from measurement import Measurement
+from measurement import Measurement, MeasurementDimensionError
 from scipy.stats import norm
 
 if __name__ == '__main__':
@@ -51,4 +51,86 @@ def test_marginal_probability_2obs2parts(
     assert_allclose(
                         probs,
                         expected_2obs2parts_sameparams['probs']
-                   )
\ No newline at end of file
+                   )
+def test_log_marginal_probability_2obs2parts(
+                                            setup_2obs2parts_sameparams,
+                                            expected_2obs2parts_sameparams
+                                            ):
+    meas = setup_2obs2parts_sameparams['meas_obj']
+    log_probs = meas.log_marginal_probability(
+                                      setup_2obs2parts_sameparams['facs_data'],
+                                      1
+                                     )
+    assert_allclose(
+                        log_probs,
+                        np.log(expected_2obs2parts_sameparams['probs'])
+                   )
+
+@pytest.fixture
+def setup_collapsed_vs_per_equation():
+    out = {}
+    rng = np.random.RandomState(6)
+    params = [
+                {'beta1': 1, 'beta2': .5, 'z': 1.0, 'var': .5},
+                {'beta1': .3, 'beta2': 1, 'z': 1.2, 'var': .2},
+                {'beta1': 1, 'beta2': 1, 'z': -.8, 'var': 1.5}
+             ]
+    index = pd.MultiIndex.from_product([range(1, 5), range(1, 4)])
+    meas_data = pd.DataFrame(
+                                rng.normal(size = (12, 5)),
+                                index = index,
+                                columns = [
+                                            'control', 'control_2', 'meas1',
+                                            'meas2', 'meas3'
+                                          ]
+                            )
+    out['collapsed'] = Measurement(params, meas_data)
+    out['shuffled'] = Measurement(
+                                    params,
+                                    meas_data.iloc[rng.permutation(12), :]
+                                 )
+    out['per_equation'] = Measurement(params, meas_data, collapse = False)
+    out['facs_data'] = rng.normal(scale = 3, size = (4, 7))
+    return out
+
+def test_collapsed_equals_per_equation(setup_collapsed_vs_per_equation):
+    setup = setup_collapsed_vs_per_equation
+    for period in range(1, 4):
+        assert_allclose(
+                        setup['collapsed'].log_marginal_probability(
+                                                        setup['facs_data'],
+                                                        period
+                                                                   ),
+                        setup['per_equation'].log_marginal_probability(
+                                                        setup['facs_data'],
+                                                        period
+                                                                      )
+                       )
+
+def test_incomplete_data_raises_at_construction():
+    params = {'beta1': 1, 'beta2': 1, 'z': 1, 'var': 1}
+    meas_data = pd.DataFrame(
+                                {
+                                    'control': [1, 2, 3],
+                                    'control_2': [1, 1, 1],
+                                    'meas1': [0, 1, 2]
+                                },
+                                index = [[1, 1, 2], [1, 2, 1]]
+                            )
+    with pytest.raises(MeasurementDimensionError):
+        Measurement([params], meas_data)
+
+def test_dense_residuals_and_dimension_checks(setup_collapsed_vs_per_equation):
+    setup = setup_collapsed_vs_per_equation
+    meas = setup['collapsed']
+    assert meas.meas_res.shape == (3, 4, 3)
+    # Period lookup is a view of the residual array.
+    assert np.shares_memory(meas.meas_res[:, :, 1], meas.meas_res)
+    with pytest.raises(MeasurementDimensionError):
+        meas.log_marginal_probability(setup['facs_data'], 4)
+    with pytest.raises(MeasurementDimensionError):
+        meas.log_marginal_probability(setup['facs_data'][:3, :], 1)
+
+def test_row_order_of_data_irrelevant(setup_collapsed_vs_per_equation):
+    setup = setup_collapsed_vs_per_equation
+    assert_allclose(setup['shuffled'].meas_res, setup['collapsed'].meas_res)
@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from monte_carlo import RunningMoments, replication_seed, monte_carlo
+from monte_carlo import replicate, replicate_batch
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_study():
+    specs_dir = os.path.join(
+                            os.path.dirname(os.path.abspath(__file__)),
+                            '..', 'model_specs'
+                            )
+    out = {}
+    for name in ['measurements', 'transitions', 'true_prior']:
+        with open(
+                    os.path.join(specs_dir, name + '.json'),
+                    encoding = 'utf-8'
+                 ) as spec_file:
+            out[name] = json.load(spec_file)
+    out['fixed'] = {
+                    'rnd_seed': 5, 'n_particles': 6, 'draws_constant': 2,
+                    'draws_varying': 3, 'period': 3, 'obs': 20,
+                    'chunk_size': 0
+                   }
+    return out
+
+def _run(setup, replications, batch=1):
+    return monte_carlo(
+                        setup['fixed'], setup['measurements'],
+                        setup['transitions'], setup['true_prior'],
+                        replications, workers = 0, batch = batch
+                      )
+
+def test_running_moments():
+    values = np.random.RandomState(0).normal(size = (7, 3, 2))
+    moments = RunningMoments()
+    for value in values:
+        moments.update(value)
+    assert 7 == moments.count
+    assert_allclose(moments.mean, values.mean(axis = 0))
+    assert_allclose(moments.variance(), values.var(axis = 0, ddof = 1))
+    assert_allclose(
+                    moments.standard_error(),
+                    values.std(axis = 0, ddof = 1)/np.sqrt(7)
+                   )
+
+def test_replication_seeds_differ():
+    seeds = [replication_seed(12345, r) for r in range(50)]
+    assert len(set(seeds)) == 50
+    assert seeds[3] == replication_seed(12345, 3)
+
+def test_study_shapes(setup_study):
+    moments = _run(setup_study, 2)
+    assert set(moments) == {
+                            (spec, stat)
+                            for spec in ['rnd_prior', 'deg_prior']
+                            for stat in ['bias', 'rmse']
+                           }
+    for entry in moments.values():
+        assert 2 == entry.count
+        assert entry.mean.shape == (3, 3)
+    assert np.all(moments[('rnd_prior', 'rmse')].mean > 0)
+
+def test_study_reproducible(setup_study):
+    # Each replication is seeded from the seed of the study alone.
+    first = _run(setup_study, 1)
+    again = _run(setup_study, 1)
+    for key in first:
+        assert np.array_equal(first[key].mean, again[key].mean)
+
+def test_batched_study(setup_study):
+    moments = _run(setup_study, 3, batch = 2)
+    for entry in moments.values():
+        assert 3 == entry.count
+        assert entry.mean.shape == (3, 3)
+    # The degenerate prior holds the true (constant) fac3.
+    assert_allclose(moments[('deg_prior', 'rmse')].mean[:, 2], 0)
+
+@pytest.mark.parametrize('chunk_size', [0, 7])
+def test_batch_equals_single_replications(setup_study, chunk_size):
+    # Each replication resamples from its own streams in the batch.
+    fixed = dict(setup_study['fixed'], chunk_size = chunk_size)
+    args = (
+            fixed, setup_study['measurements'], setup_study['transitions'],
+            setup_study['true_prior']
+           )
+    batch = replicate_batch(range(1, 4), *args)
+    for r, tables in zip(range(1, 4), batch):
+        single = replicate(r, *args)
+        assert set(tables) == set(single)
+        for key in single:
+            assert_allclose(tables[key], single[key])
@@ -0,0 +1,82 @@
+import sys
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+from particle_history import ParticleHistory, ConstantFactors
+from resampling import gather_particles
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_3periods():
+    out = {}
+    rng = np.random.default_rng(3)
+    out['prior'] = rng.normal(size = (3, 4, 5))
+    out['states'] = rng.normal(size = (3, 3, 4, 5))
+    out['ancestors'] = rng.integers(0, 5, size = (3, 4, 5))
+    return out
+
+def test_particles_equal_resampled_copies(setup_3periods):
+    history = ParticleHistory(setup_3periods['prior'], [1, 1, 0])
+    copies = [setup_3periods['prior']]
+    for state, ancestors in zip(
+                                setup_3periods['states'],
+                                setup_3periods['ancestors']
+                               ):
+        # The constant factor is carried over from the resampled particles.
+        state[2, ...] = copies[-1][2, ...]
+        history.append(state, ancestors)
+        copies.append(gather_particles(state, ancestors))
+    assert len(history) == len(copies)
+    for per, copy in enumerate(copies):
+        assert_array_equal(history.particles(per), copy)
+    # Only the states of the distinct ancestors are stored.
+    for states, ancestors in zip(
+                                    history.states,
+                                    setup_3periods['ancestors']
+                                ):
+        distinct = sum(len(np.unique(row)) for row in ancestors)
+        assert states.shape == (2, distinct)
+    # Indices of five particles and codes of five values fit in one byte.
+    assert history.ancestors[0].dtype == np.uint8
+    assert history.codes[-1].dtype == np.uint8
+
+def test_broadcast_prior(setup_3periods):
+    prior = np.broadcast_to(setup_3periods['prior'][:, :, :1], (3, 4, 5))
+    history = ParticleHistory(prior, [1, 1, 0])
+    copied = ParticleHistory(prior.copy(), [1, 1, 0])
+    for state, ancestors in zip(
+                                setup_3periods['states'],
+                                setup_3periods['ancestors']
+                               ):
+        history.append(state, ancestors)
+        copied.append(state, ancestors)
+    for per in range(len(history)):
+        assert_array_equal(history.particles(per), copied.particles(per))
+
+def test_constant_factors_of_cartesian_prior():
+    # Three draws of the constant factor, each combined with four draws of
+    # the non-constant factors.
+    rng = np.random.default_rng(5)
+    prior = rng.normal(size = (3, 2, 12))
+    prior[2, ...] = np.tile(rng.normal(size = (2, 3)), 4)
+    constants = ConstantFactors.from_particles(prior, [2])
+    assert constants.values.shape == (1, 2, 3)
+    assert_array_equal(constants.broadcast(constants.values[0]), prior[2])
+    lineage = rng.integers(0, 12, size = (2, 12))
+    assert_array_equal(
+                    constants.select(lineage).broadcast(constants.values[0]),
+                    np.take_along_axis(prior[2], lineage, 1)
+                      )
+
+def test_constant_factors_of_degenerate_prior():
+    prior = np.arange(6.).reshape(3, 2, 1)
+    constants = ConstantFactors.from_particles(prior, [2], nr_parts = 4)
+    assert constants.values.shape == (1, 2, 1)
+    assert constants.codes.shape == (2, 4)
+    assert_array_equal(
+                    constants.broadcast(constants.values[0]),
+                    np.repeat(prior[2], 4, axis = 1)
+                      )
@@ -0,0 +1,299 @@
+import json
+import sys
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+import pytest
+from particle_smoother import particle_smoother, chunked_particle_smoother
+from particle_smoother import replicated_particle_smoother, fold_replications
+from particle_smoother import SmootherModel, smooth_specs, SmootherResult
+from particle_smoother import _draw_part
+from parallel_smoother import parallel_particle_smoother
+from random_streams import CounterTransitionErrors
+from initial_draws import PriorSampler
+from artifacts import save_array, load_array, save_frame
+from prepare_data import MeasurementManifest
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_6obs3periods():
+    out = {}
+    rng = np.random.RandomState(1)
+    nr_obs, nr_per, nr_parts = 6, 3, 8
+    out['params'] = {
+                        'n_particles': nr_parts, 'period': nr_per,
+                        'obs': nr_obs, 'rnd_seed': 1
+                    }
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 1,
+                                'z': 1.0, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                          ]
+    index = pd.MultiIndex.from_product(
+                                        [range(1, nr_obs+1),
+                                         range(1, nr_per+1)]
+                                      )
+    out['meas_data'] = [
+                        pd.DataFrame(
+                                        rng.normal(size = (len(index), 5)),
+                                        index = index,
+                                        columns = [
+                                                    'control', 'control_2',
+                                                    'meas1', 'meas2', 'meas3'
+                                                  ]
+                                    )
+                        for fac in range(3)
+                       ]
+    out['prior'] = rng.normal(size = (3, nr_obs, nr_parts))
+    out['trans_errors'] = rng.normal(size = (2, nr_obs, nr_per, nr_parts))
+    return out
+
+def _run(setup, chunk_size=None):
+    np.random.seed(setup['params']['rnd_seed'])
+    args = [
+            setup['params'], setup['meas_params'], setup['trans_params'],
+            setup['prior'], setup['trans_errors']
+           ]
+    if chunk_size is None:
+        return particle_smoother(*args, meas_data = setup['meas_data'])
+    return chunked_particle_smoother(
+                                        *args, chunk_size,
+                                        meas_data = setup['meas_data']
+                                    )
+
+def test_particle_smoother_shape(setup_6obs3periods):
+    estimates = _run(setup_6obs3periods)
+    assert estimates.shape == (18, 3)
+    assert list(estimates.columns) == ['fac1', 'fac2', 'fac3']
+    assert np.all(np.isfinite(estimates.values))
+
+def test_chunked_single_chunk_equals_unchunked(setup_6obs3periods):
+    assert_allclose(
+                    _run(setup_6obs3periods, chunk_size = 6).values,
+                    _run(setup_6obs3periods).values
+                   )
+
+def test_chunked_index(setup_6obs3periods):
+    estimates = _run(setup_6obs3periods, chunk_size = 4)
+    expected = pd.MultiIndex.from_product([range(1, 7), range(1, 4)])
+    assert estimates.index.equals(expected)
+    # The constant factor is estimated identically in every period.
+    fac3 = estimates['fac3'].unstack(level = 1).values
+    assert_allclose(fac3, np.tile(fac3[:, :1], (1, 3)))
+
+def test_parallel_independent_of_workers(setup_6obs3periods):
+    setup = setup_6obs3periods
+    params = dict(setup['params'], chunk_size = 2)
+    args = [
+            params, setup['meas_params'], setup['trans_params'],
+            setup['prior'], setup['trans_errors']
+           ]
+    serial = chunked_particle_smoother(
+                                        *args, 2,
+                                        meas_data = setup['meas_data'],
+                                        seed = params['rnd_seed']
+                                      )
+    for workers in [1, 2]:
+        parallel = parallel_particle_smoother(
+                                        *args, workers,
+                                        meas_data = setup['meas_data']
+                                             )
+        assert np.array_equal(parallel.values, serial.values)
+        assert parallel.index.equals(serial.index)
+
+def test_counter_errors_equal_stored_errors(setup_6obs3periods):
+    setup = dict(setup_6obs3periods)
+    counter = CounterTransitionErrors(1, (2, 6, 3, 8), shard_size = 4)
+    setup['trans_errors'] = counter
+    lazy = _run(setup, chunk_size = 4)
+    setup['trans_errors'] = np.stack(
+                                [counter.period(per) for per in range(3)],
+                                axis = 2
+                                    )
+    stored = _run(setup, chunk_size = 4)
+    assert np.array_equal(lazy.values, stored.values)
+
+def test_parallel_counter_errors(setup_6obs3periods):
+    setup = setup_6obs3periods
+    params = dict(setup['params'], chunk_size = 2)
+    args = [
+            params, setup['meas_params'], setup['trans_params'],
+            setup['prior'], CounterTransitionErrors(1, (2, 6, 3, 8))
+           ]
+    serial = chunked_particle_smoother(
+                                        *args, 2,
+                                        meas_data = setup['meas_data'],
+                                        seed = params['rnd_seed']
+                                      )
+    parallel = parallel_particle_smoother(
+                                        *args, 2,
+                                        meas_data = setup['meas_data']
+                                         )
+    assert np.array_equal(parallel.values, serial.values)
+
+def test_lazy_prior(setup_6obs3periods):
+    setup = dict(setup_6obs3periods)
+    fixed = {
+                'obs': 6, 'rnd_seed': 1, 'draws_varying': 4,
+                'draws_constant': 2
+            }
+    sampler = PriorSampler(np.eye(2), 0.2, fixed, shard_size = 4)
+    setup['prior'] = sampler
+    lazy = _run(setup, chunk_size = 4)
+    setup['prior'] = sampler.sample()
+    stored = _run(setup, chunk_size = 4)
+    assert np.array_equal(lazy.values, stored.values)
+    params = dict(setup['params'], chunk_size = 4)
+    parallel = parallel_particle_smoother(
+                                params, setup['meas_params'],
+                                setup['trans_params'], sampler,
+                                setup['trans_errors'], 2,
+                                meas_data = setup['meas_data']
+                                         )
+    serial = chunked_particle_smoother(
+                                params, setup['meas_params'],
+                                setup['trans_params'], sampler,
+                                setup['trans_errors'], 4,
+                                meas_data = setup['meas_data'], seed = 1
+                                      )
+    assert np.array_equal(parallel.values, serial.values)
+
+def test_degenerate_prior_not_replicated(setup_6obs3periods):
+    setup = dict(setup_6obs3periods)
+    setup['prior'] = setup['prior'][:, :, :1]
+    compact = _run(setup, chunk_size = 4)
+    setup['prior'] = np.repeat(setup['prior'], 8, axis = 2)
+    assert np.array_equal(compact.values, _run(setup, chunk_size = 4).values)
+
+def test_parallel_memory_mapped_inputs(setup_6obs3periods, tmp_path):
+    setup = setup_6obs3periods
+    params = dict(setup['params'], chunk_size = 4)
+    for key in ['prior', 'trans_errors']:
+        save_array(str(tmp_path / key), setup[key])
+    args = [params, setup['meas_params'], setup['trans_params']]
+    mapped = parallel_particle_smoother(
+                                *args, load_array(str(tmp_path / 'prior')),
+                                load_array(str(tmp_path / 'trans_errors')), 2,
+                                meas_data = setup['meas_data']
+                                       )
+    in_memory = parallel_particle_smoother(
+                                *args, setup['prior'], setup['trans_errors'],
+                                2, meas_data = setup['meas_data']
+                                          )
+    assert np.array_equal(mapped.values, in_memory.values)
+
+def test_chunked_measurement_shards(setup_6obs3periods, tmp_path):
+    setup = dict(setup_6obs3periods)
+    shards = []
+    for nr, caseids in enumerate([[1, 2, 3, 4], [5, 6]]):
+        files = {}
+        for f, data in zip(['fac1', 'fac2', 'fac3'], setup['meas_data']):
+            files[f] = 'meas_{}_shard_{}'.format(f, nr)
+            save_frame(str(tmp_path / files[f]), data.loc[caseids])
+        shards.append({'nr_obs': len(caseids), 'files': files})
+    path = tmp_path / 'meas_manifest.json'
+    path.write_text(json.dumps({'shards': shards}))
+    in_memory = _run(setup, chunk_size = 3)
+    setup['meas_data'] = MeasurementManifest(str(path))
+    sharded = _run(setup, chunk_size = 3)
+    assert np.array_equal(sharded.values, in_memory.values)
+    assert sharded.index.equals(in_memory.index)
+
+def test_fold_replications():
+    array = np.arange(2*3*4*5).reshape(2, 3, 4, 5)
+    folded = fold_replications(array)
+    assert folded.shape == (3, 8, 5)
+    assert np.array_equal(folded[:, 4:, :], array[1])
+
+def test_replicated_equals_stacked_observations(setup_6obs3periods):
+    # Two replications of three observations (the second one with caseids
+    # 11, 12, 13) are smoothed as the six observations of the setup.
+    setup = setup_6obs3periods
+    meas_data = [
+        [data.loc[[1, 2, 3]] for data in setup['meas_data']],
+        [
+            data.loc[[4, 5, 6]].rename(index = {4: 11, 5: 12, 6: 13})
+            for data in setup['meas_data']
+        ]
+                ]
+    split = lambda array: np.stack([array[:, :3], array[:, 3:]])
+    np.random.seed(setup['params']['rnd_seed'])
+    estimates = replicated_particle_smoother(
+                            setup['params'], setup['meas_params'],
+                            setup['trans_params'], split(setup['prior']),
+                            split(setup['trans_errors']), meas_data
+                                            )
+    expected = _run(setup)
+    assert list(estimates.index.names) == ['replication', 'caseid', 't']
+    assert list(estimates.loc[1].index.unique(level = 0)) == [11, 12, 13]
+    assert np.array_equal(estimates.values, expected.values)
+
+def test_smooth_specs_share_model(setup_6obs3periods):
+    setup = setup_6obs3periods
+    model = SmootherModel(
+                            setup['params'], setup['meas_params'],
+                            setup['trans_params'], setup['meas_data']
+                         )
+    priors = {
+                'rnd_prior': setup['prior'],
+                'deg_prior': setup['prior'][:, :, :1]
+             }
+    sequential = smooth_specs(model, priors, setup['trans_errors'], 1)
+    concurrent = smooth_specs(
+                                model, priors, setup['trans_errors'], 1,
+                                threads = 2
+                             )
+    assert list(concurrent) == ['rnd_prior', 'deg_prior']
+    # Each specification equals smoothing it alone with the same seed.
+    assert np.array_equal(
+                    sequential['rnd_prior'].to_frame().values,
+                    _run(setup).values
+                         )
+    for spec in priors:
+        assert np.array_equal(
+                    sequential[spec].estimates, concurrent[spec].estimates
+                             )
+
+def test_draw_part():
+    rng = np.random.RandomState(3)
+    weights = np.full((5, 4), -np.inf)
+    weights[np.arange(5), [0, 3, 1, 2, 3]] = rng.normal(size = 5)
+    parts = rng.normal(size = (3, 5, 4))
+    # Only the particle with finite weight can be drawn.
+    expected = parts[:, np.arange(5), [0, 3, 1, 2, 3]]
+    assert np.array_equal(_draw_part(weights, parts, rng), expected)
+
+def test_result_frame_roundtrip(setup_6obs3periods):
+    frame = _run(setup_6obs3periods)
+    result = SmootherResult.from_frame(frame)
+    assert result.estimates.shape == (3, 3, 6)
+    assert np.array_equal(result.to_frame().values, frame.values)
+    assert result.to_frame().index.equals(frame.index)
+    assert np.array_equal(
+                    result.observations([2, 5])[:, 0, 1],
+                    frame.loc[5, 'fac1'].values
+                         )
+    # Unknown caseids, between, before and after the known ones.
+    for caseids in [[2, 2.5], [0], [7]]:
+        with pytest.raises(KeyError):
+            result.observations(caseids)
+
+def test_unique_particles_equal_full_particles(setup_6obs3periods):
+    full = _run(setup_6obs3periods)
+    setup_6obs3periods['params']['particles'] = 'unique'
+    assert_allclose(_run(setup_6obs3periods).values, full.values)
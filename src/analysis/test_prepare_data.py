@@ -0,0 +1,136 @@
+import json
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from prepare_data import OrderedTable, MeasurementManifest, TableOrderError
+from prepare_data import _measurement_frames
+from artifacts import save_frame
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+def _chunks(ids, size):
+    for start in range(0, len(ids), size):
+        yield {
+                'caseid': ids[start:start+size],
+                'value': 10*ids[start:start+size]
+              }
+
+@pytest.fixture
+def setup_tables():
+    out = {}
+    caseids = np.array([1, 2, 3])
+    periods = np.array([1, 2])
+    case_ids = np.repeat(caseids, 2)
+    t = np.tile(periods, 3)
+    out['case'] = {
+                    'caseid': case_ids, 't': t,
+                    'fac1': case_ids*100 + 10 + t,
+                    'fac2': case_ids*100 + 20 + t,
+                    'fac3': case_ids*100 + 38,
+                    'x1': case_ids*10 + 1, 'x2': case_ids*10 + 2
+                  }
+    factor_ids = np.sort(np.concatenate([
+                                    out['case']['fac1'], out['case']['fac2'],
+                                    caseids*100 + 38
+                                        ]))
+    rng = np.random.RandomState(0)
+    out['factor'] = {
+                        'factor_id': factor_ids,
+                        'meas1': rng.normal(size = len(factor_ids)),
+                        'meas2': rng.normal(size = len(factor_ids)),
+                        'meas3': rng.normal(size = len(factor_ids))
+                    }
+    cont_ids = np.sort(np.concatenate([caseids*10 + 1, caseids*10 + 2]))
+    out['control'] = {
+                        'cont_id': cont_ids,
+                        'control': np.where(cont_ids % 10 == 2, 1., .5)
+                     }
+    return out
+
+def test_ordered_table_takes_rows_in_order():
+    ids = np.array([1, 1, 2, 3, 3, 3, 5, 8])
+    table = OrderedTable(_chunks(ids, 3), 'caseid')
+    assert table.next_bound(2) == 3
+    first = table.take_before(3)
+    assert np.array_equal(first['caseid'], [1, 1, 2])
+    assert np.array_equal(first['value'], [10, 10, 20])
+    assert table.next_bound(2) == 8
+    assert np.array_equal(table.take_before(8)['caseid'], [3, 3, 3, 5])
+    assert table.next_bound(2) is None
+    assert np.array_equal(table.take_before(None)['caseid'], [8])
+
+def test_ordered_table_rejects_unordered_ids():
+    table = OrderedTable(_chunks(np.array([1, 2, 4, 3]), 3), 'caseid')
+    with pytest.raises(TableOrderError):
+        table.take_before(None)
+
+def test_measurement_frames(setup_tables):
+    frames = _measurement_frames(
+                                    setup_tables['factor'],
+                                    setup_tables['case'],
+                                    setup_tables['control']
+                                )
+    assert [len(frame) for frame in frames] == [6, 6, 3]
+    factor = pd.DataFrame(setup_tables['factor']).set_index('factor_id')
+    row = frames[1].loc[(2, 2)]
+    assert row['meas2'] == factor.loc[222, 'meas2']
+    assert row['control'] == .5 and row['control_2'] == 1
+
+def test_manifest_loads_ranges_across_shards(setup_tables, tmp_path):
+    frames = _measurement_frames(
+                                    setup_tables['factor'],
+                                    setup_tables['case'],
+                                    setup_tables['control']
+                                )
+    shards = []
+    for nr, caseids in enumerate([[1, 2], [3]]):
+        files = {}
+        for f, frame in zip(['fac1', 'fac2', 'fac3'], frames):
+            files[f] = 'meas_{}_shard_{}'.format(f, nr)
+            save_frame(str(tmp_path / files[f]), frame.loc[caseids])
+        shards.append({
+                        'first_caseid': caseids[0],
+                        'last_caseid': caseids[-1],
+                        'nr_obs': len(caseids), 'files': files
+                      })
+    path = tmp_path / 'meas_manifest.json'
+    path.write_text(json.dumps({'shard_size': 2, 'shards': shards}))
+    manifest = MeasurementManifest(str(path))
+    assert manifest.nr_obs == 3
+    for loaded, frame in zip(manifest.load(1, 3), frames):
+        pd.testing.assert_frame_equal(loaded, frame.loc[[2, 3]])
+
+def test_duplicates_dropped_within_caseid(setup_tables):
+    # Caseids 1 and 3 refer to missing factors and controls, so all their
+    # rows of fac1 are missing values: repeated within each caseid, but
+    # kept once per caseid.
+    case = dict(setup_tables['case'])
+    missing = np.isin(case['caseid'], [1, 3])
+    case['fac1'] = np.where(missing, 999, case['fac1'])
+    for c in ['x1', 'x2']:
+        case[c] = np.where(missing, 99, case[c])
+    frames = _measurement_frames(
+                                    setup_tables['factor'], case,
+                                    setup_tables['control']
+                                )
+    assert list(frames[0].index) == [(1, 1), (2, 1), (2, 2), (3, 1)]
+    assert frames[0].loc[[1, 3]].isnull().all(axis = None)
+    # The constant fac3 repeats its measurements in both periods.
+    assert list(frames[2].index) == [(1, 1), (2, 1), (3, 1)]
+    # Shards of caseids give the same rows.
+    shards = [
+                _measurement_frames(
+                    setup_tables['factor'],
+                    {key: column[rows] for key, column in case.items()},
+                    setup_tables['control']
+                                   )
+                for rows in [case['caseid'] < 3, case['caseid'] == 3]
+             ]
+    for nr, frame in enumerate(frames):
+        pd.testing.assert_frame_equal(
+                                pd.concat([shard[nr] for shard in shards]),
+                                frame
+                                     )
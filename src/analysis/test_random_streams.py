@@ -0,0 +1,70 @@
+import sys
+import numpy as np
+import pytest
+from random_streams import CounterTransitionErrors, period_errors
+from random_streams import counter_normals, StackedGenerator
+from random_streams import shard_seeds, shard_generator
+from numpy.testing import assert_array_equal
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_counter_errors():
+    out = {}
+    out['shape'] = (2, 7, 3, 5)
+    out['errors'] = CounterTransitionErrors(12345, out['shape'], shard_size=3)
+    return out
+
+def test_counter_errors_shape(setup_counter_errors):
+    errors = setup_counter_errors['errors']
+    for per in range(3):
+        assert errors.period(per).shape == (2, 7, 5)
+
+def test_counter_errors_reproducible(setup_counter_errors):
+    errors = setup_counter_errors['errors']
+    again = CounterTransitionErrors(12345, setup_counter_errors['shape'], 3)
+    for per in [2, 0, 1]:
+        assert np.array_equal(errors.period(per), again.period(per))
+
+def test_counter_errors_independent_of_blocks(setup_counter_errors):
+    errors = setup_counter_errors['errors']
+    full = errors.period(1)
+    for start, stop in [(0, 2), (2, 5), (5, 7), (1, 7)]:
+        assert np.array_equal(
+                                errors.observations(start, stop).period(1),
+                                full[:, start:stop, :]
+                             )
+    nested = errors.observations(1, 6).observations(2, 4)
+    assert np.array_equal(nested.period(1), full[:, 3:5, :])
+
+def test_counter_errors_differ_over_periods_and_shards():
+    first = period_errors(1, 0, 0, (2, 3, 4))
+    assert not np.array_equal(first, period_errors(1, 0, 1, (2, 3, 4)))
+    assert not np.array_equal(first, period_errors(1, 1, 0, (2, 3, 4)))
+    assert not np.array_equal(first, period_errors(2, 0, 0, (2, 3, 4)))
+
+def test_counter_normals_rows():
+    for row_length in [4, 5, 9]:
+        full = counter_normals([1, 2], [0, 3, 0], 0, 9, row_length)
+        assert full.shape == (9, row_length)
+        assert np.array_equal(
+                    counter_normals([1, 2], [0, 3, 0], 4, 3, row_length),
+                    full[4:7]
+                             )
+    assert np.array_equal(
+                            period_errors(1, 0, 0, (2, 2, 4), first = 1),
+                            period_errors(1, 0, 0, (2, 3, 4))[:, 1:, :]
+                         )
+
+def test_stacked_generator_draws_blocks_from_own_streams():
+    seqs = shard_seeds(3, 2)
+    stacked = StackedGenerator([shard_generator(seq) for seq in seqs], [2, 3])
+    draws = stacked.standard_exponential((5, 4))
+    alone = [shard_generator(seq) for seq in seqs]
+    assert_array_equal(draws[:2], alone[0].standard_exponential((2, 4)))
+    assert_array_equal(draws[2:], alone[1].standard_exponential((3, 4)))
+    assert stacked.random((5, 1)).shape == (5, 1)
+    with pytest.raises(ValueError):
+        stacked.random((4, 1))
@@ -0,0 +1,233 @@
+import sys
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+import pytest
+from rao_blackwell import rao_blackwellized_smoother, particles_for_equal_rmse
+from rao_blackwell import equal_rmse_table
+from rao_blackwell import _support_distribution
+from particle_smoother import particle_smoother
+from particle_history import ConstantFactors
+from transition import Transition
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_6obs3periods():
+    out = {}
+    rng = np.random.RandomState(2)
+    nr_obs, nr_per, nr_parts = 6, 3, 8
+    out['params'] = {
+                        'n_particles': nr_parts, 'period': nr_per,
+                        'obs': nr_obs, 'rnd_seed': 1
+                    }
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 1,
+                                'z': 1.0, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                          ]
+    index = pd.MultiIndex.from_product(
+                                        [range(1, nr_obs+1),
+                                         range(1, nr_per+1)]
+                                      )
+    out['meas_data'] = [
+                        pd.DataFrame(
+                                        rng.normal(size = (len(index), 5)),
+                                        index = index,
+                                        columns = [
+                                                    'control', 'control_2',
+                                                    'meas1', 'meas2', 'meas3'
+                                                  ]
+                                    )
+                        for fac in range(3)
+                       ]
+    # Cartesian product of 4 draws of fac1 and fac2 with 2 draws of fac3,
+    # as drawn by initial_draws.PriorSampler.
+    prior = np.empty((3, nr_obs, nr_parts))
+    prior[:2, ...] = np.repeat(rng.normal(size = (2, nr_obs, 4)), 2, axis = 2)
+    prior[2, ...] = np.tile(rng.normal(size = (nr_obs, 2)), (1, 4))
+    out['prior'] = prior
+    out['trans_errors'] = rng.normal(size = (2, nr_obs, nr_per, nr_parts))
+    return out
+
+def _run(setup, smoother, prior):
+    return smoother(
+                    setup['params'], setup['meas_params'],
+                    setup['trans_params'], prior, setup['trans_errors'],
+                    setup['meas_data'], np.random.RandomState(3)
+                   )
+
+def test_degenerate_prior_equals_bootstrap(setup_6obs3periods):
+    # With one value of fac3 per observation, there is nothing to integrate
+    # out and both smoothers use the same random numbers, so the forward
+    # iterations and the estimates of the last period are the same (earlier
+    # periods are weighted with the filter density in addition).
+    prior = setup_6obs3periods['prior'][:, :, :1]
+    estimates, bootstrap = [
+                    _run(setup_6obs3periods, smoother, prior).xs(3, level = 1)
+                    for smoother in [
+                                    rao_blackwellized_smoother,
+                                    particle_smoother
+                                    ]
+                           ]
+    assert_allclose(estimates.values, bootstrap.values)
+
+def test_output_format(setup_6obs3periods):
+    prior = setup_6obs3periods['prior']
+    estimates = _run(setup_6obs3periods, rao_blackwellized_smoother, prior)
+    bootstrap = _run(setup_6obs3periods, particle_smoother, prior)
+    assert estimates.index.equals(bootstrap.index)
+    assert list(estimates.columns) == list(bootstrap.columns)
+    assert np.all(np.isfinite(estimates.values))
+    # fac3 is one of the prior values of its observation in all periods.
+    fac3 = estimates['fac3'].values.reshape(6, 3)
+    assert np.all(fac3 == fac3[:, :1])
+    assert np.all(np.any(fac3[:, :1] == prior[2, ...], axis = 1))
+
+@pytest.fixture
+def setup_simulated():
+    out = {}
+    rng = np.random.RandomState(0)
+    nr_obs, nr_per = 100, 8
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 1,
+                                'z': z, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                            for z in [1.0, 1.2]
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                          ]
+    trans = Transition(out['trans_params'], [1, 1, 0])
+    state = rng.normal(size = (3, nr_obs))
+    true_facs = []
+    for per in range(nr_per):
+        state = trans.next_state(state, rng.normal(size = (2, nr_obs)))
+        true_facs.append(state)
+    out['true_facs'] = np.array(true_facs)
+    index = pd.MultiIndex.from_product(
+                                        [range(1, nr_obs+1),
+                                         range(1, nr_per+1)]
+                                      )
+    out['meas_data'] = []
+    for fac in range(3):
+        factors = out['true_facs'][:, fac, :].T.ravel()
+        data = pd.DataFrame(
+                            0., index = index,
+                            columns = [
+                                        'control', 'control_2', 'meas1',
+                                        'meas2', 'meas3'
+                                      ]
+                           )
+        for eq, z in enumerate([1.0, 1.2]):
+            data['meas'+str(eq+1)] = z*factors + np.sqrt(.5)*rng.normal(
+                                                            size = len(index)
+                                                                        )
+        out['meas_data'].append(data)
+    out['rng'] = rng
+    return out
+
+def test_rmse_does_not_grow_with_particles(setup_simulated):
+    setup = setup_simulated
+    nr_per, _, nr_obs = setup['true_facs'].shape
+    draws_constant = 10
+    rmse = []
+    for draws in [5, 20]:
+        nr_parts = draws*draws_constant
+        # Cartesian prior as drawn by initial_draws.PriorSampler.
+        prior = np.empty((3, nr_obs, nr_parts))
+        prior[:2, ...] = np.repeat(
+                                    setup['rng'].normal(
+                                                size = (2, nr_obs, draws)
+                                                       ),
+                                    draws_constant, axis = 2
+                                  )
+        prior[2, ...] = np.tile(
+                            setup['rng'].normal(
+                                            size = (nr_obs, draws_constant)
+                                               ),
+                            (1, draws)
+                               )
+        params = {
+                    'n_particles': nr_parts, 'period': nr_per,
+                    'obs': nr_obs, 'rnd_seed': 1
+                 }
+        estimates = rao_blackwellized_smoother(
+                        params, setup['meas_params'], setup['trans_params'],
+                        prior,
+                        setup['rng'].normal(size = (2, nr_obs, nr_per,
+                                                    nr_parts)),
+                        setup['meas_data'], np.random.RandomState(3)
+                                              )
+        diff = estimates.values.reshape(nr_obs, nr_per, 3) - np.moveaxis(
+                                            setup['true_facs'], 2, 0
+                                                                         )
+        rmse.append(np.sqrt(np.mean(diff**2, axis = (0, 1))))
+    # More particles must not give worse estimates of fac1 and fac2.
+    assert np.all(rmse[1][:2] <= rmse[0][:2])
+
+def test_support_distribution():
+    particles = np.zeros((3, 2, 4))
+    particles[2, ...] = [[1, 2, 1, 1], [5, 5, 5, 5]]
+    constants = ConstantFactors.from_particles(particles, np.array([2]))
+    assert_allclose(
+                    np.exp(_support_distribution(constants, 4)),
+                    [[.75, .25], [1, 0]]
+                   )
+
+def test_particles_for_equal_rmse():
+    table = pd.DataFrame(
+                            {
+                                'fac1': [.5, .3, .45, .3],
+                                'fac2': [.5, .3, .45, .3],
+                                'fac3': [.5, .4, .3, .2]
+                            },
+                            index = pd.MultiIndex.from_product(
+                                        [['bootstrap', 'rao_blackwell'],
+                                         [10, 20]]
+                                                              )
+                        )
+    assert particles_for_equal_rmse(table, 20) == {
+                            'bootstrap': {'fac1': 20, 'fac2': 20, 'fac3': 20},
+                            'rao_blackwell': {'fac1': 20, 'fac2': 20,
+                                              'fac3': 10}
+                                                  }
+    assert particles_for_equal_rmse(table, 10) == {
+                            'bootstrap': {'fac1': 10, 'fac2': 10, 'fac3': 10},
+                            'rao_blackwell': {'fac1': 10, 'fac2': 10,
+                                              'fac3': 10}
+                                                  }
+    # Without its run with 20 particles, rao_blackwell never reaches the
+    # RMSE of fac1 and fac2 of the bootstrap smoother with 20, whatever its
+    # gain in fac3.
+    equal = equal_rmse_table(table.drop(('rao_blackwell', 20)), 20)
+    assert list(equal.index) == ['bootstrap', 'rao_blackwell']
+    assert list(equal.columns) == ['fac1', 'fac2', 'fac3', 'reference']
+    assert list(equal.loc['bootstrap', ['fac1', 'fac2', 'fac3']]) == [20]*3
+    assert pd.isna(equal.loc['rao_blackwell', 'fac1'])
+    assert pd.isna(equal.loc['rao_blackwell', 'fac2'])
+    assert equal.loc['rao_blackwell', 'fac3'] == 10
+    assert list(equal['reference']) == [20, 20]
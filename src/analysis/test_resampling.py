@@ -0,0 +1,107 @@
+import sys
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import pytest
+from resampling import resample, resample_log, log_normalize, draw_log
+from resampling import gather_particles, UniqueAncestors, SCHEMES
+from resampling import ResamplingSchemeError
+from particle_smoother import _construct_new_particles
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_3obs4parts():
+    out = {}
+    out['weights'] = np.array(
+                                [[.5, .25, .25, 0],
+                                 [0, 0, 1, 0],
+                                 [.1, .2, .3, .4]]
+                             )
+    out['particles'] = np.arange(3*3*4, dtype=float).reshape((3, 3, 4))
+    out['rng'] = np.random.default_rng(12345)
+    return out
+
+@pytest.mark.parametrize('scheme', sorted(SCHEMES))
+def test_resample_indices_valid(setup_3obs4parts, scheme):
+    weights = setup_3obs4parts['weights']
+    indices = resample(weights, scheme, setup_3obs4parts['rng'])
+    assert indices.shape == weights.shape
+    assert np.all(np.diff(indices, axis=1) >= 0)
+    # Particles with zero weight are never drawn.
+    assert np.all(np.take_along_axis(weights, indices, 1) > 0)
+    assert_array_equal(indices[1, :], 2)
+
+@pytest.mark.parametrize('scheme', sorted(SCHEMES))
+def test_resample_mean_counts(scheme):
+    rng = np.random.default_rng(54321)
+    weights = np.tile(np.array([.1, .2, .3, .4]), (20000, 1))
+    indices = resample(weights, scheme, rng)
+    counts = np.bincount(indices.ravel(), minlength=4) / indices.size
+    assert_allclose(counts, weights[0, :], atol=.01)
+
+def test_systematic_uniform_weights():
+    weights = np.ones((2, 5))
+    indices = resample(weights, 'systematic', np.random.default_rng(1))
+    assert_array_equal(indices, np.tile(np.arange(5), (2, 1)))
+
+def test_residual_exact_multiples(setup_3obs4parts):
+    weights = setup_3obs4parts['weights'][:2, :]
+    indices = resample(weights, 'residual', setup_3obs4parts['rng'])
+    assert_array_equal(indices, np.array([[0, 0, 1, 2], [2, 2, 2, 2]]))
+
+@pytest.mark.parametrize('scheme', sorted(SCHEMES))
+def test_gather_equals_reference(setup_3obs4parts, scheme):
+    weights = setup_3obs4parts['weights']
+    particles = setup_3obs4parts['particles']
+    indices = resample(weights, scheme, setup_3obs4parts['rng'])
+    counts = np.array([np.bincount(row, minlength=4) for row in indices])
+    reference = _construct_new_particles(counts, particles)
+    # The reference fills positions round-robin over the ancestors, so new
+    # particles are compared up to their order within each observation.
+    order = np.argsort(reference[0, ...], axis=1)[np.newaxis, ...]
+    assert_array_equal(
+                        gather_particles(particles, indices),
+                        np.take_along_axis(reference, order, 2)
+                      )
+
+def test_log_normalize():
+    log_weights = np.log(np.array([[1., 3.], [2., 2.]])) - 1000
+    assert_allclose(
+                        np.exp(log_normalize(log_weights)),
+                        np.array([[.25, .75], [.5, .5]])
+                   )
+
+def test_resample_log_no_underflow(setup_3obs4parts):
+    # Weights of exp(-1000) underflow to zero outside of the log-domain.
+    log_weights = np.array([[-1000., -1000., -np.inf, -np.inf]])
+    indices = resample_log(log_weights, 'systematic', setup_3obs4parts['rng'])
+    assert np.all(indices < 2)
+    assert_array_equal(np.bincount(indices[0, :], minlength=4), [2, 2, 0, 0])
+
+def test_draw_log_frequencies():
+    rng = np.random.default_rng(2468)
+    log_weights = np.tile(
+                            np.append(np.log([.1, .2, .3, .4]), -np.inf),
+                            (20000, 1)
+                         )
+    indices = draw_log(log_weights - 1000, rng)
+    assert indices.shape == (20000,)
+    counts = np.bincount(indices, minlength=5) / indices.size
+    assert_allclose(counts, [.1, .2, .3, .4, 0], atol=.01)
+
+def test_unknown_scheme(setup_3obs4parts):
+    with pytest.raises(ResamplingSchemeError):
+        resample(setup_3obs4parts['weights'], 'unknown')
+
+def test_unique_ancestors(setup_3obs4parts):
+    particles = setup_3obs4parts['particles']
+    indices = np.array([[0, 0, 2, 2], [1, 1, 1, 1], [0, 1, 2, 3]])
+    unique = UniqueAncestors(indices)
+    assert 7 == len(unique)
+    assert_array_equal(unique.ancestors, [0, 2, 1, 0, 1, 2, 3])
+    assert_array_equal(
+                        unique.expand(unique.compress(particles)),
+                        gather_particles(particles, indices)
+                      )
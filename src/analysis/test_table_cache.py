@@ -0,0 +1,56 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from table_cache import load_table, cache_directory, lookup, gather
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_table(tmp_path):
+    out = {}
+    out['path'] = str(tmp_path / 'table.dta')
+    out['cache'] = str(tmp_path / 'cache')
+    out['table'] = pd.DataFrame({
+                                    'cont_id': np.array([12, 11, 22, 21],
+                                                        dtype = np.int32),
+                                    'control': np.array([1, .3, 1, .7],
+                                                        dtype = np.float32)
+                                })
+    out['table'].to_stata(out['path'], write_index = False)
+    return out
+
+def test_load_table_from_cache(setup_table):
+    columns = load_table(setup_table['path'], setup_table['cache'])
+    assert list(columns) == ['cont_id', 'control']
+    for name, column in columns.items():
+        assert np.array_equal(column, setup_table['table'][name].values)
+    assert os.path.isdir(
+                cache_directory(setup_table['path'], setup_table['cache'])
+                        )
+    again = load_table(setup_table['path'], setup_table['cache'])
+    assert np.array_equal(again['control'], columns['control'])
+
+def test_changed_file_gets_new_cache(setup_table):
+    old = cache_directory(setup_table['path'], setup_table['cache'])
+    load_table(setup_table['path'], setup_table['cache'])
+    table = setup_table['table'].assign(control = np.float32(2))
+    table.to_stata(setup_table['path'], write_index = False)
+    assert cache_directory(setup_table['path'], setup_table['cache']) != old
+    columns = load_table(setup_table['path'], setup_table['cache'])
+    assert np.all(columns['control'] == 2)
+
+def test_lookup_and_gather(setup_table):
+    table = setup_table['table']
+    keys = np.array([[11, 21], [22, 13]])
+    rows = lookup(table['cont_id'].values, keys)
+    assert np.array_equal(rows, [[1, 3], [2, -1]])
+    values = gather(table['control'].values, rows)
+    expected = (
+                table.set_index('cont_id')['control']
+                .reindex(keys.ravel()).values.reshape(2, 2)
+               )
+    assert np.array_equal(values, expected, equal_nan = True)
@@ -2,7 +2,9 @@ import sys
 import numpy as np
 from numpy.testing import assert_allclose
 import pytest
-from transition import Transition
+from transition import Transition, TransitionParameterError
+from particle_history import ConstantFactors
+from resampling import UniqueAncestors, gather_particles
 
 if __name__ == '__main__':
     status = pytest.main([sys.argv[1]])
@@ -89,4 +91,165 @@ def test_marginal_probability(
     assert_allclose(
                         marginal,
                         expected_1nonconst_factor_marg_prob['marg_prob']
-                   )
\ No newline at end of file
+                   )
+def test_log_marginal_probability(
+                                setup_1nonconst_factor_marg_prob,
+                                expected_1nonconst_factor_marg_prob
+                                 ):
+    trans = setup_1nonconst_factor_marg_prob['trans_obj']
+    log_marginal = trans.log_marginal_probability(
+                                setup_1nonconst_factor_marg_prob['next_state'],
+                                setup_1nonconst_factor_marg_prob['state']
+                                                 )
+    with np.errstate(divide = 'ignore'):
+        expected = np.log(expected_1nonconst_factor_marg_prob['marg_prob'])
+    assert_allclose(log_marginal, expected)
+
+def test_log_marginal_probability_matches_per_particle_loop():
+    params = {
+                'phi': -.5, 'lambda': 1, 'gamma1': .6, 'gamma2': .2,
+                'gamma3': .2, 'var_u': .1
+             }
+    trans = Transition([params], [1, 0, 0])
+    rng = np.random.RandomState(8)
+    state = rng.randint(0, 2, size = (3, 5, 6)).astype(float)
+    state[0, ...] = rng.normal(size = (5, 6))
+    next_state = np.array([rng.normal(size = 5), np.ones(5), np.zeros(5)])
+    expected = np.full((5, 6), -np.inf)
+    for n in range(5):
+        for m in range(6):
+            if np.all(state[1:, n, m] == next_state[1:, n]):
+                expected[n, m] = trans._log_density(
+                        0,
+                        next_state[0, n]
+                        - trans._transition_equation(0, state[:, n, m])
+                                                   )
+    assert_allclose(
+                    trans.log_marginal_probability(next_state, state),
+                    expected
+                   )
+    # Matching the distinct values of the constant factor types instead.
+    constants = ConstantFactors.from_particles(state, [1, 2])
+    assert_allclose(
+                    trans.log_marginal_probability(
+                                                    next_state, state,
+                                                    constants
+                                                  ),
+                    expected
+                   )
+
+@pytest.fixture
+def setup_2nonconst_factors():
+    out = {}
+    out['params'] = [
+                        {
+                            'phi': -.5, 'lambda': 1.5, 'gamma1': .6,
+                            'gamma2': .2, 'gamma3': .2, 'var_u': .1
+                        },
+                        {
+                            'phi': 1, 'lambda': 1, 'gamma1': 0, 'gamma2': .6,
+                            'gamma3': 0, 'var_u': .2
+                        }
+                    ]
+    out['trans_obj'] = Transition(out['params'], [1, 1, 0])
+    out['state'] = np.random.RandomState(9).normal(size = (3, 4, 5))
+    return out
+
+def _naive_ces(p, a):
+    return np.log(
+                    p['gamma1']*np.exp(p['phi']*p['lambda']*a[0])
+                    + p['gamma2']*np.exp(p['phi']*a[1])
+                    + p['gamma3']*np.exp(p['phi']*a[2])
+                 ) / (p['phi']*p['lambda'])
+
+def test_ces_kernel_equals_naive_formula(setup_2nonconst_factors):
+    setup = setup_2nonconst_factors
+    expected = np.array([
+                            _naive_ces(p, setup['state'])
+                            for p in setup['params']
+                        ])
+    assert_allclose(
+                    setup['trans_obj']._ces_kernel(setup['state']),
+                    expected
+                   )
+
+def test_ces_kernel_no_overflow():
+    params = {
+                'phi': -.5, 'lambda': 1, 'gamma1': .6, 'gamma2': .2,
+                'gamma3': .2, 'var_u': .1
+             }
+    trans = Transition([params], [1, 0, 0])
+    # exp(phi*a) overflows for a = -2000 in the naive formula; with equal
+    # inputs and weights summing up to one, the CES-function returns a.
+    state = np.full((3, 1, 1), -2000.)
+    assert_allclose(trans._ces_kernel(state), state[:1, ...])
+
+def test_specialized_equals_general_formula(setup_2nonconst_factors):
+    trans = setup_2nonconst_factors['trans_obj']
+    state = setup_2nonconst_factors['state']
+    assert trans.kinds == ['ces', 'linear']
+    assert_allclose(
+                    trans.expected_next_state(state),
+                    trans._ces_kernel(state)
+                   )
+    assert_allclose(
+                    trans.expected_next_state(state)[1, ...],
+                    state[1, ...] + np.log(.6)
+                   )
+
+def test_cobb_douglas_limit(setup_2nonconst_factors):
+    state = setup_2nonconst_factors['state']
+    params = {
+                'phi': 0, 'lambda': 1.5, 'gamma1': .6, 'gamma2': .2,
+                'gamma3': .2, 'var_u': .1
+             }
+    trans = Transition([params], [1, 0, 0])
+    assert trans.kinds == ['linear']
+    close_trans = Transition([dict(params, phi = 1e-7)], [1, 0, 0])
+    assert_allclose(
+                    trans.expected_next_state(state),
+                    close_trans._ces_kernel(state),
+                    rtol = 1e-5
+                   )
+    with pytest.raises(TransitionParameterError):
+        Transition([dict(params, gamma3 = .5)], [1, 0, 0])
+    for phi in [0, 1]:
+        with pytest.raises(TransitionParameterError):
+            Transition(
+                        [dict(params, phi = phi, gamma1 = 0, gamma2 = 0,
+                              gamma3 = 0)],
+                        [1, 0, 0]
+                      )
+
+def test_next_state_broadcasts_degenerate_state(setup_2nonconst_factors):
+    trans = setup_2nonconst_factors['trans_obj']
+    state = setup_2nonconst_factors['state'][:, :, :1]
+    errors = np.random.RandomState(4).normal(size = (2, 4, 5))
+    expected = trans.next_state(np.repeat(state, 5, axis = 2), errors)
+    broadcast = trans.next_state(
+                                    np.broadcast_to(state, (3, 4, 5)), errors
+                                )
+    assert_allclose(trans.next_state(state, errors), expected)
+    assert_allclose(broadcast, expected)
+
+def test_unique_ancestors_equal_gathered_particles(setup_2nonconst_factors):
+    trans = setup_2nonconst_factors['trans_obj']
+    state = setup_2nonconst_factors['state']
+    rng = np.random.RandomState(6)
+    ancestors = np.sort(rng.randint(0, 5, size = (4, 5)), axis = 1)
+    unique = UniqueAncestors(ancestors)
+    errors = rng.normal(size = (2, 4, 5))
+    assert_allclose(
+                    trans.next_state(state, errors, unique = unique),
+                    trans.next_state(gather_particles(state, ancestors), errors)
+                   )
+    resampled = gather_particles(state, ancestors)
+    next_state = rng.normal(size = (3, 4))
+    next_state[2, :] = resampled[2, :, 0]
+    assert_allclose(
+                trans.log_marginal_probability(
+                                                next_state, resampled,
+                                                unique = unique
+                                              ),
+                trans.log_marginal_probability(next_state, resampled)
+                   )
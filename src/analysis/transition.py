@@ -1,9 +1,9 @@
 """Transition class: provide transition equations and -probabilities.
 TransitionFactorSettingError class: exception for unfit factor settings.
+TransitionParameterError class: exception for CES-parameters without limit.
 """
 
 import numpy as np
-from scipy.stats import norm
 
 class Transition:
     """Handle the transition equations of the different factor types for a
@@ -27,6 +27,10 @@ class Transition:
     Public methods:
         + next_state
         + marginal_probability
+        + log_marginal_probability
+        + autoregressive_factors
+        + expected_next_state
+        + log_densities
     """
     
     def __init__(self, parameters, factor_setting):
@@ -48,12 +52,186 @@ class Transition:
         Created class attributes:
             + *params* (list of dictionaries)
             + *factor_setting* (list of binaries (0 or 1))
+            + *nonconst* (np.ndarray):
+                Positions of the H non-constant factor types.
+            + *coeffs* (np.ndarray):
+                Hx3 array with the coefficients of the inputs in the
+                exponentials of the CES-functions (phi*lambda, phi, phi).
+            + *log_gammas* (np.ndarray):
+                Hx3 array with the logarithms of the CES-weights gammaX
+                (-inf for weights that are zero).
+            + *denoms* (np.ndarray):
+                H-array with phi*lambda of each CES-function.
+            + *variances*, *sds* (np.ndarray):
+                H-arrays with variance and standard deviation of the additive
+                errors.
+            + *kinds* (list of strings):
+                For each non-constant factor type, 'linear' if its transition
+                equation is specialized to a linear map, else 'ces'.
+            + *linear*, *ces* (np.ndarray):
+                Positions (among the non-constant factor types) of the linear
+                and of the general CES transition equations.
+            + *lin_coeffs*, *lin_intercepts* (np.ndarray):
+                Lx3 and L-arrays with the coefficients and intercepts of the
+                L linear transition equations.
+            + *ces_inputs* (np.ndarray):
+                Inputs with a non-zero weight in any general CES-function.
+        
+        Raises:
+            + TransitionParameterError:
+                If phi is 0 and the weights gammaX do not sum up to one, or
+                if all weights gammaX are 0.
         """
         
         self.params = parameters
-        self.sds = [np.sqrt(p['var_u']) for p in parameters]
         self.factor_setting = factor_setting
+        # Pack parameters of the non-constant factor types into arrays, in
+        # the order of the factor types.
+        self.nonconst = np.nonzero(factor_setting)[0]
+        trans_params = [parameters[nr] for nr in self.nonconst]
+        phis = np.array([p['phi'] for p in trans_params], dtype = float)
+        lambdas = np.array([p['lambda'] for p in trans_params], dtype = float)
+        self.coeffs = np.column_stack([phis*lambdas, phis, phis])
+        gammas = np.array(
+                            [[p['gamma1'], p['gamma2'], p['gamma3']]
+                             for p in trans_params],
+                            dtype = float
+                         ).reshape((-1, 3))
+        with np.errstate(divide = 'ignore'):
+            self.log_gammas = np.log(gammas)
+        self.denoms = phis*lambdas
+        self.variances = np.array(
+                                    [p['var_u'] for p in trans_params],
+                                    dtype = float
+                                 )
+        self.sds = np.sqrt(self.variances)
+        self._specialize(gammas, lambdas)
+    
+    def _specialize(self, gammas, lambdas):
+        """Compile each transition equation to the cheapest exact form:
+        
+            + Only one non-zero weight gamma_k: the CES-function is the
+              linear map c_k/(phi*lambda)*a_k + log(gamma_k)/(phi*lambda).
+            + phi equal to 0 (Cobb-Douglas limit, requires the weights to
+              sum up to one): the linear map
+              gamma1*a1 + (gamma2*a2 + gamma3*a3)/lambda.
+            + Otherwise, the general CES-function, where inputs with zero
+              weight are left out.
+        
+        """
+        
+        self.kinds = []
+        lin_coeffs = []
+        lin_intercepts = []
+        for h, gamma in enumerate(gammas):
+            active = np.nonzero(gamma)[0]
+            if 0 == len(active):
+                raise TransitionParameterError(
+                                                self.nonconst[h],
+                                                zero_weights = True
+                                              )
+            if 0 == self.denoms[h]:
+                if not np.isclose(np.sum(gamma), 1):
+                    raise TransitionParameterError(self.nonconst[h])
+                lin_coeffs.append(gamma*np.array([lambdas[h], 1, 1])
+                                  / lambdas[h])
+                lin_intercepts.append(0)
+            elif 1 == len(active):
+                coeff = np.zeros(3)
+                coeff[active] = self.coeffs[h, active] / self.denoms[h]
+                lin_coeffs.append(coeff)
+                lin_intercepts.append(
+                                self.log_gammas[h, active[0]] / self.denoms[h]
+                                     )
+            else:
+                self.kinds.append('ces')
+                continue
+            self.kinds.append('linear')
+        kinds = np.array(self.kinds, dtype = object)
+        self.linear = np.nonzero('linear' == kinds)[0]
+        self.ces = np.nonzero('ces' == kinds)[0]
+        self.lin_coeffs = np.array(lin_coeffs).reshape((-1, 3))
+        self.lin_intercepts = np.array(lin_intercepts, dtype = float)
+        self.ces_inputs = np.nonzero(
+                                     np.any(0 != gammas[self.ces], axis = 0)
+                                    )[0]
+        
+    def autoregressive_factors(self):
+        """Find the factor types whose transition equation is specialized to
+        a linear map of the factor type itself (see *_specialize*). With the
+        additive Gaussian errors, each of them follows a Gaussian AR(1)
+        process of its own, a + b*f + u with u ~ N(0, var_u).
+        
+        Returns:
+            + factor types (np.ndarray):
+                Positions of the A autoregressive factor types among the
+                three factor types.
+            + intercepts, slopes, variances (np.ndarray):
+                A-arrays with a, b and var_u of each of them.
+        
+        """
+        
+        own = self.nonconst[self.linear]
+        coeffs = self.lin_coeffs
+        own_coeffs = coeffs[np.arange(len(own)), own]
+        is_ar = (0 != own_coeffs) & (
+                    np.sum(0 != coeffs, axis = 1) == 1
+                                    )
+        return (
+                own[is_ar], self.lin_intercepts[is_ar], own_coeffs[is_ar],
+                self.variances[self.linear[is_ar]]
+               )
+        
+    def _ces_kernel(self, factors, eqs=slice(None), inputs=range(3)):
+        """Calculate (expected) next states of the non-constant factor types
+        in one vectorized pass over all CES-functions, in the numerically
+        stable log-sum-exp form
+        
+            log(sum_k gamma_k*exp(c_k*a_k)) / (phi*lambda)
+                = (m + log(sum_k exp(log(gamma_k) + c_k*a_k - m))) / (phi*lambda),
         
+        where m is the largest of the terms log(gamma_k) + c_k*a_k.
+        
+        Args:
+            + *factors* (np.ndarray):
+                Array of arbitrary shape, but with **first dimension of length
+                3** (is taken as the three inputs).
+            + *eqs* (slice or np.ndarray):
+                Selects the CES-functions (positions among the non-constant
+                factor types), default is all.
+            + *inputs* (sequence of integers):
+                Inputs k that enter the sum, default is all three (inputs
+                with zero weight in all selected functions can be left out).
+        
+        Returns:
+            + expected next states (np.ndarray):
+                Array with the selected factor types along the first dimension
+                and the shape of *factors* along the others.
+                
+        """
+        
+        extra_dims = (np.newaxis,)*(factors.ndim - 1)
+        coeffs = self.coeffs[eqs][(Ellipsis,) + extra_dims]
+        log_gammas = self.log_gammas[eqs][(Ellipsis,) + extra_dims]
+        # Terms log(gamma_k) + c_k*a_k of all functions at once, per input k.
+        terms = []
+        for k in inputs:
+            term = np.multiply(coeffs[:, k, ...], factors[np.newaxis, k, ...])
+            term += log_gammas[:, k, ...]
+            terms.append(term)
+        shift = terms[0].copy()
+        for term in terms[1:]:
+            np.maximum(shift, term, out = shift)
+        out = np.zeros(shift.shape)
+        for term in terms:
+            term -= shift
+            np.exp(term, out = term)
+            out += term
+        np.log(out, out = out)
+        out += shift
+        out /= self.denoms[eqs][(Ellipsis,) + extra_dims]
+        return out
+    
     def _transition_equation(self, nr, factors):
         """Calculate (expected) next state of one factor, given inputs.
         
@@ -72,44 +250,74 @@ class Transition:
                 
         """
         
-        # Define CES-function with parameters from factor type *nr*.
-        ces = lambda a1, a2, a3 : np.log(
-                                            self.params[nr]['gamma1']*
-                                            np.exp(
-                                                    self.params[nr]['phi']*
-                                                    self.params[nr]['lambda']*
-                                                    a1
-                                                  )
-                                            + self.params[nr]['gamma2']*
-                                            np.exp(
-                                                    self.params[nr]['phi']*
-                                                    a2
-                                                  )
-                                            + self.params[nr]['gamma3']*
-                                            np.exp(
-                                                    self.params[nr]['phi']*
-                                                    a3
-                                                  )
-                                        ) / (
-                                                self.params[nr]['phi']*
-                                                self.params[nr]['lambda']
-                                            )
-        return ces(factors[0, ...], factors[1, ...], factors[2, ...])
+        pos = np.searchsorted(self.nonconst, nr)
+        return self.expected_next_state(factors)[pos, ...]
+    
+    def expected_next_state(self, factors):
+        """Calculate (expected) next states of all non-constant factor
+        types, using the specialized form of each transition equation (see
+        *_specialize*).
+        
+        Args:
+            + *factors* (np.ndarray):
+                Array of arbitrary shape, but with **first dimension of length
+                3** (is taken as the three inputs).
+        
+        Returns:
+            + expected next states (np.ndarray):
+                Array with the H non-constant factor types along the first
+                dimension and the shape of *factors* along the others.
+        
+        """
+        
+        out = np.empty((len(self.nonconst),) + factors.shape[1:])
+        extra_dims = (np.newaxis,)*(factors.ndim - 1)
+        if len(self.linear) > 0:
+            linear = np.broadcast_to(
+                            self.lin_intercepts[(Ellipsis,) + extra_dims],
+                            (len(self.linear),) + factors.shape[1:]
+                                    ).copy()
+            for k in np.nonzero(np.any(0 != self.lin_coeffs, axis = 0))[0]:
+                linear += (
+                            self.lin_coeffs[(slice(None), k) + extra_dims]
+                            * factors[np.newaxis, k, ...]
+                          )
+            out[self.linear, ...] = linear
+        if len(self.ces) > 0:
+            out[self.ces, ...] = self._ces_kernel(
+                                                    factors, self.ces,
+                                                    self.ces_inputs
+                                                 )
+        return out
     
-    def _density(self, nr, x):
-        """Return value of density evaluated at x.
+    def _log_density(self, nr, x):
+        """Return value of log-density evaluated at x.
         
         Args:
             + *nr* (integer): Factor number (**starts at 0**).
             + *x* (np.ndarray): matrix of values
         
         Returns:
-            + np.ndarray of normal densities at x
+            + np.ndarray of normal log-densities at x
+        """
+        
+        return -.5*(
+                    np.log(2*np.pi*self.params[nr]['var_u'])
+                    + x*x/self.params[nr]['var_u']
+                   )
+    
+    def log_densities(self, x):
+        """Return values of the log-densities of the additive errors of all
+        non-constant factor types at *x* (deviations from the expected next
+        states), where the first dimension of *x* runs over these types.
+        
         """
         
-        return norm.pdf(x, scale = self.sds[nr])
+        extra_dims = (np.newaxis,)*(x.ndim - 1)
+        variances = self.variances[(Ellipsis,) + extra_dims]
+        return -.5*(np.log(2*np.pi*variances) + x*x/variances)
         
-    def next_state(self, state, errors):
+    def next_state(self, state, errors, unique=None):
         """Calculate next state of all factors, given last state and normalized
         errors.
         
@@ -123,10 +331,22 @@ class Transition:
                 as long as number of non-constant factors. Contains additive,
                 normalized errors to transition equations. They are attributed
                 to factor types along first dimension, sorted from first to
-                last non-constant factor type.
+                last non-constant factor type. *state* and *errors* only need
+                to be broadcastable along the other dimensions (e.g. a
+                degenerate prior of shape 3xNx1 with errors of shape HxNxM),
+                in which case the transition equations are evaluated on the
+                smaller *state*.
+            + *unique* (UniqueAncestors):
+                If given, *state* holds the particles *before* resampling and
+                *unique* the resampled ancestors (see
+                *resampling.UniqueAncestors*). The transition equations are
+                evaluated once per distinct ancestor and expanded to the
+                resampled particles only where the errors are added.
         
         Returns:
-            + next state of factors (np.ndarray): Has same shape as *state*.
+            + next state of factors (np.ndarray):
+                Has the first dimension of *state* and the broadcast shape of
+                *state* and *errors* along the others.
             
         """
     
@@ -136,21 +356,25 @@ class Transition:
             ):
             raise TransitionFactorSettingError
             
-        next_state = np.zeros(state.shape)
-        sum_trans = 0
-        for nr, trans in enumerate(self.factor_setting):
+        next_state = np.empty(
+                        state.shape[:1]
+                        + np.broadcast_shapes(state.shape[1:], errors.shape[1:])
+                             )
+        const = np.nonzero(0 == np.array(self.factor_setting))[0]
+        extra_dims = (np.newaxis,)*(state.ndim - 1)
+        if unique is None:
             # Take same values if factor type is constant.
-            if 0 == trans:
-                next_state[nr, ...] = state[nr, ...]
-            else:
-                next_state[nr, ...] = (
-                                        self._transition_equation(
-                                                                   nr, 
-                                                                   state
-                                                                 )
-                                        + self.sds[nr]*errors[sum_trans, ...]
-                                     )
-                sum_trans += 1
+            next_state[const, ...] = state[const, ...]
+            expected = self.expected_next_state(state)
+        else:
+            distinct = unique.compress(state)
+            next_state[const, ...] = unique.expand(distinct[const, ...])
+            expected = unique.expand(self.expected_next_state(distinct))
+        # Add the scaled errors to the transition equations.
+        next_state[self.nonconst, ...] = np.add(
+                                    expected,
+                                    self.sds[(Ellipsis,) + extra_dims]*errors
+                                               )
         return next_state
     
     def marginal_probability(self, next_state, state):
@@ -179,31 +403,93 @@ class Transition:
                 
         """
         
-        ret_arr = np.zeros(state.shape[1:])
-        # Start with constant factor types to identify fitting indices.
+        return np.exp(self.log_marginal_probability(next_state, state))
+    
+    def log_marginal_probability(self, next_state, state, constants=None,
+                                 unique=None):
+        """Calculate logarithms of the (marginal) probabilities of factors in
+        *state*, given transition equations and *next_state* (see
+        *marginal_probability*). The log-densities of the transition equations
+        are added up among non-constant factor types; factors that do not fit
+        to *next_state* in a constant factor type get assigned -inf.
+        
+        Args:
+            + *next_state* (np.ndarray):
+                Array of shape 3xN, where N is the number of observations.
+            + *state* (np.ndarray):
+                Array of shape 3xNxM, where M is the number of factors per
+                observation and type.
+            + *constants* (ConstantFactors):
+                The constant factor types of *state* as distinct values per
+                observation (see *particle_history.ConstantFactors*). If
+                given, the distinct values are compared with *next_state*
+                instead of all particles.
+            + *unique* (UniqueAncestors):
+                The ancestors that the particles in *state* were resampled
+                from. If given, the densities are evaluated once per distinct
+                particle and expanded.
+        
+        Returns:
+            + log marginal probabilities (np.ndarray): Array of shape NxM.
+                
+        """
+        
+        # Start with constant factor types to identify fitting particles,
+        # comparing all particles (or all distinct values) at once by
+        # broadcasting.
         const = np.nonzero(0 == np.array(self.factor_setting))[0]
-        are_equal = np.ones(state.shape[1:])
-        for c_i in const:
-            is_equal = lambda x : next_state[c_i, :] == x
-            are_equal *= np.apply_along_axis(is_equal, 0, state[c_i, ...])
-        fit_indices = np.nonzero(are_equal)
-        fit_factors = state[:, fit_indices[0], fit_indices[1]]
-        # Calculate marg. probabilities for fitting indices.
-        nonconst = np.nonzero(self.factor_setting)[0]
-        ret_arr[fit_indices[0], fit_indices[1]] = 1
-        for nc_i in nonconst:
-            marg_prob = self._density(
-                                      nc_i,
-                                      next_state[nc_i, fit_indices[0]] -
-                                      self._transition_equation(
-                                                                nc_i,
-                                                                fit_factors
-                                                               )
-                                     )
-            ret_arr[fit_indices[0], fit_indices[1]] *= marg_prob
+        if constants is None:
+            fits = np.ones(state.shape[1:], dtype = bool)
+            for c_i in const:
+                fits &= state[c_i, ...] == next_state[c_i, :, np.newaxis]
+        else:
+            fits = constants.broadcast(np.all(
+                    constants.values == next_state[const, :, np.newaxis],
+                    axis = 0
+                                             ))
+        if unique is not None:
+            # One copy of each distinct particle.
+            fit_distinct = np.nonzero(fits[unique.rows, unique.first])[0]
+            fit_obs = unique.rows[fit_distinct]
+            fit_parts = unique.first[fit_distinct]
+        else:
+            fit_obs, fit_parts = np.nonzero(fits)
+        fit_factors = state[:, fit_obs, fit_parts]
+        # Calculate log marg. probabilities for fitting particles only, for
+        # all non-constant factor types in one pass.
+        deviations = self.expected_next_state(fit_factors)
+        np.subtract(
+                    next_state[self.nonconst[:, np.newaxis], fit_obs],
+                    deviations,
+                    out = deviations
+                   )
+        fit_log_probs = np.sum(self.log_densities(deviations), axis = 0)
+        if unique is not None:
+            distinct_arr = np.full(len(unique), -np.inf)
+            distinct_arr[fit_distinct] = fit_log_probs
+            return unique.expand(distinct_arr)
+        ret_arr = np.full(state.shape[1:], -np.inf)
+        ret_arr[fit_obs, fit_parts] = fit_log_probs
         return ret_arr
         
 class TransitionFactorSettingError(Exception):
     
     def __str__(self):
         return "Input does not fit to number of non-constant factor types."
+        
+class TransitionParameterError(Exception):
+    
+    def __init__(self, nr, zero_weights=False):
+        self.nr = nr
+        self.zero_weights = zero_weights
+    
+    def __str__(self):
+        if self.zero_weights:
+            return (
+                    "Transition equation of factor type {} has no non-zero "
+                    "weight gammaX."
+                   ).format(self.nr+1)
+        return (
+                "Transition equation of factor type {} has phi = 0, but its "
+                "weights do not sum up to one (no Cobb-Douglas limit)."
+               ).format(self.nr+1)
@@ -0,0 +1,413 @@
+"""
+In the file "simulate_data.py", the source data are simulated with NumPy, as
+an alternative to "generate_data.do" and "data_management.do" that runs
+without Stata and for millions of observations.
+
+The script reads the same model specifications in "IN_MODEL_SPECS"
+(smoother.json, transitions.json, measurements.json and true_prior.json).
+Factors evolve with the transition equations of the *Transition* class (the
+equations that the particle smoother estimates), measurements are linear in
+the factor of their equation with Gaussian errors, as in the *Measurement*
+class:
+
+    meas = beta1*x1 + beta2*x2 + z*fac + sqrt(var)*error
+
+where x1 is uniform on [0, 1] and x2 = 1. Factor 3 and its measurements are
+constant over time. The factors of period 1 are drawn from the prior with
+mean zero and variances 'var_p'.
+
+The observations are simulated in chunks of *CHUNK_SIZE* caseids. Each block
+of *BLOCK_SIZE* caseids has its own random stream spawned from the random
+seed, such that the data do not depend on the chunk size. The output is
+either
+
+    * the normalized tables "data_table_1.dta", "data_table_2.dta",
+      "data_table_3.dta" in "OUT_DATA" (layout 'tables'), as generated by
+      "data_management.do", or
+    * the dense analysis arrays 'meas_facX' and 'true_facs' in "OUT_ANALYSIS"
+      (layout 'dense', see *artifacts.open_frame*), as produced by
+      *prepare_data* and *extract_true_factors*, written chunk by chunk.
+
+"""
+
+import argparse
+import json
+import numpy as np
+import pandas as pd
+
+from bld.project_paths import project_paths_join as ppj
+from src.analysis.transition import Transition
+from src.analysis.artifacts import open_frame
+
+F_NR = ['fac1', 'fac2', 'fac3']
+F_SETTING = [1, 1, 0]
+MEAS_COLUMNS = ['control', 'control_2', 'meas1', 'meas2', 'meas3']
+# Number of caseids per random stream. It is fixed, such that the data do not
+# depend on the number of caseids simulated at once (*CHUNK_SIZE*).
+BLOCK_SIZE = 1000
+CHUNK_SIZE = 10000
+# First entry of the spawn key of the simulation streams.
+_SIMULATION_STREAM = 2
+
+
+def block_generator(seed, block):
+    """Return the random generator of block number *block*."""
+
+    return np.random.Generator(np.random.PCG64(
+                np.random.SeedSequence(
+                                        seed,
+                                        spawn_key = (_SIMULATION_STREAM, block)
+                                      )
+                                              ))
+
+
+def simulate_factors(trans_params, prior, nr_obs, nr_per, rng):
+    """Simulate the factors of *nr_obs* observations over *nr_per* periods.
+
+    Args:
+        + *trans_params* (list of dictionaries): See *Transition*.
+        + *prior* (list of dictionaries):
+            Variance 'var_p' of the factors in period 1, per factor type.
+        + *nr_obs*, *nr_per* (integer): Number of observations and periods.
+        + *rng* (np.random.Generator): Source of randomness.
+
+    Returns:
+        + factors (np.ndarray): 3xNxP array.
+
+    """
+
+    trans_obj = Transition(trans_params, F_SETTING)
+    factors = np.empty((3, nr_obs, nr_per))
+    sds = np.sqrt([d["var_p"] for d in prior])
+    factors[..., 0] = sds[:, np.newaxis]*rng.standard_normal((3, nr_obs))
+    for per in range(1, nr_per):
+        factors[..., per] = trans_obj.next_state(
+                            factors[..., per-1],
+                            rng.standard_normal((sum(F_SETTING), nr_obs))
+                                                )
+    return factors
+
+
+def simulate_measurements(meas_params, factors, controls, rng):
+    """Simulate the measurements of each factor type.
+
+    Args:
+        + *meas_params* (list of dictionaries): See *Measurement*.
+        + *factors* (np.ndarray): 3xNxP array, see *simulate_factors*.
+        + *controls* (np.ndarray): 2xN array of the controls x1 and x2.
+        + *rng* (np.random.Generator): Source of randomness.
+
+    Returns:
+        + measurements (list of np.ndarray):
+            For each factor type, an ExNxP array (E measurement equations).
+            Measurements of constant factor types are constant over periods.
+
+    """
+
+    measurements = []
+    for fac, factor, setting in zip(F_NR, factors, F_SETTING):
+        params = [d for d in meas_params if fac == d['factor']]
+        nr_per = factor.shape[1] if setting else 1
+        meas = np.empty((len(params),) + factor.shape)
+        for i, d in enumerate(params):
+            meas[i, ...] = (
+                            d['beta1']*controls[0, :, np.newaxis]
+                            + d['beta2']*controls[1, :, np.newaxis]
+                            + d['z']*factor
+                           )
+            meas[i, ...] += np.sqrt(d['var'])*rng.standard_normal(
+                                                    (factor.shape[0], nr_per)
+                                                                   )
+        measurements.append(meas)
+    return measurements
+
+
+def simulate_block(fixed, meas_params, trans_params, prior, block, nr_obs):
+    """Simulate controls, factors and measurements of the *nr_obs*
+    observations of block number *block*.
+
+    Returns:
+        + controls (np.ndarray): 2xN array.
+        + factors (np.ndarray): 3xNxP array.
+        + measurements (list of np.ndarray): See *simulate_measurements*.
+
+    """
+
+    rng = block_generator(fixed["rnd_seed"], block)
+    controls = np.ones((2, nr_obs))
+    controls[0, :] = rng.random(nr_obs)
+    factors = simulate_factors(
+                                trans_params, prior, nr_obs, fixed["period"],
+                                rng
+                              )
+    measurements = simulate_measurements(
+                                            meas_params, factors, controls,
+                                            rng
+                                        )
+    return controls, factors, measurements
+
+
+def simulate_chunks(fixed, meas_params, trans_params, prior,
+                    chunk_size=CHUNK_SIZE):
+    """Yield (start, stop, controls, factors, measurements) for consecutive
+    chunks of observations (see *simulate_block*). *chunk_size* is rounded
+    to a multiple of *BLOCK_SIZE*; each chunk concatenates whole blocks.
+
+    """
+
+    blocks = max(1, chunk_size // BLOCK_SIZE)
+    for start in range(0, fixed["obs"], blocks*BLOCK_SIZE):
+        stop = min(start + blocks*BLOCK_SIZE, fixed["obs"])
+        parts = [
+                    simulate_block(
+                                    fixed, meas_params, trans_params, prior,
+                                    block_start // BLOCK_SIZE,
+                                    min(block_start+BLOCK_SIZE, stop)
+                                    - block_start
+                                  )
+                    for block_start in range(start, stop, BLOCK_SIZE)
+                ]
+        yield (
+                start, stop,
+                np.concatenate([part[0] for part in parts], axis = 1),
+                np.concatenate([part[1] for part in parts], axis = 1),
+                [
+                    np.concatenate([part[2][f] for part in parts], axis = 1)
+                    for f in range(len(F_NR))
+                ]
+              )
+
+
+def _concat_ids(*parts):
+    """Concatenate the decimal digits of integer arrays *parts* (the ids of
+    the normalized tables, e.g. caseid 12, factor 3, period 8 give 1238).
+
+    """
+
+    ids = np.zeros(np.broadcast(*parts).shape, dtype = np.int64)
+    for part in parts:
+        part = np.asarray(part, dtype = np.int64)
+        digits = 1 + sum(part >= 10**k for k in range(1, 19))
+        ids = ids*10**digits + part
+    return ids
+
+
+def _table_rows(nr_per):
+    """Return the number of rows of **table_1** per caseid (all periods of
+    the non-constant factors, one row for each constant factor).
+
+    """
+
+    return sum(nr_per if setting else 1 for setting in F_SETTING)
+
+
+def write_tables(fixed, meas_params, trans_params, prior,
+                 chunk_size=CHUNK_SIZE):
+    """Simulate the data and write the normalized tables in "OUT_DATA"
+    (see "data_management.do"): factor ids with measurements and true
+    factors (**table_1**), factor and control ids per caseid and period
+    (**table_2**) and controls (**table_3**). The columns are filled chunk by
+    chunk, each table is written at once.
+
+    """
+
+    nr_obs, nr_per = fixed["obs"], fixed["period"]
+    caseids = np.arange(1, nr_obs+1)
+    periods = np.arange(1, nr_per+1)
+    rows_1 = _table_rows(nr_per)
+    table_1 = {
+                key: np.empty(nr_obs*rows_1)
+                for key in ['meas1', 'meas2', 'meas3', 'true_fac']
+              }
+    factor_ids = []
+    for f_nr, setting in enumerate(F_SETTING):
+        # Constant factors are stored once, with the id of the last period.
+        per = periods if setting else periods[-1:]
+        factor_ids.append(_concat_ids(
+                                        caseids[:, np.newaxis], f_nr+1,
+                                        per[np.newaxis, :]
+                                     ))
+    table_1['factor_id'] = np.concatenate(factor_ids, axis = 1).ravel()
+    controls_3 = np.empty((nr_obs, 2))
+    for start, stop, controls, factors, measurements in simulate_chunks(
+                                                fixed, meas_params,
+                                                trans_params, prior,
+                                                chunk_size
+                                                                        ):
+        rows = slice(start*rows_1, stop*rows_1)
+        for i, key in enumerate(['meas1', 'meas2', 'meas3']):
+            table_1[key][rows] = np.concatenate(
+                        [
+                            meas[i] if setting else meas[i][:, :1]
+                            for meas, setting in zip(measurements, F_SETTING)
+                        ],
+                        axis = 1
+                                               ).ravel()
+        table_1['true_fac'][rows] = np.concatenate(
+                        [
+                            factor if setting else factor[:, :1]
+                            for factor, setting in zip(factors, F_SETTING)
+                        ],
+                        axis = 1
+                                                  ).ravel()
+        controls_3[start:stop, :] = controls.T
+    pd.DataFrame(
+                    table_1,
+                    columns = ['factor_id', 'meas1', 'meas2', 'meas3',
+                               'true_fac']
+                ).to_stata(
+                            ppj("OUT_DATA", "tables", "data_table_1.dta"),
+                            write_index = False
+                          )
+    table_2 = {
+                'caseid': np.repeat(caseids, nr_per),
+                't': np.tile(periods, nr_obs)
+              }
+    for f_nr, setting in enumerate(F_SETTING):
+        per = table_2['t'] if setting else periods[-1]
+        table_2[F_NR[f_nr]] = _concat_ids(table_2['caseid'], f_nr+1, per)
+    for c in [1, 2]:
+        table_2['x{}'.format(c)] = _concat_ids(table_2['caseid'], c)
+    pd.DataFrame(table_2).to_stata(
+                            ppj("OUT_DATA", "tables", "data_table_2.dta"),
+                            write_index = False
+                                  )
+    pd.DataFrame({
+                    'cont_id': _concat_ids(
+                                            caseids[:, np.newaxis],
+                                            np.array([[1, 2]])
+                                          ).ravel(),
+                    'control': controls_3.ravel()
+                }).to_stata(
+                            ppj("OUT_DATA", "tables", "data_table_3.dta"),
+                            write_index = False
+                           )
+
+
+def _dense_indices(nr_obs, nr_per):
+    """Return the (caseid, t) MultiIndex over all periods and over period 1
+    only (for constant factor types).
+
+    """
+
+    caseids = np.arange(1, nr_obs+1)
+    full_index = pd.MultiIndex.from_product(
+                                    [caseids, np.arange(1, nr_per+1)],
+                                    names = ['caseid', 't']
+                                           )
+    first_index = pd.MultiIndex.from_product(
+                                    [caseids, [1]], names = ['caseid', 't']
+                                            )
+    return full_index, first_index
+
+
+def _fill_dense(meas_out, true_out, fixed, meas_params, trans_params, prior,
+                chunk_size):
+    """Simulate the data chunk by chunk into the arrays *meas_out* (values of
+    'meas_facX') and *true_out* (values of 'true_facs').
+
+    """
+
+    nr_per = fixed["period"]
+    for start, stop, controls, factors, measurements in simulate_chunks(
+                                                fixed, meas_params,
+                                                trans_params, prior,
+                                                chunk_size
+                                                                        ):
+        for out, meas, setting in zip(meas_out, measurements, F_SETTING):
+            nr_per_out = nr_per if setting else 1
+            rows = slice(start*nr_per_out, stop*nr_per_out)
+            out[rows, :2] = np.repeat(controls.T, nr_per_out, axis = 0)
+            out[rows, 2:] = meas[..., :nr_per_out].reshape(
+                                                        meas.shape[0], -1
+                                                          ).T
+        true_out[start*nr_per:stop*nr_per, :] = factors.reshape(3, -1).T
+
+
+def write_dense(fixed, meas_params, trans_params, prior,
+                chunk_size=CHUNK_SIZE):
+    """Simulate the data and write the measurement data of each factor type
+    ('meas_facX') and the true factors ('true_facs') directly as array
+    artifacts in "OUT_ANALYSIS", chunk by chunk. Constant factor types have
+    measurements for period 1 only (as after *prepare_data*).
+
+    """
+
+    indices = _dense_indices(fixed["obs"], fixed["period"])
+    metadata = {"seed": fixed["rnd_seed"]}
+    meas_out = [
+                open_frame(
+                            ppj("OUT_ANALYSIS", 'meas_'+fac),
+                            indices[1-setting], MEAS_COLUMNS, **metadata
+                          )
+                for fac, setting in zip(F_NR, F_SETTING)
+               ]
+    true_out = open_frame(
+                            ppj("OUT_ANALYSIS", 'true_facs'), indices[0],
+                            F_NR, **metadata
+                         )
+    _fill_dense(
+                meas_out, true_out, fixed, meas_params, trans_params, prior,
+                chunk_size
+               )
+    for out in meas_out + [true_out]:
+        out.flush()
+
+
+def simulate_frames(fixed, meas_params, trans_params, prior,
+                    chunk_size=CHUNK_SIZE):
+    """Simulate the data in memory, in the form that *write_dense* stores
+    (e.g. for Monte Carlo replications, see *monte_carlo*).
+
+    Returns:
+        + measurement data (list of pd.DataFrame):
+            One DataFrame per factor type, as 'meas_facX'.
+        + true factors (pd.DataFrame): As 'true_facs'.
+
+    """
+
+    indices = _dense_indices(fixed["obs"], fixed["period"])
+    meas_out = [
+                np.empty((len(indices[1-setting]), len(MEAS_COLUMNS)))
+                for setting in F_SETTING
+               ]
+    true_out = np.empty((len(indices[0]), len(F_NR)))
+    _fill_dense(
+                meas_out, true_out, fixed, meas_params, trans_params, prior,
+                chunk_size
+               )
+    meas_data = [
+                    pd.DataFrame(
+                                    values, index = indices[1-setting],
+                                    columns = MEAS_COLUMNS
+                                )
+                    for values, setting in zip(meas_out, F_SETTING)
+                ]
+    return meas_data, pd.DataFrame(true_out, index = indices[0], columns = F_NR)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+                        "--layout", choices = ['tables', 'dense'],
+                        default = 'tables',
+                        help = "write the normalized Stata tables or the "
+                               "dense analysis arrays"
+                       )
+    parser.add_argument(
+                        "--chunk-size", type = int, default = CHUNK_SIZE,
+                        help = "number of caseids simulated at once"
+                       )
+    args = parser.parse_args()
+    specs = [
+                json.load(open(
+                                ppj("IN_MODEL_SPECS", name+".json"),
+                                encoding = "utf-8"
+                              ))
+                for name in ['smoother', 'measurements', 'transitions',
+                             'true_prior']
+            ]
+    if 'tables' == args.layout:
+        write_tables(*specs, chunk_size = args.chunk_size)
+    else:
+        write_dense(*specs, chunk_size = args.chunk_size)
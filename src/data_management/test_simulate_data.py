@@ -0,0 +1,84 @@
+import sys
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from simulate_data import simulate_chunks, simulate_factors, _concat_ids
+import simulate_data
+
+if __name__ == '__main__':
+    status = pytest.main([sys.argv[1]])
+    sys.exit(status)
+
+@pytest.fixture
+def setup_model():
+    out = {}
+    out['fixed'] = {'rnd_seed': 7, 'period': 4, 'obs': 25}
+    out['meas_params'] = [
+                            {
+                                'factor': fac, 'beta1': 1, 'beta2': 0.5,
+                                'z': 1 + 0.2*i, 'var': 0.5
+                            }
+                            for fac in ['fac1', 'fac2', 'fac3']
+                            for i in range(3)
+                         ]
+    out['trans_params'] = [
+                            {
+                                'phi': -0.5, 'lambda': 1, 'gamma1': 0.6,
+                                'gamma2': 0.2, 'gamma3': 0.2, 'var_u': 0.1
+                            },
+                            {
+                                'phi': 1, 'lambda': 1, 'gamma1': 0,
+                                'gamma2': 0.6, 'gamma3': 0, 'var_u': 0.1
+                            }
+                           ]
+    out['prior'] = [{'var_p': 0.2}, {'var_p': 0.2}, {'var_p': 0.2}]
+    return out
+
+def _simulate(setup, chunk_size):
+    chunks = list(simulate_chunks(
+                                    setup['fixed'], setup['meas_params'],
+                                    setup['trans_params'], setup['prior'],
+                                    chunk_size
+                                 ))
+    factors = np.concatenate([chunk[3] for chunk in chunks], axis = 1)
+    measurements = [
+                    np.concatenate([chunk[4][f] for chunk in chunks], axis = 1)
+                    for f in range(3)
+                   ]
+    return chunks, factors, measurements
+
+def test_chunks_cover_observations(setup_model, monkeypatch):
+    monkeypatch.setattr(simulate_data, 'BLOCK_SIZE', 4)
+    chunks, factors, measurements = _simulate(setup_model, 8)
+    assert [chunk[:2] for chunk in chunks] == [(0, 8), (8, 16), (16, 24),
+                                               (24, 25)]
+    assert factors.shape == (3, 25, 4)
+    assert all(meas.shape == (3, 25, 4) for meas in measurements)
+
+def test_data_independent_of_chunk_size(setup_model, monkeypatch):
+    monkeypatch.setattr(simulate_data, 'BLOCK_SIZE', 4)
+    _, factors, measurements = _simulate(setup_model, 4)
+    _, factors_2, measurements_2 = _simulate(setup_model, 12)
+    assert np.array_equal(factors, factors_2)
+    for meas, meas_2 in zip(measurements, measurements_2):
+        assert np.array_equal(meas, meas_2)
+
+def test_constant_factor(setup_model):
+    _, factors, measurements = _simulate(setup_model, 10)
+    assert np.all(factors[2] == factors[2, :, :1])
+    assert np.all(measurements[2] == measurements[2][..., :1])
+    assert not np.all(factors[0] == factors[0, :, :1])
+
+def test_linear_transition(setup_model):
+    # Without transition errors, fac2 moves by log(gamma2) each period.
+    setup_model['trans_params'][1]['var_u'] = 0
+    factors = simulate_factors(
+                                setup_model['trans_params'],
+                                setup_model['prior'], 5, 3,
+                                np.random.default_rng(0)
+                              )
+    assert_allclose(factors[1, :, 1:], factors[1, :, :-1] + np.log(0.6))
+
+def test_concat_ids():
+    ids = _concat_ids(np.array([1, 12, 345]), 3, np.array([8, 8, 10]))
+    assert np.array_equal(ids, [138, 1238, 345310])
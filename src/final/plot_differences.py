@@ -10,21 +10,26 @@ import seaborn as sns
 import sys
 
 from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import load_frame
+from src.final.summary_stats import differences
 
 def plot_differences(estimates, truth, spec):
-    diff = estimates - truth
-    ax = sns.boxplot(x = diff.loc[(slice(None),1),'fac3'])
+    # Px3xN differences, see summary_stats.differences.
+    diff = differences(estimates, truth)
+    periods = range(1, diff.shape[0]+1)
+    ax = sns.boxplot(x = diff[0, 2, :])
     fig = ax.get_figure()
     fig.savefig(ppj("OUT_FIGURES", spec+"_boxplot_fac3.png"))
     fig.clear()
     
-    unstacked_f1 = diff.loc[:,'fac1'].unstack(level=1)
+    # One column per period, as the unstacked DataFrame.
+    unstacked_f1 = pd.DataFrame(diff[:, 0, :].T, columns = periods)
     bp_fac1 = sns.boxplot(data = unstacked_f1)
     fig = bp_fac1.get_figure()
     fig.savefig(ppj("OUT_FIGURES", spec+"_boxplot_fac1.png"))
     fig.clear()
     
-    unstacked_f2 = diff.loc[:,'fac2'].unstack(level=1)
+    unstacked_f2 = pd.DataFrame(diff[:, 1, :].T, columns = periods)
     bp_fac2 = sns.boxplot(data = unstacked_f2)
     fig = bp_fac2.get_figure()
     fig.savefig(ppj("OUT_FIGURES", spec+"_boxplot_fac2.png"))
@@ -32,6 +37,6 @@ def plot_differences(estimates, truth, spec):
     
 if __name__ == '__main__':
     spec = sys.argv[1]
-    truth = pd.read_pickle(ppj('OUT_ANALYSIS','true_facs.pkl'))
-    est = pd.read_pickle(ppj('OUT_ANALYSIS',spec+'_factor_estimates.pkl'))
+    truth = load_frame(ppj('OUT_ANALYSIS','true_facs'))
+    est = load_frame(ppj('OUT_ANALYSIS',spec+'_factor_estimates'))
     plot_differences(est, truth, spec)
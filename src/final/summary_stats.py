@@ -2,25 +2,50 @@
 two tables. Specifically, the average bias and the root mean square error is
 provided for all factor types and periods.
 
+The statistics are computed on the dense Px3xN arrays of
+*particle_smoother.SmootherResult*; estimates and true factors given as
+DataFrames are converted first.
+
 """
 
-import pandas as pd
 import sys
+import numpy as np
+import pandas as pd
 
 from bld.project_paths import project_paths_join as ppj
+from src.analysis.artifacts import load_frame
+from src.analysis.particle_smoother import SmootherResult
+
+def differences(est, truth):
+    """Return the Px3xN array of differences between the estimates *est*
+    and the true factors *truth* (SmootherResult or pd.DataFrame each), at
+    the observations of *est*.
+    
+    """
+    
+    if isinstance(est, pd.DataFrame):
+        est = SmootherResult.from_frame(est)
+    if isinstance(truth, pd.DataFrame):
+        truth = SmootherResult.from_frame(truth)
+    return est.estimates - truth.observations(est.caseids)
 
 def summary_stats(est, truth):
-    diff = est - truth
+    diff = differences(est, truth)
     # Calculate mean bias and root mean square error per period and factor.
-    biases = diff.mean(level = 1)
-    rmses = diff.std(level = 1, ddof = 0)
+    index = pd.Index(np.arange(1, diff.shape[0]+1), name = 't')
+    columns = ['fac1', 'fac2', 'fac3']
+    biases = pd.DataFrame(diff.mean(axis = 2), index = index, columns = columns)
+    rmses = pd.DataFrame(
+                            diff.std(axis = 2, ddof = 0), index = index,
+                            columns = columns
+                        )
     
     return [biases, rmses]
     
 if __name__ == '__main__':
     spec = sys.argv[1]
-    truth = pd.read_pickle(ppj('OUT_ANALYSIS','true_facs.pkl'))
-    est = pd.read_pickle(ppj('OUT_ANALYSIS',spec+'_factor_estimates.pkl'))
+    truth = load_frame(ppj('OUT_ANALYSIS','true_facs'))
+    est = load_frame(ppj('OUT_ANALYSIS',spec+'_factor_estimates'))
     table_bias, table_rmse = summary_stats(est, truth)
     table_bias.to_csv(ppj('OUT_TABLES','{}_est_bias.csv'.format(spec)))
-    table_rmse.to_csv(ppj('OUT_TABLES','{}_est_rmse.csv'.format(spec)))
\ No newline at end of file
+    table_rmse.to_csv(ppj('OUT_TABLES','{}_est_rmse.csv'.format(spec)))